@@ -11,13 +11,19 @@
 #	Purpose: Contacts the Metro Transit XML web service as described at http://svc.metrotransit.org/
 #	to retrieve the number of minutes until the next bus, or no return value if there is no further bus.
 #
-#	Interface: Command-Line
+#	Interface: Command-Line, or as a Python module (nextBus, or nextBusAsync from asyncio programs;
+#				nextBusResult gives the next few departures and any error as a NextBusResult object)
 #
 #	External dependencies:	requests
 #		Install this dependency by using: pip install requests
-#	Standard libraries:		time, sys
+#	Standard libraries:		time, sys, os, csv, json, sqlite3, threading, collections, concurrent.futures, atexit,
+#						asyncio, urllib.parse, http.server, mmap, struct, signal, array, bisect, heapq, contextvars,
+#						difflib, math, re
+#		Because of these, this version needs CPython and no longer runs under Brython.  The web page
+#		runs web/nextbus.py instead: the original single-lookup version of this program, kept
+#		separately with the small requests shim in web/requests.py.
 #
-#	Example Command-Line: nextbus.py bus-route bus-stop-name direction
+#	Example Command-Line: nextbus.py [options] bus-route bus-stop-name direction
 #	
 #	bus-route:		should be a unique substring of the name of the bus route you want
 #					If you put # followed by a number, it picks a particular Metro Transit route number
@@ -27,6 +33,35 @@
 #	direction:			must be east, north, south, or west (case-insensitive)
 #					If you put #any, it lists all the directions for that route in the resulting error message
 #
+#	Options:
+#	--no-cache:		don't use the on-disk cache of routes, directions and stops
+#	--cache-dir DIR:	keep the on-disk cache in DIR instead of the default (~/.cache/nextbus)
+#	--batch FILE:		answer every query in FILE (or standard input, if FILE is -), one per line, as
+#					CSV (route,stop,direction) or JSON; prints one result line per query, in order
+#	--workers N:		number of departure lookups done at once in batch or board mode (default 8)
+#	--serve PORT:		instead of answering one query, run as a local HTTP server on PORT, keeping
+#					connections and caches warm between requests (see NextBusServer)
+#	--host HOST:		address the server listens on (default 127.0.0.1)
+#	--processes N:		with --serve, run N worker processes sharing one memory-mapped catalogue
+#					snapshot, which another process rebuilds every few hours (not on Windows)
+#	--catalogue FILE:	catalogue snapshot file (default: catalogue.snapshot in the cache directory); if it has
+#					been built, route, direction and stop names are looked up in it with no service calls
+#	--build-catalogue:	crawl every route, direction and stop (--workers at a time, rate limited) and write the
+#					catalogue snapshot file, then exit; meant to be run nightly
+#	--board:			instead of the three arguments, give ROUTE/DIRECTION/STOP codes (e.g. 21/2/SNUN 4/1/LALY) of
+#					the routes at one place; prints their next departures merged in time order, one per line
+#	--count N:		number of departures --board prints, or stops --find-stop prints (default 10)
+#	--find-stop:		instead of the three arguments, give part of a stop's name or its code (e.g. franklin lyndale);
+#					prints the best matching stops anywhere in the network, with the routes and directions serving each;
+#					without a catalogue snapshot, the first run crawls the network and saves one (see --build-catalogue)
+#	--profile:		time each stage of the work (route, direction and stop lookups, service calls, JSON decoding,
+#					matching...) and print a table of them to standard error at the end (see Metrics)
+#	--record FILE:		save every response from Metro Transit to the cassette FILE, to be played back with --replay
+#	--replay FILE:		answer from the responses saved in the cassette FILE (see --record) instead of Metro Transit,
+#					with the departure times moved up to now
+#	--watch:			keep watching the stop, printing the result again each time it changes; Metro Transit
+#					is polled often when a bus is due and rarely when the next one is far away (see NextBusWatch)
+#
 #	Return values are sent to Standard Output
 #	Example return value (as requested in design) if bus-route and bus-stop-name are unique matches:
 #		2 minutes
@@ -79,23 +114,1769 @@
 #	   the time is just the scheduled time.  Should my app do the same, or indicate
 #	   the difference between actual estimated arrival time and scheduled time in any way?
 
+import array
+import asyncio
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import contextvars
+import csv
+import difflib
+import heapq
+import http.server
+import json
+import math
+import mmap
+import os
+import re
 import requests
+import requests.adapters
+import signal
+import sqlite3
+import struct
+import sys
+import threading
 import time
+import urllib.parse
 
 #-- Global constants
 metroTransitServiceUrl = "https://svc.metrotransit.org"
 
+class PooledTransport:
+	"""
+	HTTP transport used for every call to the Metro Transit service.  It keeps a pool of
+	keep-alive connections, so one lookup pays for the TLS handshake once instead of once
+	per service call, and it puts a timeout and a retry budget on every call.
+	
+	Any object with the same get() and close() methods can be used as a transport (see
+	setTransport); get() must return an object with "ok", "status_code" and "content"
+	attributes and a json() method, like requests does.  RecordingTransport and
+	ReplayTransport record the responses of this live transport and play them back.
+	
+	Parameters
+	------------
+	timeout : float or tuple
+		(Optional) Default timeout in seconds for each call, either one number or a
+		(connect timeout, read timeout) tuple.
+	poolSize : int
+		(Optional) Maximum number of connections kept open to the service.
+	retries : int
+		(Optional) Number of times a failed connection or a 502/503/504 response is retried.
+	backoff : float
+		(Optional) Backoff factor in seconds between retries.
+	"""
+	def __init__(self, timeout = (3.05, 10.0), poolSize = 10, retries = 2, backoff = 0.2):
+		self.timeout = timeout
+		self.poolSize = poolSize
+		self.retries = retries
+		self.backoff = backoff
+		self.session = None
+		self.lock = threading.Lock()
+	
+	def getSession(self):
+		""" returns the pooled requests session, creating it on first use """
+		with self.lock:
+			if self.session is None:
+				session = requests.Session()
+				retry = requests.adapters.Retry(total = self.retries, backoff_factor = self.backoff, status_forcelist = (502, 503, 504))
+				adapter = requests.adapters.HTTPAdapter(pool_connections = self.poolSize, pool_maxsize = self.poolSize, max_retries = retry)
+				session.mount("https://", adapter)
+				session.mount("http://", adapter)
+				self.session = session
+			return self.session
+	
+	def get(self, url, params = None, timeout = None):
+		""" does an HTTP GET over the pooled session; timeout defaults to the transport's timeout """
+		if timeout is None: timeout = self.timeout
+		return self.getSession().get(url, params = params, timeout = timeout)
+	
+	def close(self):
+		""" closes all pooled connections; the next call opens a new session (also use this in a forked child) """
+		with self.lock:
+			if self.session is not None:
+				self.session.close()
+				self.session = None
+
+#-- The transport shared by every service call in this module
+transport = PooledTransport()
+
+def setTransport(newTransport):
+	""" replaces the transport used for all Metro Transit service calls, and returns the previous one """
+	global transport
+	oldTransport = transport
+	transport = newTransport
+	return oldTransport
+
+class TransportResponse:
+	""" an HTTP response with the parts of requests' Response object that this module uses: status_code, ok, content and json() """
+	def __init__(self, status_code, content):
+		self.status_code = status_code
+		self.ok = status_code < 400
+		self.content = content
+	
+	def json(self, **options):
+		""" returns the body decoded as JSON; options are passed on to json.loads, as by requests """
+		return json.loads(self.content.decode("utf-8-sig"), **options)
+
+#-- Cassette file format version written by Cassette.save
+cassetteVersion = 1
+
+#-- Finds the epoch milliseconds in Metro Transit times like /Date(1533081600000-0500)/, which the JSON may write as \/Date(...)\/
+departureTimePattern = re.compile(r"Date\((-?\d+)")
+
+def shiftDepartureTimes(text, seconds):
+	""" returns service JSON text with every /Date(...)/ time in it moved seconds later """
+	shift = int(round(seconds * 1000.0))
+	return departureTimePattern.sub(lambda match: "Date(" + str(int(match.group(1)) + shift), text)
+
+class Cassette:
+	"""
+	Responses from the Metro Transit service, recorded by RecordingTransport and played back
+	by ReplayTransport (or the unit tests' stub server), so that lookups can be repeated
+	exactly, offline, and as fast as wanted.  Responses are kept by path (e.g.
+	"/NexTrip/Routes", or "/NexTripBadge.aspx?direction=1&route=4&stop=FRLY" for a request with other
+	parameters than the service's format=json), each path's in the order they were recorded;
+	playback hands them out in that order and then keeps repeating the last one.  Departure
+	times are moved forward by the time since they were recorded, so replayed buses are as
+	many minutes away as they were then.  Saved as a JSON file of the status, body text and
+	recording time of each response.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.responses = { }		# path -> [ [ HTTP status, body text, time recorded ], ... ]
+		self.played = collections.Counter()		# path -> responses handed out
+	
+	def __len__(self):
+		return sum(len(thisList) for thisList in self.responses.values())
+	
+	@staticmethod
+	def requestKey(url, params = None):
+		""" returns what a request for url with params is kept under: its path, followed by its query unless that is only format=json """
+		urlParts = urllib.parse.urlsplit(url)
+		query = urllib.parse.parse_qsl(urlParts.query) + list((params or { }).items())
+		query = sorted((str(name), str(value)) for name, value in query if (name, value) != ('format', 'json'))
+		return urlParts.path + ("?" + urllib.parse.urlencode(query) if query else "")
+	
+	@classmethod
+	def load(cls, cassettePath):
+		""" returns the cassette saved in a file; raises OSError if it can't be read, or ValueError if it isn't a cassette """
+		with open(cassettePath, encoding = "utf-8") as cassetteFile:
+			data = json.load(cassetteFile)
+		if not isinstance(data, dict) or data.get('version') != cassetteVersion: raise ValueError("not a cassette of the current version")
+		cassette = cls()
+		cassette.responses = { thisPath: [ list(thisResponse) for thisResponse in responses ] for thisPath, responses in data['responses'].items() }
+		return cassette
+	
+	def save(self, cassettePath):
+		""" writes the cassette to a file, replacing it atomically """
+		with self.lock:
+			data = { 'version': cassetteVersion, 'responses': self.responses }
+			temporaryPath = cassettePath + ".tmp" + str(os.getpid())
+			with open(temporaryPath, "w", encoding = "utf-8") as cassetteFile:
+				json.dump(data, cassetteFile, indent = 1, sort_keys = True)
+			os.replace(temporaryPath, cassettePath)
+	
+	def record(self, path, status, body, recordedAt = None):
+		""" adds a response (body as bytes or text) for a path """
+		if isinstance(body, bytes): body = body.decode("utf-8-sig")
+		with self.lock:
+			self.responses.setdefault(path, [ ]).append([ status, body, time.time() if recordedAt is None else recordedAt ])
+	
+	def play(self, path, nowTime = None, shiftTimes = True):
+		""" returns (HTTP status, body bytes) of the next response for a path, with departure times moved up to nowTime if shiftTimes is true, or None if the path wasn't recorded """
+		with self.lock:
+			responses = self.responses.get(path)
+			if not responses: return None
+			status, body, recordedAt = responses[min(self.played[path], len(responses) - 1)]
+			self.played[path] += 1
+		if shiftTimes: body = shiftDepartureTimes(body, (time.time() if nowTime is None else nowTime) - recordedAt)
+		return status, body.encode("utf-8")
+
+class RecordingTransport:
+	"""
+	Transport (see setTransport) that passes every call on to another transport, normally
+	the live one, and records each response in a Cassette to be played back later by
+	ReplayTransport.  Calls that fail without a response are not recorded.
+	"""
+	def __init__(self, innerTransport = None, cassette = None):
+		self.innerTransport = innerTransport if innerTransport is not None else PooledTransport()
+		self.cassette = cassette if cassette is not None else Cassette()
+	
+	def get(self, url, params = None, timeout = None):
+		response = self.innerTransport.get(url, params = params, timeout = timeout)
+		self.cassette.record(Cassette.requestKey(url, params), response.status_code, response.content)
+		return response
+	
+	def close(self):
+		self.innerTransport.close()
+
+class AsyncRecordingTransport(RecordingTransport):
+	""" version of RecordingTransport for the coroutine service calls (see setAsyncTransport), passing calls on to an AsyncTransport by default """
+	def __init__(self, innerTransport = None, cassette = None):
+		super().__init__(innerTransport if innerTransport is not None else AsyncTransport(), cassette)
+	
+	async def get(self, url, params = None, timeout = None):
+		response = await self.innerTransport.get(url, params = params, timeout = timeout)
+		self.cassette.record(Cassette.requestKey(url, params), response.status_code, response.content)
+		return response
+
+class ReplayTransport:
+	"""
+	Transport (see setTransport) that answers every call from a Cassette instead of the
+	network, for tests that must be repeatable and must not depend on Metro Transit.  A
+	path missing from the cassette fails like an unreachable service.
+	
+	Parameters
+	------------
+	cassette : Cassette or str
+		The cassette, or the file to load it from.
+	latency : float
+		(Optional) Seconds each call takes, to imitate the network.  A call whose timeout is
+		shorter fails with a timeout after waiting that long.
+	shiftTimes : boolean
+		(Optional) If true (the default), departure times are moved forward by the time since
+		they were recorded; see Cassette.play.
+	clock : function
+		(Optional) Returns the current time in seconds since the Unix epoch, for shiftTimes.
+	"""
+	def __init__(self, cassette, latency = 0.0, shiftTimes = True, clock = time.time):
+		self.cassette = Cassette.load(cassette) if isinstance(cassette, str) else cassette
+		self.latency = latency
+		self.shiftTimes = shiftTimes
+		self.clock = clock
+	
+	def get(self, url, params = None, timeout = None):
+		readTimeout = timeout[-1] if isinstance(timeout, tuple) else timeout
+		if self.latency > 0:
+			if readTimeout is not None and self.latency > readTimeout:
+				time.sleep(readTimeout)
+				raise requests.Timeout("replayed call timed out")
+			time.sleep(self.latency)
+		return self.play(url, params)
+	
+	def play(self, url, params):
+		""" returns the TransportResponse for a call from the cassette """
+		requestKey = Cassette.requestKey(url, params)
+		answer = self.cassette.play(requestKey, self.clock(), self.shiftTimes)
+		if answer is None: raise requests.ConnectionError("not in the cassette: " + requestKey)
+		return TransportResponse(*answer)
+	
+	def close(self):
+		pass
+
+class AsyncReplayTransport(ReplayTransport):
+	""" version of ReplayTransport for the coroutine service calls (see setAsyncTransport); the latency is waited out without blocking the event loop """
+	async def get(self, url, params = None, timeout = None):
+		if isinstance(timeout, tuple): timeout = sum(timeout)
+		if self.latency > 0:
+			if timeout is not None and self.latency > timeout:
+				await asyncio.sleep(timeout)
+				raise asyncio.TimeoutError()
+			await asyncio.sleep(self.latency)
+		return self.play(url, params)
+
+#-- HTTP status codes of redirects that AsyncTransport follows, as requests does
+redirectStatuses = frozenset([ 301, 302, 303, 307, 308 ])
+
+class AsyncTransport:
+	"""
+	Asyncio HTTP/1.1 transport used by the coroutine versions of the service calls (e.g.
+	getMetroTransitServiceAsync), so that thousands of lookups can be in flight on one event
+	loop without a thread each.  Like PooledTransport, it keeps keep-alive connections open
+	between calls and puts a timeout on every call, and like requests it follows redirects.
+	
+	Parameters
+	------------
+	timeout : float or tuple
+		(Optional) Default timeout in seconds for each whole call, redirects included; a
+		(connect, read) tuple is treated as their sum.
+	poolSize : int
+		(Optional) Maximum number of connections open at once, per event loop.
+	maxRedirects : int
+		(Optional) Most redirects followed for one call before it fails, as requests' default.
+	"""
+	def __init__(self, timeout = (3.05, 10.0), poolSize = 10, maxRedirects = 30):
+		self.timeout = timeout
+		self.poolSize = poolSize
+		self.maxRedirects = maxRedirects
+		self.loop = None
+		self.idleConnections = { }		# (scheme, host, port) -> list of idle (reader, writer) pairs
+		self.semaphore = None
+	
+	async def get(self, url, params = None, timeout = None):
+		""" does an HTTP GET and returns a TransportResponse; raises OSError or asyncio.TimeoutError on failure """
+		if timeout is None: timeout = self.timeout
+		if isinstance(timeout, tuple): timeout = sum(timeout)
+		loop = asyncio.get_running_loop()
+		if self.loop is not loop:
+			# connections belong to the loop that opened them, so start over on a new loop
+			self.loop = loop
+			self.idleConnections = { }
+			self.semaphore = asyncio.Semaphore(self.poolSize)
+		return await asyncio.wait_for(self.followRedirects(url, params), timeout)
+	
+	async def followRedirects(self, url, params):
+		""" sends a GET, and sends it again where each redirect response's Location says, as requests does; raises OSError after maxRedirects of them """
+		for redirectCount in range(self.maxRedirects + 1):
+			status, headers, body = await self.request(url, params)
+			location = headers.get("location")
+			if status not in redirectStatuses or not location: return TransportResponse(status, body)
+			url, params = urllib.parse.urljoin(url, location), None		# the Location has whatever query it needs
+		raise OSError("too many redirects from " + url)
+	
+	async def request(self, url, params, method = "GET"):
+		"""
+		sends one request over an idle connection if there is one, retrying once on a new
+		connection if the idle one was closed, and returns (status code, headers, body bytes)
+		"""
+		urlParts = urllib.parse.urlsplit(url)
+		query = urlParts.query
+		if params: query += ("&" if query else "") + urllib.parse.urlencode(params)
+		target = (urlParts.path or "/") + ("?" + query if query else "")
+		useSsl = (urlParts.scheme == "https")
+		hostKey = (urlParts.scheme, urlParts.hostname, urlParts.port or (443 if useSsl else 80))
+		requestBytes = (method + " " + target + " HTTP/1.1\r\nHost: " + urlParts.netloc + "\r\nAccept: application/json\r\nConnection: keep-alive\r\n\r\n").encode("latin-1")
+		async with self.semaphore:
+			idleList = self.idleConnections.setdefault(hostKey, [ ])
+			while True:
+				reused = len(idleList) > 0
+				if reused:
+					reader, writer = idleList.pop()
+				else:
+					reader, writer = await asyncio.open_connection(hostKey[1], hostKey[2], ssl = True if useSsl else None)
+				try:
+					writer.write(requestBytes)
+					await writer.drain()
+					status, keepAlive, headers, body = await self.readResponse(reader, method)
+				except (OSError, asyncio.IncompleteReadError):
+					writer.close()
+					if reused: continue		# the server closed the idle connection; try again on a new one
+					raise
+				except BaseException:
+					writer.close()
+					raise
+				if keepAlive:
+					idleList.append((reader, writer))
+				else:
+					writer.close()
+				return status, headers, body
+	
+	async def readResponse(self, reader, method = "GET"):
+		""" reads an HTTP/1.1 response to a method request and returns (status code, whether the connection can be reused, headers by lowercase name, body bytes) """
+		statusLine = await reader.readline()
+		if not statusLine: raise ConnectionError("connection closed")
+		status = int(statusLine.split()[1])
+		headers = { }
+		while True:
+			headerLine = await reader.readline()
+			if headerLine in (b"\r\n", b"\n", b""): break
+			headerName, separator, headerValue = headerLine.decode("latin-1").partition(":")
+			headers[headerName.strip().lower()] = headerValue.strip()
+		keepAlive = headers.get("connection", "").lower() != "close"
+		if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+			body = b""		# these never have a body, whatever the headers say
+		elif "chunked" in headers.get("transfer-encoding", "").lower():
+			chunks = [ ]
+			while True:
+				chunkSize = int((await reader.readline()).split(b";")[0], 16)
+				if chunkSize == 0: break
+				chunks.append(await reader.readexactly(chunkSize))
+				await reader.readexactly(2)		# the CRLF after each chunk
+			while (await reader.readline()) not in (b"\r\n", b"\n", b""): pass		# trailer headers
+			body = b"".join(chunks)
+		elif "content-length" in headers:
+			body = await reader.readexactly(int(headers["content-length"]))
+		else:
+			body = await reader.read()
+			keepAlive = False
+		return status, keepAlive, headers, body
+	
+	def close(self):
+		""" closes all idle connections """
+		for idleList in self.idleConnections.values():
+			for reader, writer in idleList: writer.close()
+		self.idleConnections = { }
+
+#-- The transport shared by every coroutine service call in this module
+asyncTransport = AsyncTransport()
+
+def setAsyncTransport(newTransport):
+	""" replaces the transport used for coroutine Metro Transit service calls, and returns the previous one """
+	global asyncTransport
+	oldTransport = asyncTransport
+	asyncTransport = newTransport
+	return oldTransport
+
+class ServiceRecord:
+	"""
+	Base of the compact record types that objects in Metro Transit results are decoded into
+	(see decodeServiceJson) instead of dictionaries.  Each type keeps its fields in __slots__,
+	named as in the service's JSON, so a record has no dictionary of its own, and decoded
+	strings are interned, so a street or direction name that appears in thousands of records
+	is one string object.  Records read like the dictionaries they replace, e.g. record["Text"]
+	or record.get("Actual"), so extractMatches, commaList and the rest of this module work on
+	either, and a record compares equal to the dictionary with the same fields and values.
+	There is one type for each distinct list of fields, made the first time it is seen (see
+	serviceRecordType).
+	"""
+	__slots__ = ()
+	fields = ()
+	fieldSet = frozenset()
+	
+	def __init__(self, *values):
+		for thisField, thisValue in zip(self.fields, values): setattr(self, thisField, thisValue)
+	
+	def __getitem__(self, field):
+		if field not in self.fieldSet: raise KeyError(field)
+		return getattr(self, field)
+	
+	def get(self, field, default = None):
+		return getattr(self, field) if field in self.fieldSet else default
+	
+	def __contains__(self, field):
+		return field in self.fieldSet
+	
+	def __iter__(self):
+		return iter(self.fields)
+	
+	def __len__(self):
+		return len(self.fields)
+	
+	def keys(self):
+		return list(self.fields)
+	
+	def values(self):
+		return [ getattr(self, thisField) for thisField in self.fields ]
+	
+	def items(self):
+		return [ (thisField, getattr(self, thisField)) for thisField in self.fields ]
+	
+	def toDict(self):
+		""" returns the record as a dictionary that can be converted to JSON """
+		return { thisField: getattr(self, thisField) for thisField in self.fields }
+	
+	def __eq__(self, other):
+		if isinstance(other, ServiceRecord): return self.fields == other.fields and self.values() == other.values()
+		if isinstance(other, dict): return self.toDict() == other
+		return NotImplemented
+	
+	__hash__ = None		# like the dictionaries they stand for
+	
+	def __repr__(self):
+		return repr(self.toDict())
+
+#-- Decode objects in service results as ServiceRecords (True) or as plain dictionaries (False)
+compactRecords = True
+
+#-- ServiceRecord types made so far, keyed by their tuple of fields; past maxServiceRecordTypes, odd objects stay dictionaries
+serviceRecordTypes = { }
+maxServiceRecordTypes = 256
+
+def serviceRecordType(fields):
+	""" returns the ServiceRecord type for a tuple of field names, making it the first time, or None if the fields can't be slots """
+	recordType = serviceRecordTypes.get(fields)
+	if recordType is None:
+		if len(serviceRecordTypes) >= maxServiceRecordTypes: return None
+		for thisField in fields:
+			if not isinstance(thisField, str) or not thisField.isidentifier() or thisField.startswith("_") or hasattr(ServiceRecord, thisField): return None
+		recordType = type("ServiceRecord", (ServiceRecord,), { '__slots__': fields, 'fields': fields, 'fieldSet': frozenset(fields) })
+		recordType = serviceRecordTypes.setdefault(fields, recordType)
+	return recordType
+
+def compactServiceObject(item):
+	""" object_hook for json.loads: returns an object decoded from service JSON as a ServiceRecord with interned strings, or the dictionary itself if it can't be one """
+	recordType = serviceRecordType(tuple(item))
+	if recordType is None: return item
+	return recordType(*[ sys.intern(thisValue) if type(thisValue) is str else thisValue for thisValue in item.values() ])
+
+class ServiceList(list):
+	"""
+	A list result from the Metro Transit service (routes, directions, stops or departures),
+	carrying what has been worked out from it so that it is only worked out once: the
+	MatchIndex for each field searched (see getMatchIndex), and for departures the parsed
+	DepartureTimes (see decodeDepartures).  These go when the result does, instead of
+	being kept in a cache of their own that would also have to keep the result alive.
+	"""
+	__slots__ = ("matchIndexes", "departureTimes")
+	
+	def __init__(self, items = ()):
+		super().__init__(items)
+		self.matchIndexes = { }		# field -> MatchIndex
+		self.departureTimes = None
+
+def serviceResult(decoded):
+	""" returns a decoded service result as a ServiceList if it is a list, or as it is otherwise """
+	return ServiceList(decoded) if type(decoded) is list else decoded
+
+def decodeServiceJson(text):
+	""" returns a service result decoded from JSON text, with its objects as ServiceRecords if compactRecords is set """
+	return serviceResult(json.loads(text, object_hook = compactServiceObject if compactRecords else None))
+
+def serviceRecordJson(value):
+	""" default for json.dumps, so that results holding ServiceRecords can be converted to JSON """
+	if isinstance(value, ServiceRecord): return value.toDict()
+	raise TypeError("not JSON serializable: " + type(value).__name__)
+
+class TtlLruCache:
+	"""
+	Thread-safe cache holding at most maxEntries values, each stored with its own time to live.
+	When the cache is full, the least recently used entry is evicted.  Hits, misses and
+	evictions are counted, see stats().
+	
+	Parameters
+	------------
+	maxEntries : int
+		(Optional) Maximum number of entries kept.
+	clock : function
+		(Optional) Returns the current time in seconds; defaults to time.time.  Used for testing.
+	"""
+	def __init__(self, maxEntries = 1024, clock = time.time):
+		self.maxEntries = maxEntries
+		self.clock = clock
+		self.entries = collections.OrderedDict()		# key -> (expiry time, value), least recently used first
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+	
+	def get(self, key, default = None):
+		""" returns the unexpired value stored for key, or default if there is none """
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None:
+				if entry[0] > self.clock():
+					self.entries.move_to_end(key)
+					self.hits += 1
+					return entry[1]
+				del self.entries[key]
+			self.misses += 1
+			return default
+	
+	def put(self, key, value, ttl = None):
+		""" stores value for key for ttl seconds (None means until evicted; zero or less means don't store) """
+		if ttl is not None and ttl <= 0: return
+		expiry = float("inf") if ttl is None else self.clock() + ttl
+		with self.lock:
+			self.entries[key] = (expiry, value)
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.maxEntries:
+				self.entries.popitem(last = False)
+				self.evictions += 1
+	
+	def invalidate(self, prefix = None):
+		""" removes every entry whose key starts with prefix, or all entries if prefix is None; returns how many were removed """
+		with self.lock:
+			if prefix is None:
+				count = len(self.entries)
+				self.entries.clear()
+				return count
+			doomedKeys = [ key for key in self.entries if key.startswith(prefix) ]
+			for key in doomedKeys: del self.entries[key]
+			return len(doomedKeys)
+	
+	def stats(self):
+		""" returns a dictionary of the cache's size and its hit, miss and eviction counts """
+		with self.lock:
+			return { 'size': len(self.entries), 'maxEntries': self.maxEntries, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions }
+
+class TopCounter:
+	"""
+	Thread-safe count of how often each key is seen, for finding the heaviest sources of some
+	kind of traffic.  At most maxKeys keys are kept: when there are more, the less counted half
+	is dropped, so the heavy hitters stay while one-off keys can't use up memory.
+	"""
+	def __init__(self, maxKeys = 1000):
+		self.maxKeys = maxKeys
+		self.counts = collections.Counter()
+		self.total = 0
+		self.lock = threading.Lock()
+	
+	def add(self, key, amount = 1):
+		with self.lock:
+			self.counts[key] += amount
+			self.total += amount
+			if len(self.counts) > self.maxKeys:
+				self.counts = collections.Counter(dict(self.counts.most_common(self.maxKeys // 2)))
+	
+	def top(self, count = 10):
+		""" returns the count most seen keys and their counts, as [key, count] lists, most seen first """
+		with self.lock:
+			return [ [ key, keyCount ] for key, keyCount in self.counts.most_common(count) ]
+	
+	def clear(self):
+		with self.lock:
+			self.counts.clear()
+			self.total = 0
+
+class SqliteCache:
+	"""
+	Persistent cache of Metro Transit results in an SQLite database, shared by every process on
+	the host that uses the same cache directory.  The database is in WAL mode, so concurrent
+	readers never block and writers only block each other briefly.  Any database problem is
+	treated as a cache miss, since the cache is only an optimization.
+	
+	Parameters
+	------------
+	cacheDir : str
+		(Optional) Directory that holds the database; defaults to defaultCacheDir().
+	clock : function
+		(Optional) Returns the current time in seconds; defaults to time.time.  Used for testing.
+	"""
+	def __init__(self, cacheDir = None, clock = time.time):
+		if cacheDir is None: cacheDir = defaultCacheDir()
+		os.makedirs(cacheDir, exist_ok = True)
+		self.path = os.path.join(cacheDir, "nextbus_cache.sqlite3")
+		self.clock = clock
+		self.local = threading.local()		# SQLite connections can't be shared between threads
+		connection = self.connection()		# fail now, not on first use, if the database can't be created
+		connection.execute("CREATE TABLE IF NOT EXISTS results (url TEXT PRIMARY KEY, expiry REAL NOT NULL, body TEXT NOT NULL)")
+	
+	def connection(self):
+		""" returns this thread's connection to the database, opening it if needed (including after a fork) """
+		connection = getattr(self.local, "connection", None)
+		if connection is None or self.local.pid != os.getpid():
+			connection = sqlite3.connect(self.path, timeout = 5.0, isolation_level = None)
+			connection.execute("PRAGMA journal_mode=WAL")
+			connection.execute("PRAGMA synchronous=NORMAL")
+			self.local.connection = connection
+			self.local.pid = os.getpid()
+		return connection
+	
+	def getEntry(self, key):
+		""" returns (expiry time, value) for an unexpired entry, or None """
+		try:
+			row = self.connection().execute("SELECT expiry, body FROM results WHERE url = ?", (key,)).fetchone()
+			if row is None or row[0] <= self.clock(): return None
+			return (row[0], decodeServiceJson(row[1]))
+		except (sqlite3.Error, ValueError):
+			return None
+	
+	def get(self, key, default = None):
+		""" returns the unexpired value stored for key, or default if there is none """
+		entry = self.getEntry(key)
+		if entry is None: return default
+		return entry[1]
+	
+	def put(self, key, value, ttl):
+		""" stores value (which must be JSON-serializable, apart from ServiceRecords) for key for ttl seconds; zero or less means don't store """
+		if ttl <= 0: return
+		try:
+			self.connection().execute("INSERT OR REPLACE INTO results (url, expiry, body) VALUES (?, ?, ?)", (key, self.clock() + ttl, json.dumps(value, default = serviceRecordJson)))
+		except sqlite3.Error:
+			pass
+	
+	def invalidate(self, prefix = None):
+		""" removes every entry whose key starts with prefix, or all entries if prefix is None; returns how many were removed """
+		try:
+			if prefix is None:
+				cursor = self.connection().execute("DELETE FROM results")
+			else:
+				cursor = self.connection().execute("DELETE FROM results WHERE substr(url, 1, ?) = ?", (len(prefix), prefix))
+			return cursor.rowcount
+		except sqlite3.Error:
+			return 0
+
+def defaultCacheDir():
+	""" returns the default directory for the on-disk cache: $XDG_CACHE_HOME/nextbus, or ~/.cache/nextbus """
+	baseDir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+	return os.path.join(baseDir, "nextbus")
+
+#-- Marks a cache miss, since None and empty lists are valid cached results
+cacheMiss = object()
+
+#-- How long, in seconds, each class of Metro Transit endpoint is cached.  Routes, directions
+#-- and stops only change when the service changes; departures are live and not cached.
+endpointTtls = { 'routes': 6 * 3600, 'directions': 6 * 3600, 'stops': 6 * 3600, 'departures': 0, 'other': 0 }
+
+#-- In-process cache of Metro Transit service results, keyed by URL
+serviceCache = TtlLruCache(maxEntries = 2048)
+
+#-- Optional on-disk cache shared between processes, consulted after serviceCache; see enableDiskCache
+diskCache = None
+
+def enableDiskCache(cacheDir = None):
+	""" starts using an on-disk cache in cacheDir (or the default directory) and returns it; raises OSError or sqlite3.Error if it can't be opened """
+	global diskCache
+	diskCache = SqliteCache(cacheDir)
+	return diskCache
+
+def disableDiskCache():
+	""" stops using the on-disk cache """
+	global diskCache
+	diskCache = None
+
+#-- Catalogue snapshot files start with this, then a version byte and the header length.
+#-- Version 2 is the compact format described in writeCatalogueSnapshot.
+catalogueMagic = b"NXCAT"
+catalogueVersion = 2
+
+#-- Table cells of a catalogue snapshot are 32-bit string numbers; this bit marks a value that
+#-- wasn't a string, whose string is its JSON
+catalogueJsonFlag = 0x80000000
+catalogueCell = struct.Struct("<I")
+
+def catalogueMatchField(localPath):
+	""" returns the field that catalogue results for a local path are matched on, or None if they aren't catalogue results """
+	return { 'routes': "Description", 'directions': "Text", 'stops': "Text" }.get(endpointClass(localPath))
+
+def writeCatalogueSnapshot(snapshotPath, results, serviceUrl = None):
+	"""
+	Writes catalogue results (routes, directions and stops) to a compact snapshot file that
+	CatalogueSnapshot maps into memory.  The file is written under a temporary name and
+	renamed over snapshotPath, so readers always see a whole snapshot, either the old one or
+	the new one.
+	
+	The file has a small JSON header, then a string table, then one table per result.  Every
+	distinct string (field values, and the normalized match key of each record, so that
+	readers don't have to normalize them again) is stored once in the string table, as UTF-8
+	bytes found through an array of little-endian 32-bit offsets.  Each result is an array of
+	32-bit string numbers, one row per record and one column per field plus the match key;
+	the header gives each one's position, row count, field names and match field (as string
+	numbers too).
+	Street and stop names repeat a great deal across routes and directions, so the file is a
+	fraction of the size of the JSON, and a reader only decodes the rows it is asked for.
+	
+	Parameters
+	------------
+	snapshotPath : str
+		The file to write.
+	results : dict
+		Result lists in Metro Transit format, keyed by local path (e.g. "/NexTrip/Routes").
+	serviceUrl : str
+		(Optional) The service the results came from; defaults to metroTransitServiceUrl.
+	"""
+	stringNumbers = { }
+	stringBlobs = [ ]
+	def intern(text):
+		number = stringNumbers.get(text)
+		if number is None:
+			number = stringNumbers[text] = len(stringBlobs)
+			stringBlobs.append(text.encode("utf-8"))
+		return number
+	def cell(value):
+		if isinstance(value, str): return intern(value)
+		return intern(json.dumps(value, separators = (",", ":"))) | catalogueJsonFlag
+	tables = { }
+	cells = array.array("I")
+	for localPath, items in results.items():
+		matchField = catalogueMatchField(localPath)
+		columns = [ ]
+		for thisItem in items:
+			for thisField in thisItem:
+				if thisField not in columns: columns.append(thisField)
+		tables[localPath] = [ len(cells), len(items), [ intern(thisField) for thisField in columns ], -1 if matchField is None else intern(matchField) ]
+		for thisItem in items:
+			for thisField in columns:
+				cells.append(cell(thisItem.get(thisField)))
+			if matchField is not None: cells.append(intern(suppressMultipleSpaces(thisItem[matchField].upper())))
+	offsets = array.array("I", [ 0 ])
+	for thisBlob in stringBlobs: offsets.append(offsets[-1] + len(thisBlob))
+	stringBytes = offsets[-1]
+	if sys.byteorder == "big":
+		offsets.byteswap()
+		cells.byteswap()
+	offsetBytes, cellBytes = offsets.tobytes(), cells.tobytes()
+	header = json.dumps({ 'built': time.time(), 'serviceUrl': serviceUrl or metroTransitServiceUrl, 'strings': len(stringBlobs),
+		'stringBytes': stringBytes, 'tables': tables }, separators = (",", ":")).encode("utf-8")
+	temporaryPath = snapshotPath + ".tmp" + str(os.getpid())
+	with open(temporaryPath, "wb") as snapshotFile:
+		snapshotFile.write(catalogueMagic + struct.pack("<BI", catalogueVersion, len(header)) + header)
+		snapshotFile.write(offsetBytes)
+		for thisBlob in stringBlobs: snapshotFile.write(thisBlob)
+		snapshotFile.write(cellBytes)
+		snapshotFile.flush()
+		os.fsync(snapshotFile.fileno())
+	os.replace(temporaryPath, snapshotPath)
+
+class CatalogueSnapshot:
+	"""
+	Read-only view of a catalogue snapshot file written by writeCatalogueSnapshot.  The file is
+	memory-mapped, so opening it costs one small header read however big it is, and every
+	process that opens the same snapshot shares one copy of it in the operating system's page
+	cache.  Each process only decodes the results it actually uses, keeping a bounded number of
+	them decoded; equal strings decode to one shared string object.  When the file is replaced
+	by a new snapshot, readers switch to it within checkInterval seconds.
+	
+	Parameters
+	------------
+	snapshotPath : str
+		The snapshot file.  Raises OSError if it can't be read, or ValueError if it isn't a
+		snapshot of the current version.
+	decodedEntries : int
+		(Optional) Maximum number of results kept decoded in this process.
+	checkInterval : float
+		(Optional) Seconds between checks for a replaced snapshot file.
+	"""
+	def __init__(self, snapshotPath, decodedEntries = 256, checkInterval = 1.0):
+		self.path = snapshotPath
+		self.decodedEntries = decodedEntries
+		self.checkInterval = checkInterval
+		self.lock = threading.Lock()
+		self.load()
+	
+	def load(self):
+		""" maps the current snapshot file into memory """
+		with open(self.path, "rb") as snapshotFile:
+			fileStat = os.fstat(snapshotFile.fileno())
+			mapped = mmap.mmap(snapshotFile.fileno(), 0, access = mmap.ACCESS_READ)
+		prefixLength = len(catalogueMagic) + struct.calcsize("<BI")
+		if mapped[0:len(catalogueMagic)] != catalogueMagic: raise ValueError("not a catalogue snapshot")
+		version, headerLength = struct.unpack_from("<BI", mapped, len(catalogueMagic))
+		if version != catalogueVersion: raise ValueError("unsupported catalogue snapshot version")
+		header = json.loads(mapped[prefixLength:prefixLength + headerLength].decode("utf-8"))
+		offsetsStart = prefixLength + headerLength
+		stringsStart = offsetsStart + catalogueCell.size * (header['strings'] + 1)
+		cellsStart = stringsStart + header['stringBytes']
+		if len(mapped) < cellsStart: raise ValueError("truncated catalogue snapshot")
+		with self.lock:
+			self.mapped = mapped		# an older mapping is closed when the last reader lets go of it
+			self.offsetsStart = offsetsStart
+			self.stringsStart = stringsStart
+			self.cellsStart = cellsStart
+			self.built = header['built']
+			self.serviceUrl = header['serviceUrl']
+			self.entries = header['tables']
+			self.stringCount = header['strings']
+			self.strings = { }		# string number -> decoded string, so equal strings are one object
+			self.fileId = (fileStat.st_ino, fileStat.st_mtime_ns, fileStat.st_size)
+			self.decoded = TtlLruCache(maxEntries = self.decodedEntries)
+			self.nextCheck = time.time() + self.checkInterval
+	
+	def refreshIfChanged(self):
+		""" switches to a new snapshot file if the file has been replaced since it was loaded """
+		if time.time() < self.nextCheck: return
+		self.nextCheck = time.time() + self.checkInterval
+		try:
+			fileStat = os.stat(self.path)
+			if (fileStat.st_ino, fileStat.st_mtime_ns, fileStat.st_size) != self.fileId: self.load()
+		except (OSError, ValueError):
+			pass		# keep using the snapshot already loaded
+	
+	def string(self, number, mapped, offsetsStart, stringsStart, strings):
+		""" returns a string of the string table, decoding it only the first time """
+		text = strings.get(number)
+		if text is None:
+			start = catalogueCell.unpack_from(mapped, offsetsStart + catalogueCell.size * number)[0]
+			stop = catalogueCell.unpack_from(mapped, offsetsStart + catalogueCell.size * (number + 1))[0]
+			text = strings.setdefault(number, mapped[stringsStart + start:stringsStart + stop].decode("utf-8"))
+		return text
+	
+	def get(self, localPath, default = None):
+		""" returns the result for a local path, with its match index ready, or default if the snapshot doesn't have it """
+		self.refreshIfChanged()
+		with self.lock:
+			mapped, entry, decoded = self.mapped, self.entries.get(localPath), self.decoded
+			offsetsStart, stringsStart, cellsStart, strings = self.offsetsStart, self.stringsStart, self.cellsStart, self.strings
+		if entry is None: return default
+		items = decoded.get(localPath, cacheMiss)
+		if items is not cacheMiss: return items
+		firstCell, rowCount, columnNumbers, matchFieldNumber = entry
+		def value(number):
+			if number & catalogueJsonFlag: return json.loads(self.string(number & ~catalogueJsonFlag, mapped, offsetsStart, stringsStart, strings))
+			return self.string(number, mapped, offsetsStart, stringsStart, strings)
+		columns = [ value(thisNumber) for thisNumber in columnNumbers ]
+		matchField = None if matchFieldNumber < 0 else value(matchFieldNumber)
+		rowWidth = len(columns) + (0 if matchField is None else 1)
+		cellValues = struct.unpack_from("<" + str(rowCount * rowWidth) + "I", mapped, cellsStart + catalogueCell.size * firstCell)
+		recordType = serviceRecordType(tuple(columns)) if compactRecords else None
+		items = ServiceList()
+		matchKeys = [ ]
+		for rowStart in range(0, rowCount * rowWidth, rowWidth):
+			if recordType is not None:
+				items.append(recordType(*[ value(cellValues[rowStart + i]) for i in range(len(columns)) ]))
+			else:
+				items.append({ thisField: value(cellValues[rowStart + i]) for i, thisField in enumerate(columns) })
+			if matchField is not None: matchKeys.append(value(cellValues[rowStart + len(columns)]))
+		if matchField is not None: items.matchIndexes[matchField] = MatchIndex(items, matchField, matchKeys)
+		decoded.put(localPath, items)
+		return items
+	
+	def stats(self):
+		""" returns when the snapshot was built and how many results and strings it has, as a dictionary """
+		with self.lock:
+			return { 'path': self.path, 'built': self.built, 'results': len(self.entries), 'strings': self.stringCount, 'decodedStrings': len(self.strings),
+				'records': sum(thisEntry[1] for thisEntry in self.entries.values()) }
+
+#-- Catalogue snapshot consulted before the service caches, if one is in use; see useCatalogueSnapshot
+catalogueSnapshot = None
+
+def useCatalogueSnapshot(snapshotPath):
+	""" starts answering routes, directions and stops from a snapshot file, and returns the CatalogueSnapshot; None stops using one """
+	global catalogueSnapshot, pendingSnapshotPath
+	catalogueSnapshot = None if snapshotPath is None else CatalogueSnapshot(snapshotPath)
+	pendingSnapshotPath = None
+	return catalogueSnapshot
+
+#-- Snapshot file that awaitCatalogueSnapshot couldn't load yet and is still trying, the time
+#-- of its next try, and the seconds between tries
+pendingSnapshotPath = None
+pendingSnapshotRetry = 0.0
+catalogueRetryInterval = 1.0
+
+def awaitCatalogueSnapshot(snapshotPath):
+	"""
+	Starts using a snapshot file like useCatalogueSnapshot if it can be loaded now.  If not
+	(e.g. it hasn't been built yet), routes, directions and stops come from the service and
+	its caches meanwhile, and the file is tried again on lookups, at most every
+	catalogueRetryInterval seconds, until it loads.  Returns the CatalogueSnapshot, or None
+	if it isn't loaded yet.
+	"""
+	global pendingSnapshotPath, pendingSnapshotRetry
+	try:
+		return useCatalogueSnapshot(snapshotPath)
+	except (OSError, ValueError):
+		pendingSnapshotPath = snapshotPath
+		pendingSnapshotRetry = time.time() + catalogueRetryInterval
+		return None
+
+def retryPendingCatalogueSnapshot():
+	""" tries loading the snapshot awaitCatalogueSnapshot is waiting for, if it is time; returns the CatalogueSnapshot or None """
+	snapshotPath = pendingSnapshotPath
+	if snapshotPath is None or time.time() < pendingSnapshotRetry: return None
+	return awaitCatalogueSnapshot(snapshotPath)
+
+#-- Snapshots older than this many seconds are not used by useFreshCatalogueSnapshot (the
+#-- snapshot is meant to be rebuilt nightly, so this allows for a few missed rebuilds)
+catalogueMaxAge = 3 * 24 * 3600
+
+def useFreshCatalogueSnapshot(snapshotPath, maxAge = None):
+	"""
+	Starts using a snapshot file like useCatalogueSnapshot, but only if it exists, can be read,
+	and was built no more than maxAge seconds ago (default catalogueMaxAge); otherwise routes,
+	directions and stops keep coming from the service and its caches.  Returns the
+	CatalogueSnapshot, or None if it isn't used.
+	"""
+	if maxAge is None: maxAge = catalogueMaxAge
+	try:
+		snapshot = CatalogueSnapshot(snapshotPath)
+	except (OSError, ValueError):
+		return None
+	if time.time() - snapshot.built > maxAge: return None
+	global catalogueSnapshot
+	catalogueSnapshot = snapshot
+	return snapshot
+
+def endpointClass(localPath):
+	""" returns the class of Metro Transit endpoint a local path belongs to: routes, directions, stops, departures or other """
+	parts = localPath.strip("/").split("/")
+	if len(parts) < 2 or parts[0] != "NexTrip": return "other"
+	if parts[1] == "Routes": return "routes"
+	if parts[1] == "Directions": return "directions"
+	if parts[1] == "Stops": return "stops"
+	if len(parts) == 4: return "departures"
+	return "other"
+
+def invalidateServiceCache(localPath = None):
+	"""
+	Removes cached Metro Transit results from memory and from the on-disk cache, so they are
+	fetched again on next use.  With no localPath, the whole cache is cleared; otherwise every cached path starting with localPath
+	is removed (e.g. "/NexTrip/Stops/21" removes the stops for both directions of route 21).
+	Remembered query resolutions (including ones with no unique match) are always cleared, since
+	they were worked out from the cache, error responses under localPath are forgotten,
+	and so are last-known departures under localPath (see getDeparturesStaleWhileRevalidate).
+	Returns the number of results removed from memory.
+	"""
+	prefix = None if localPath is None else metroTransitServiceUrl + localPath
+	if diskCache is not None: diskCache.invalidate(prefix)
+	resolutionCache.invalidate()
+	negativeResolutionCache.invalidate()
+	errorResponseCache.invalidate(prefix)
+	departureCache.invalidate(prefix)
+	return serviceCache.invalidate(prefix)
+
+class SingleFlight:
+	"""
+	Coalesces identical calls that are in flight at the same time: the first caller for a key
+	(the leader) does the work, and callers that arrive before it finishes wait for it and get
+	the same result, or the same exception, instead of repeating the work.  Threads and asyncio
+	tasks share the same flights, see do() and doAsync().  Counts calls and how many were
+	collapsed into another caller's flight.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.flights = { }		# key -> (concurrent.futures.Future, thread id of the leader)
+		self.calls = 0
+		self.collapsed = 0
+	
+	def join(self, key, canWaitInThisThread):
+		""" returns (future, True) if the caller leads a new flight for key, or (future, False) to wait for the flight already in progress """
+		with self.lock:
+			self.calls += 1
+			flight = self.flights.get(key)
+			# a blocking wait on a flight led from this same thread (an asyncio task on this thread's
+			# event loop) could never finish, so such a caller gets a flight of its own
+			if flight is not None and (canWaitInThisThread or flight[1] != threading.get_ident()):
+				self.collapsed += 1
+				return flight[0], False
+			future = concurrent.futures.Future()
+			if flight is None: self.flights[key] = (future, threading.get_ident())
+			return future, True
+	
+	def finish(self, key, future, result = None, error = None):
+		""" ends a flight, handing its result or error to everyone waiting for it """
+		with self.lock:
+			if key in self.flights and self.flights[key][0] is future: del self.flights[key]
+		if error is not None:
+			future.set_exception(error if isinstance(error, Exception) else IOError())
+		else:
+			future.set_result(result)
+	
+	def do(self, key, function):
+		""" returns function(), or the result of the identical call already in flight for key """
+		future, isLeader = self.join(key, False)
+		if not isLeader: return future.result()
+		try:
+			result = function()
+		except BaseException as error:
+			self.finish(key, future, error = error)
+			raise
+		self.finish(key, future, result)
+		return result
+	
+	async def doAsync(self, key, coroutineFunction):
+		""" coroutine version of do(): returns await coroutineFunction(), or the result of the identical call already in flight for key """
+		future, isLeader = self.join(key, True)
+		if not isLeader: return await asyncio.wrap_future(future)
+		try:
+			result = await coroutineFunction()
+		except BaseException as error:
+			self.finish(key, future, error = error)
+			raise
+		self.finish(key, future, result)
+		return result
+	
+	def stats(self):
+		""" returns a dictionary of the number of calls, how many were collapsed into another call, and how many flights are in progress """
+		with self.lock:
+			return { 'calls': self.calls, 'collapsed': self.collapsed, 'inFlight': len(self.flights) }
+
+#-- In-flight fetches from the Metro Transit service, keyed by URL, shared by threads and asyncio tasks
+serviceFlights = SingleFlight()
+
+#-- Upper bounds, in seconds, of the buckets of Metrics' latency histograms
+metricsBuckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+#-- Counters kept by Metrics: name -> (Prometheus metric name, label name, help text)
+metricsCounters = {
+	'httpRequests': ("nextbus_http_requests_total", "endpoint", "Requests sent to Metro Transit, by endpoint."),
+	'httpStatus': ("nextbus_http_responses_total", "status", "Responses from Metro Transit, by HTTP status."),
+	'httpBytes': ("nextbus_http_response_bytes_total", "endpoint", "Bytes of response bodies from Metro Transit, by endpoint."),
+	'serviceErrors': ("nextbus_service_errors_total", "error", "Service calls that failed, by the kind of failure."),
+	'cacheLookups': ("nextbus_cache_lookups_total", "source", "Lookups of cacheable results, by where the result came from (miss: fetched)."),
+	'results': ("nextbus_results_total", "kind", "Query results, by error kind (OK for none).") }
+
+class Metrics:
+	"""
+	Built-in instrumentation: latency histograms for each stage of a query, and counters of
+	service calls, response bytes, cache lookups, failures and result kinds (see
+	metricsCounters).  The stages are "query" (all of nextBusResult), "resolve" (finding the
+	route, direction and stop codes), "departures" (getting the stop's departures), each
+	getMetroTransitService call by endpoint (e.g. "service stops", counting cache hits), "http"
+	(the network fetch, with any retries or hedging), "decode" (JSON decoding) and "match"
+	(extractMatches).  They nest, so their times overlap.
+	
+	Collection is off until enable() is called.  While it is off, start() returns None and
+	finish() and count() return at once, so each instrumented stage costs one attribute check.
+	The figures can be read as a dictionary (stats), in the Prometheus text format (prometheus)
+	or as a table of stages (profile).
+	"""
+	def __init__(self, buckets = metricsBuckets, clock = time.perf_counter):
+		self.buckets = buckets
+		self.clock = clock
+		self.enabled = False
+		self.lock = threading.Lock()
+		self.reset()
+	
+	def enable(self, enabled = True):
+		""" turns collection on, or off if enabled is False, keeping what has been collected """
+		self.enabled = enabled
+	
+	def reset(self):
+		""" forgets everything collected """
+		with self.lock:
+			self.histograms = { }		# stage -> [ count in each bucket then slower than all of them, total seconds, slowest seconds ]
+			self.counters = { thisName: collections.Counter() for thisName in metricsCounters }
+	
+	def start(self):
+		""" returns the time a stage starts, to pass to finish(), or None while collection is off """
+		return self.clock() if self.enabled else None
+	
+	def finish(self, stage, started):
+		""" records the time since start() returned started as one call of stage """
+		if started is None: return
+		seconds = self.clock() - started
+		position = bisect.bisect_left(self.buckets, seconds)
+		with self.lock:
+			histogram = self.histograms.get(stage)
+			if histogram is None: histogram = self.histograms[stage] = [ [ 0 ] * (len(self.buckets) + 1), 0.0, 0.0 ]
+			histogram[0][position] += 1
+			histogram[1] += seconds
+			histogram[2] = max(histogram[2], seconds)
+	
+	def count(self, name, label, amount = 1):
+		""" adds amount to the counter name (one of metricsCounters) for label """
+		if not self.enabled: return
+		with self.lock:
+			self.counters[name][label] += amount
+	
+	def stats(self):
+		""" returns everything collected as a dictionary: for each stage its calls, total and slowest seconds and bucket counts, and each counter by label """
+		with self.lock:
+			stages = { thisStage: { 'calls': sum(histogram[0]), 'seconds': histogram[1], 'maxSeconds': histogram[2], 'buckets': list(histogram[0]) }
+				for thisStage, histogram in self.histograms.items() }
+			return { 'enabled': self.enabled, 'bucketBounds': list(self.buckets), 'stages': stages,
+				'counters': { thisName: dict(thisCounter) for thisName, thisCounter in self.counters.items() } }
+	
+	def prometheus(self):
+		""" returns everything collected in the Prometheus text exposition format """
+		def labelValue(value):
+			return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+		stats = self.stats()
+		lines = [ "# HELP nextbus_stage_seconds Time taken by each stage of nextBus queries.", "# TYPE nextbus_stage_seconds histogram" ]
+		for thisStage, stage in sorted(stats['stages'].items()):
+			cumulative = 0
+			for bound, bucketCount in zip(list(self.buckets) + [ "+Inf" ], stage['buckets']):
+				cumulative += bucketCount
+				lines.append("nextbus_stage_seconds_bucket{stage=" + labelValue(thisStage) + ",le=" + labelValue(bound) + "} " + str(cumulative))
+			lines.append("nextbus_stage_seconds_sum{stage=" + labelValue(thisStage) + "} " + repr(stage['seconds']))
+			lines.append("nextbus_stage_seconds_count{stage=" + labelValue(thisStage) + "} " + str(stage['calls']))
+		for thisName, (metricName, labelName, helpText) in metricsCounters.items():
+			lines += [ "# HELP " + metricName + " " + helpText, "# TYPE " + metricName + " counter" ]
+			for label, value in sorted(stats['counters'][thisName].items()):
+				lines.append(metricName + "{" + labelName + "=" + labelValue(label) + "} " + str(value))
+		return "\n".join(lines) + "\n"
+	
+	def profile(self):
+		""" returns a table of the stages, slowest in total first, with their calls, total, average and slowest times in milliseconds, followed by the counters """
+		stats = self.stats()
+		lines = [ "{:<22}{:>8}{:>12}{:>12}{:>12}".format("stage", "calls", "total ms", "mean ms", "max ms") ]
+		for thisStage, stage in sorted(stats['stages'].items(), key = lambda thisItem: -thisItem[1]['seconds']):
+			lines.append("{:<22}{:>8}{:>12.3f}{:>12.3f}{:>12.3f}".format(thisStage, stage['calls'], stage['seconds'] * 1000.0,
+				stage['seconds'] * 1000.0 / stage['calls'], stage['maxSeconds'] * 1000.0))
+		for thisName, thisCounter in stats['counters'].items():
+			if thisCounter: lines.append(thisName + ": " + ", ".join(str(label) + " " + str(value) for label, value in sorted(thisCounter.items(), key = lambda thisItem: str(thisItem[0]))))
+		return "\n".join(lines)
+
+#-- Instrumentation of this module's queries and service calls, off until enabled (see Metrics)
+metrics = Metrics()
+
+class LatencyTracker:
+	"""
+	Recent latencies of one kind of service call: an exponentially weighted moving average,
+	which follows the typical latency, and a window of the most recent samples to take
+	percentiles from, which show the slow tail.
+	"""
+	def __init__(self, windowSize = 200, alpha = 0.2):
+		self.alpha = alpha
+		self.ewma = None
+		self.samples = collections.deque(maxlen = windowSize)
+		self.lock = threading.Lock()
+	
+	def __len__(self):
+		return len(self.samples)
+	
+	def record(self, seconds):
+		""" adds the latency of one successful call """
+		with self.lock:
+			self.ewma = seconds if self.ewma is None else self.ewma + self.alpha * (seconds - self.ewma)
+			self.samples.append(seconds)
+	
+	def percentile(self, fraction):
+		""" returns the latency that fraction (e.g. 0.95) of the recent calls were no slower than, or None if there are no samples """
+		with self.lock:
+			ordered = sorted(self.samples)
+		if not ordered: return None
+		return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+	
+	def stats(self):
+		""" returns a dictionary of latency statistics in seconds, for monitoring """
+		return { 'samples': len(self), 'ewma': self.ewma, 'p50': self.percentile(0.5), 'p95': self.percentile(0.95), 'p99': self.percentile(0.99) }
+
+class CircuitOpenError(IOError):
+	""" raised instead of calling the service while the circuit breaker is open """
+
+#-- States of a CircuitBreaker
+circuitClosed = "closed"
+circuitOpen = "open"
+circuitHalfOpen = "half-open"
+
+class CircuitBreaker:
+	"""
+	Stops calls to the service while it is unhealthy, so that they fail at once instead of each
+	waiting for a timeout.  After failureThreshold failures in a row the circuit opens and
+	calls are refused; after resetTimeout seconds one trial call is let through (half-open),
+	and its success closes the circuit again while its failure reopens it.
+	"""
+	def __init__(self, failureThreshold = 5, resetTimeout = 30.0, clock = time.monotonic):
+		self.failureThreshold = failureThreshold
+		self.resetTimeout = resetTimeout
+		self.clock = clock
+		self.lock = threading.Lock()
+		self.reset()
+	
+	def reset(self):
+		""" closes the circuit and forgets past failures """
+		with self.lock:
+			self.state = circuitClosed
+			self.consecutiveFailures = 0
+			self.openedAt = None
+			self.trialInFlight = False
+			self.opens = 0
+			self.refused = 0
+	
+	def allow(self):
+		""" returns True if a call may go ahead now; every allowed call must be followed by recordSuccess or recordFailure """
+		with self.lock:
+			if self.state == circuitOpen and self.clock() - self.openedAt >= self.resetTimeout:
+				self.state = circuitHalfOpen
+				self.trialInFlight = False
+			if self.state == circuitClosed: return True
+			if self.state == circuitHalfOpen and not self.trialInFlight:
+				self.trialInFlight = True
+				return True
+			self.refused += 1
+			return False
+	
+	def abandon(self):
+		""" records that an allowed call was cancelled, so it tells nothing about the service """
+		with self.lock:
+			self.trialInFlight = False
+	
+	def recordSuccess(self):
+		with self.lock:
+			self.state = circuitClosed
+			self.consecutiveFailures = 0
+			self.trialInFlight = False
+	
+	def recordFailure(self):
+		with self.lock:
+			self.consecutiveFailures += 1
+			if self.state == circuitHalfOpen or self.consecutiveFailures >= self.failureThreshold:
+				if self.state != circuitOpen: self.opens += 1
+				self.state = circuitOpen
+				self.openedAt = self.clock()
+				self.trialInFlight = False
+	
+	def stats(self):
+		with self.lock:
+			return { 'state': self.state, 'consecutiveFailures': self.consecutiveFailures, 'opens': self.opens, 'refused': self.refused }
+
+#-- Thread pool for hedged service calls, created on first use
+hedgeExecutor = None
+hedgeExecutorLock = threading.Lock()
+
+def getHedgeExecutor():
+	""" returns the thread pool used for hedged service calls, creating it on first use """
+	global hedgeExecutor
+	with hedgeExecutorLock:
+		if hedgeExecutor is None:
+			hedgeExecutor = concurrent.futures.ThreadPoolExecutor(max_workers = 16, thread_name_prefix = "nextbus-hedge")
+		return hedgeExecutor
+
+#-- Priority lanes for calls to the service, most urgent first: live departures, the route,
+#-- direction and stop lookups of a query someone is waiting for, and background work (catalogue
+#-- crawls, batch jobs)
+priorityLive = 0
+priorityLookup = 1
+priorityBackground = 2
+
+#-- Priority lane for service calls made in the current thread or asyncio task, if not the default for the endpoint
+upstreamPriority = contextvars.ContextVar("upstreamPriority", default = None)
+
+def withPriority(priority, function, *arguments):
+	""" calls function(*arguments) with the service calls it makes in priority's lane, e.g. as the function run by a thread pool """
+	token = upstreamPriority.set(priority)
+	try:
+		return function(*arguments)
+	finally:
+		upstreamPriority.reset(token)
+
+class RateLimiter:
+	"""
+	Token bucket that keeps calls to the service under a rate (calls per second) with bursts of
+	up to burst calls, shared by every thread and asyncio task in the process.  A call that is
+	over the rate waits for its turn instead of failing, and waiting calls go in priority order
+	(lower numbers first, see priorityLive), first come first served within a lane, so live
+	departure fetches go ahead of queued-up background work.  A rate of None means no limit.
+	"""
+	def __init__(self, rate = 20.0, burst = 40, clock = time.monotonic):
+		self.rate = rate
+		self.burst = burst
+		self.clock = clock
+		self.condition = threading.Condition()
+		self.waiters = [ ]		# heap of (priority, sequence) of calls waiting for a token
+		self.sequence = 0
+		self.reset()
+	
+	def reset(self):
+		""" fills the bucket and forgets the statistics """
+		with self.condition:
+			self.tokens = float(self.burst)
+			self.updated = self.clock()
+			self.granted = collections.Counter()
+			self.waited = collections.Counter()
+			self.waitSeconds = collections.Counter()
+	
+	def refill(self):
+		nowTime = self.clock()
+		self.tokens = min(float(self.burst), self.tokens + (nowTime - self.updated) * self.rate)
+		self.updated = nowTime
+	
+	def tryTake(self, ticket):
+		""" takes a token for a waiting ticket if it is first in line and there is one; otherwise returns how long to wait before trying again """
+		self.refill()
+		if self.waiters[0] == ticket and self.tokens >= 1.0:
+			heapq.heappop(self.waiters)
+			self.tokens -= 1.0
+			self.condition.notify_all()		# the next in line may be able to go too
+			return None
+		ahead = sum(1 for thisTicket in self.waiters if thisTicket < ticket)
+		return max(0.001, (ahead + 1.0 - self.tokens) / self.rate)
+	
+	def enqueue(self, priority):
+		self.sequence += 1
+		ticket = (priority, self.sequence)
+		heapq.heappush(self.waiters, ticket)
+		return ticket
+	
+	def granting(self, priority, startTime):
+		""" counts a granted call and how long it waited """
+		self.granted[priority] += 1
+		waited = self.clock() - startTime
+		if waited > 0.0005:
+			self.waited[priority] += 1
+			self.waitSeconds[priority] += waited
+		return waited
+	
+	def acquire(self, priority = priorityLookup):
+		""" waits until a call in priority's lane may go ahead, and returns the seconds waited """
+		if self.rate is None: return 0.0
+		with self.condition:
+			startTime = self.clock()
+			ticket = self.enqueue(priority)
+			try:
+				while True:
+					delay = self.tryTake(ticket)
+					if delay is None: return self.granting(priority, startTime)
+					self.condition.wait(delay)
+			except BaseException:
+				self.waiters.remove(ticket)
+				heapq.heapify(self.waiters)
+				raise
+	
+	def tryAcquire(self, priority = priorityLookup):
+		""" takes a token for a call in priority's lane if one is free now and no call is waiting for one, without waiting; returns True if it did """
+		if self.rate is None: return True
+		with self.condition:
+			self.refill()
+			if self.waiters or self.tokens < 1.0: return False
+			self.tokens -= 1.0
+			self.granted[priority] += 1
+			return True
+	
+	async def acquireAsync(self, priority = priorityLookup):
+		""" coroutine version of acquire, which waits without blocking the event loop """
+		if self.rate is None: return 0.0
+		with self.condition:
+			startTime = self.clock()
+			ticket = self.enqueue(priority)
+		try:
+			while True:
+				with self.condition:
+					delay = self.tryTake(ticket)
+					if delay is None: return self.granting(priority, startTime)
+				await asyncio.sleep(delay)
+		except BaseException:
+			with self.condition:
+				if ticket in self.waiters:
+					self.waiters.remove(ticket)
+					heapq.heapify(self.waiters)
+					self.condition.notify_all()
+			raise
+	
+	def stats(self):
+		""" returns the limit, the tokens left, the calls waiting, and the calls granted and made to wait (with the total wait) per lane """
+		with self.condition:
+			if self.rate is not None: self.refill()
+			return { 'rate': self.rate, 'burst': self.burst, 'tokens': round(self.tokens, 3), 'waiting': len(self.waiters),
+				'granted': dict(self.granted), 'waited': dict(self.waited), 'waitSeconds': { lane: round(seconds, 3) for lane, seconds in self.waitSeconds.items() } }
+
+class ResilientUpstream:
+	"""
+	Guards every network call to the Metro Transit service.  It tracks the latency of each
+	endpoint class (see endpointClass) and uses it to:
+	
+	* set the call's timeout to a multiple of the endpoint's recent 99th percentile latency
+	  (between minTimeout and maxTimeout), so a stalled call is given up on soon after it is
+	  clearly stalled, rather than after the transport's fixed timeout;
+	* send a second, hedged copy of the call if the first is slower than the endpoint's recent
+	  95th percentile, and use whichever answers first, which takes occasional upstream stalls
+	  out of the tail latency.  It never hedges sooner than minHedgeDelay, so a thread
+	  scheduling hiccup on a fast service isn't mistaken for a stall.  At most hedgeBudget of
+	  calls are hedged, so a slow service doesn't get twice the load.
+	
+	Until an endpoint has minSamples latencies, its calls use the transport's own timeout and
+	are not hedged.  Every call first waits for rateLimiter (a RateLimiter), in the lane set
+	with withPriority, or else priorityLive for departures and priorityLookup for everything
+	else; the hedge delay only starts once it has its token, and a hedged copy is only sent if
+	another token is free at once, so hedging never adds to calls the limiter is holding back.
+	It also has a CircuitBreaker: connection errors, timeouts and 5xx responses count as
+	failures (a 4xx answer means the service is up), and while the circuit is open calls
+	raise CircuitOpenError straight away.
+	"""
+	def __init__(self, hedging = True, minSamples = 20, hedgePercentile = 0.95, minHedgeDelay = 0.25, hedgeBudget = 0.1,
+			timeoutPercentile = 0.99, timeoutMultiplier = 3.0, minTimeout = 1.0, maxTimeout = 10.0, breaker = None, rateLimiter = None, clock = time.monotonic):
+		self.hedging = hedging
+		self.minSamples = minSamples
+		self.hedgePercentile = hedgePercentile
+		self.minHedgeDelay = minHedgeDelay
+		self.hedgeBudget = hedgeBudget
+		self.timeoutPercentile = timeoutPercentile
+		self.timeoutMultiplier = timeoutMultiplier
+		self.minTimeout = minTimeout
+		self.maxTimeout = maxTimeout
+		self.breaker = breaker if breaker is not None else CircuitBreaker()
+		self.rateLimiter = rateLimiter if rateLimiter is not None else RateLimiter()
+		self.clock = clock
+		self.lock = threading.Lock()
+		self.reset()
+	
+	def reset(self):
+		""" forgets all latencies and counts, closes the circuit, and fills the rate limiter's bucket """
+		with self.lock:
+			self.trackers = { }
+			self.calls = 0
+			self.hedges = 0
+			self.hedgeWins = 0
+			self.failures = 0
+		self.breaker.reset()
+		self.rateLimiter.reset()
+	
+	def tracker(self, endpoint):
+		""" returns the LatencyTracker for an endpoint class """
+		with self.lock:
+			if endpoint not in self.trackers: self.trackers[endpoint] = LatencyTracker()
+			return self.trackers[endpoint]
+	
+	def timeoutFor(self, endpoint):
+		""" returns the timeout in seconds for a call to an endpoint class, or None to use the transport's own """
+		tracker = self.tracker(endpoint)
+		if len(tracker) < self.minSamples: return None
+		return max(self.minTimeout, min(self.maxTimeout, tracker.percentile(self.timeoutPercentile) * self.timeoutMultiplier))
+	
+	def hedgeDelayFor(self, endpoint):
+		""" returns how long to wait for a call to an endpoint class before hedging it, or None if it shouldn't be hedged """
+		tracker = self.tracker(endpoint)
+		if not self.hedging or len(tracker) < self.minSamples: return None
+		with self.lock:
+			if self.hedges >= self.hedgeBudget * self.calls: return None
+		return max(self.minHedgeDelay, tracker.percentile(self.hedgePercentile))
+	
+	def begin(self, localPath, timeout):
+		""" checks the circuit breaker and returns (endpoint class, timeout, hedge delay, priority lane) for a call """
+		if not self.breaker.allow(): raise CircuitOpenError("circuit open: " + localPath)
+		endpoint = endpointClass(localPath)
+		with self.lock:
+			self.calls += 1
+		if timeout is None: timeout = self.timeoutFor(endpoint)
+		priority = upstreamPriority.get()
+		if priority is None: priority = priorityLive if endpoint == "departures" else priorityLookup
+		return endpoint, timeout, self.hedgeDelayFor(endpoint), priority
+	
+	def serverFailed(self, response):
+		""" returns True if a response shows the service itself failing (5xx), rather than answering """
+		statusCode = getattr(response, "status_code", None)
+		if statusCode is None: return not response.ok
+		return statusCode >= 500
+	
+	def finish(self, response):
+		""" records the outcome of a call with the circuit breaker: a response, or None if it raised """
+		if response is None or self.serverFailed(response):
+			with self.lock:
+				self.failures += 1
+			self.breaker.recordFailure()
+		else:
+			self.breaker.recordSuccess()
+	
+	def timedAttempt(self, endpoint, attempt, timeout):
+		startTime = self.clock()
+		response = attempt(timeout)
+		if not self.serverFailed(response): self.tracker(endpoint).record(self.clock() - startTime)
+		return response
+	
+	def call(self, localPath, attempt, timeout = None):
+		"""
+		Makes a guarded call: attempt(timeout) does one HTTP request for localPath and returns
+		the response (timeout None meaning the transport's own); it may be called twice at once
+		if the call is hedged.  Returns the first response, or raises the error of the last
+		attempt to fail, or CircuitOpenError.
+		"""
+		endpoint, timeout, hedgeDelay, priority = self.begin(localPath, timeout)
+		try:
+			self.rateLimiter.acquire(priority)		# before the hedge delay starts, so waiting for a token isn't taken for a slow service
+			if hedgeDelay is None:
+				response = self.timedAttempt(endpoint, attempt, timeout)
+			else:
+				response = self.hedgedAttempt(endpoint, attempt, timeout, hedgeDelay, priority)
+		except Exception:
+			self.finish(None)
+			raise
+		except BaseException:
+			self.breaker.abandon()
+			raise
+		self.finish(response)
+		return response
+	
+	def hedgedAttempt(self, endpoint, attempt, timeout, hedgeDelay, priority):
+		executor = getHedgeExecutor()
+		attempts = [ executor.submit(self.timedAttempt, endpoint, attempt, timeout) ]
+		done, notDone = concurrent.futures.wait(attempts, timeout = hedgeDelay)
+		if not done and self.rateLimiter.tryAcquire(priority):
+			with self.lock:
+				self.hedges += 1
+			attempts.append(executor.submit(self.timedAttempt, endpoint, attempt, timeout))
+		pending = set(attempts)
+		while True:
+			done, pending = concurrent.futures.wait(pending, return_when = concurrent.futures.FIRST_COMPLETED)
+			for thisAttempt in done:
+				if thisAttempt.exception() is None:
+					if thisAttempt is not attempts[0]:
+						with self.lock:
+							self.hedgeWins += 1
+					return thisAttempt.result()
+				if not pending: raise thisAttempt.exception()
+	
+	async def timedAttemptAsync(self, endpoint, attempt, timeout):
+		startTime = self.clock()
+		response = await attempt(timeout)
+		if not self.serverFailed(response): self.tracker(endpoint).record(self.clock() - startTime)
+		return response
+	
+	async def callAsync(self, localPath, attempt, timeout = None):
+		""" coroutine version of call; attempt(timeout) is a coroutine function, and a losing hedged attempt is cancelled """
+		endpoint, timeout, hedgeDelay, priority = self.begin(localPath, timeout)
+		response = None
+		attempts = [ ]
+		try:
+			await self.rateLimiter.acquireAsync(priority)
+			attempts.append(asyncio.ensure_future(self.timedAttemptAsync(endpoint, attempt, timeout)))
+			if hedgeDelay is not None:
+				done, notDone = await asyncio.wait(attempts, timeout = hedgeDelay)
+				if not done and self.rateLimiter.tryAcquire(priority):
+					with self.lock:
+						self.hedges += 1
+					attempts.append(asyncio.ensure_future(self.timedAttemptAsync(endpoint, attempt, timeout)))
+			pending = set(attempts)
+			while response is None:
+				done, pending = await asyncio.wait(pending, return_when = asyncio.FIRST_COMPLETED)
+				for thisAttempt in done:
+					if thisAttempt.exception() is None:
+						response = thisAttempt.result()
+						if thisAttempt is not attempts[0]:
+							with self.lock:
+								self.hedgeWins += 1
+						break
+					if not pending: raise thisAttempt.exception()
+		except Exception:
+			self.finish(None)
+			raise
+		except BaseException:
+			self.breaker.abandon()		# cancelled, which says nothing about the service
+			raise
+		finally:
+			for thisAttempt in attempts:
+				if not thisAttempt.done(): thisAttempt.cancel()
+		self.finish(response)
+		return response
+	
+	def stats(self):
+		""" returns a dictionary of counts, latencies and the circuit breaker's state, for monitoring """
+		with self.lock:
+			endpoints = list(self.trackers.items())
+			counts = { 'calls': self.calls, 'hedges': self.hedges, 'hedgeWins': self.hedgeWins, 'failures': self.failures }
+		counts['latency'] = { thisEndpoint: thisTracker.stats() for thisEndpoint, thisTracker in endpoints }
+		counts['breaker'] = self.breaker.stats()
+		counts['rateLimiter'] = self.rateLimiter.stats()
+		return counts
+
+#-- The guard on every call to the Metro Transit service
+upstream = ResilientUpstream()
+
+class ServiceError(IOError):
+	""" the service answered a call with an error status, e.g. 400 for a route number it doesn't have """
+	def __init__(self, statusCode, url):
+		super().__init__("HTTP " + str(statusCode) + " from " + url)
+		self.statusCode = statusCode
+		self.url = url
+
+#-- How long (seconds) a 4xx error response from the service is remembered, so a bad request
+#-- repeated by a misconfigured client fails at once instead of asking the service again
+errorResponseTtl = 60
+
+#-- Remembered 4xx status codes of service calls, keyed by URL
+errorResponseCache = TtlLruCache(maxEntries = 1024)
+
+#-- Local paths that got error responses, and how often each was asked for
+errorResponsePaths = TopCounter()
+
+#-- Whether service calls made in the current thread or asyncio task record their error responses;
+#-- speculative fetches turn it off, since nobody asked for them (see lookupStopCodesSpeculatively)
+recordErrorResponses = contextvars.ContextVar("recordErrorResponses", default = True)
+
+def checkErrorResponseCache(myURL, useCache):
+	""" raises the remembered ServiceError for a URL, if there is one """
+	if not useCache: return
+	statusCode = errorResponseCache.get(myURL)
+	if statusCode is not None:
+		if recordErrorResponses.get(): errorResponsePaths.add(urllib.parse.urlsplit(myURL).path)
+		raise ServiceError(statusCode, myURL)
+
+def rememberErrorResponse(serviceError, useCache):
+	""" remembers a 4xx ServiceError for errorResponseTtl; other errors (5xx, timeouts) are the service's trouble, not the request's, so they aren't remembered """
+	if not recordErrorResponses.get(): return
+	errorResponsePaths.add(urllib.parse.urlsplit(serviceError.url).path)
+	if useCache and 400 <= serviceError.statusCode < 500: errorResponseCache.put(serviceError.url, serviceError.statusCode, errorResponseTtl)
+
+def negativeCacheStats():
+	""" returns statistics of the caches of bad queries and error responses, with the most asked of each, as a dictionary """
+	return { 'resolutions': negativeResolutionCache.stats(), 'errorResponses': errorResponseCache.stats(),
+		'badQueries': negativeQueries.total, 'topBadQueries': negativeQueries.top(),
+		'errorResponseCount': errorResponsePaths.total, 'topErrorPaths': errorResponsePaths.top() }
+
+def getCachedServiceResult(myURL, ttl):
+	""" returns the cached result for a service URL from the catalogue snapshot, memory or disk, or cacheMiss; ttl is the URL's time to live (zero means it isn't cached) """
+	if ttl <= 0: return cacheMiss
+	snapshot = catalogueSnapshot
+	if snapshot is None and pendingSnapshotPath is not None: snapshot = retryPendingCatalogueSnapshot()
+	if snapshot is not None and myURL.startswith(snapshot.serviceUrl):
+		cachedResult = snapshot.get(myURL[len(snapshot.serviceUrl):], cacheMiss)
+		if cachedResult is not cacheMiss:
+			metrics.count("cacheLookups", "snapshot")
+			return cachedResult
+	cachedResult = serviceCache.get(myURL, cacheMiss)
+	if cachedResult is not cacheMiss:
+		metrics.count("cacheLookups", "memory")
+		return cachedResult
+	if diskCache is not None:
+		diskEntry = diskCache.getEntry(myURL)
+		if diskEntry is not None:
+			serviceCache.put(myURL, diskEntry[1], diskEntry[0] - time.time())
+			metrics.count("cacheLookups", "disk")
+			return diskEntry[1]
+	metrics.count("cacheLookups", "miss")
+	return cacheMiss
+
+def putCachedServiceResult(myURL, result, ttl):
+	""" stores a service result in memory, and on disk if enabled, for ttl seconds """
+	if ttl <= 0: return
+	serviceCache.put(myURL, result, ttl)
+	if diskCache is not None: diskCache.put(myURL, result, ttl)
+
 #-- Get a Metro Transit service result as a Python object, given a local path within the service
-#-- starting with the slash after the domain name.  Throws an IOError on any error.
-def getMetroTransitService(localPath):
+#-- starting with the slash after the domain name.  Throws an IOError on any error, including
+#-- a timeout; timeout is in seconds and defaults to the transport's own timeout.  Results for
+#-- routes, directions and stops are cached (see endpointTtls) in memory and, if enabled, on
+#-- disk, unless useCache is False.  Each call is timed as the stage "service <endpoint class>"
+#-- (see Metrics).
+def getMetroTransitService(localPath, timeout = None, useCache = True):
+	started = metrics.start()
 	myURL = metroTransitServiceUrl + localPath
+	ttl = endpointTtls.get(endpointClass(localPath), 0) if useCache else 0
 	try:
-		result = requests.get(myURL, params = {'format': 'json'})
+		result = getCachedServiceResult(myURL, ttl)
+		if result is cacheMiss:
+			def fetchAndCache():
+				fetchedResult = fetchMetroTransitService(myURL, timeout)
+				putCachedServiceResult(myURL, fetchedResult, ttl)
+				return fetchedResult
+			checkErrorResponseCache(myURL, useCache)
+			try:
+				result = serviceFlights.do(myURL, fetchAndCache)		# concurrent callers for the same URL share one fetch
+			except ServiceError as serviceError:
+				rememberErrorResponse(serviceError, useCache)
+				raise
+		return result
+	finally:
+		if started is not None: metrics.finish("service " + endpointClass(localPath), started)		# no stage name to build while metrics are off
+
+#-- Fetch a Metro Transit service result from the network, given its whole URL, through the
+#-- upstream guard (adaptive timeout, hedging, circuit breaker).  Throws an IOError on any error.
+def fetchMetroTransitService(myURL, timeout = None):
+	try:
+		def attempt(attemptTimeout):
+			return transport.get(myURL, params = {'format': 'json'}, timeout = attemptTimeout)
+		localPath = urllib.parse.urlsplit(myURL).path
+		started = metrics.start()
+		result = upstream.call(localPath, attempt, timeout)
+		countServiceResponse(localPath, result, started)
 		if (result.ok):
-			return result.json()		# on JSON error an exception will be thrown and caught
+			started = metrics.start()
+			decoded = serviceResult(result.json(object_hook = compactServiceObject if compactRecords else None))		# on JSON error an exception will be thrown and caught
+			metrics.finish("decode", started)
+			return decoded
 		else:
-			raise IOError		# non-OK HTTP status is thrown as "IOError"
+			raise ServiceError(getattr(result, "status_code", 500), myURL)		# non-OK HTTP status is thrown as a kind of "IOError"
+	except ServiceError:
+		metrics.count("serviceErrors", "ServiceError")
+		raise
 	except:
+		metrics.count("serviceErrors", sys.exc_info()[0].__name__)
+		raise IOError
+
+def countServiceResponse(localPath, result, started):
+	""" records a response from the service in metrics: the time since started as the stage "http", and its endpoint, status and size """
+	if started is None: return
+	metrics.finish("http", started)
+	endpoint = endpointClass(localPath)
+	metrics.count("httpRequests", endpoint)
+	metrics.count("httpStatus", getattr(result, "status_code", 500))
+	metrics.count("httpBytes", endpoint, len(getattr(result, "content", b"") or b""))
+
+#-- Coroutine version of getMetroTransitService, using the asyncio transport and the same caches.
+async def getMetroTransitServiceAsync(localPath, timeout = None, useCache = True):
+	started = metrics.start()
+	myURL = metroTransitServiceUrl + localPath
+	ttl = endpointTtls.get(endpointClass(localPath), 0) if useCache else 0
+	try:
+		result = getCachedServiceResult(myURL, ttl)
+		if result is cacheMiss:
+			async def fetchAndCache():
+				fetchedResult = await fetchMetroTransitServiceAsync(myURL, timeout)
+				putCachedServiceResult(myURL, fetchedResult, ttl)
+				return fetchedResult
+			checkErrorResponseCache(myURL, useCache)
+			try:
+				result = await serviceFlights.doAsync(myURL, fetchAndCache)
+			except ServiceError as serviceError:
+				rememberErrorResponse(serviceError, useCache)
+				raise
+		return result
+	finally:
+		if started is not None: metrics.finish("service " + endpointClass(localPath), started)		# no stage name to build while metrics are off
+
+#-- Coroutine version of fetchMetroTransitService.  Throws an IOError on any error, but lets
+#-- cancellation through.
+async def fetchMetroTransitServiceAsync(myURL, timeout = None):
+	try:
+		async def attempt(attemptTimeout):
+			return await asyncTransport.get(myURL, params = {'format': 'json'}, timeout = attemptTimeout)
+		localPath = urllib.parse.urlsplit(myURL).path
+		started = metrics.start()
+		result = await upstream.callAsync(localPath, attempt, timeout)
+		countServiceResponse(localPath, result, started)
+		if (result.ok):
+			started = metrics.start()
+			decoded = serviceResult(result.json(object_hook = compactServiceObject if compactRecords else None))
+			metrics.finish("decode", started)
+			return decoded
+		else:
+			raise ServiceError(result.status_code, myURL)
+	except ServiceError:
+		metrics.count("serviceErrors", "ServiceError")
+		raise
+	except Exception as error:
+		metrics.count("serviceErrors", type(error).__name__)
 		raise IOError
 
 def suppressMultipleSpaces(x):
@@ -127,19 +1908,208 @@ def extractMatches(allItems, matchField, substring):
 		The records that matched the substring.
 	"""
 	if (substring.upper()=="#ANY"): return allItems  # special code #ANY returns whole  list
-	startMatch = False
-	if (substring[0:1] == "#"):
-		startMatch = True
-		substring = substring[1:]
-	matchingItems = [ ]
-	for thisItem in allItems:
-		if startMatch:
-			if suppressMultipleSpaces(thisItem[matchField].upper()).find(suppressMultipleSpaces(substring.upper()+" ")) == 0:
-				matchingItems.append(thisItem)
-		else:
-			if suppressMultipleSpaces(thisItem[matchField].upper()).find(suppressMultipleSpaces(substring.upper())) != -1:
-				matchingItems.append(thisItem)
-	return matchingItems
+	started = metrics.start()
+	matches = getMatchIndex(allItems, matchField).find(substring)
+	metrics.finish("match", started)
+	return matches
+
+class MatchIndex:
+	"""
+	Index of one field of a list of records, built once, that answers the same searches as
+	extractMatches without rescanning and renormalizing the whole list each time.  It holds
+	each record's field uppercased with multiple spaces suppressed, a map from the first word
+	of each field (e.g. a route number) to its records for "#" searches, and a map from every
+	three-character substring to the records containing it for ordinary searches.
+	
+	Parameters
+	------------
+	allItems : list
+		The records to index.  The list must not be changed after it is indexed.
+	matchField : str
+		The field within each record to index.
+	matchKeys : list
+		(Optional) The field of each record already uppercased with multiple spaces suppressed,
+		e.g. from a catalogue snapshot.
+	"""
+	def __init__(self, allItems, matchField, matchKeys = None):
+		self.allItems = allItems
+		if matchKeys is None: matchKeys = [ suppressMultipleSpaces(thisItem[matchField].upper()) for thisItem in allItems ]
+		self.keys = matchKeys
+		self.firstWords = { }		# first word -> positions of the keys that start with that word and a space
+		self.trigrams = { }			# three characters -> set of positions of the keys containing them
+		for position, key in enumerate(self.keys):
+			firstWord, space, rest = key.partition(" ")
+			if space: self.firstWords.setdefault(firstWord, [ ]).append(position)
+			for start in range(len(key) - 2):
+				self.trigrams.setdefault(key[start:start + 3], set()).add(position)
+	
+	def find(self, substring):
+		""" returns the records that extractMatches would return for substring, in list order """
+		if (substring.upper()=="#ANY"): return self.allItems
+		if (substring[0:1] == "#"):
+			prefix = suppressMultipleSpaces(substring[1:].upper()+" ")
+			if len(prefix) > 1 and prefix.find(" ") == len(prefix) - 1:
+				return [ self.allItems[position] for position in self.firstWords.get(prefix[:-1], [ ]) ]
+			return [ self.allItems[position] for position, key in enumerate(self.keys) if key.find(prefix) == 0 ]
+		needle = suppressMultipleSpaces(substring.upper())
+		if len(needle) < 3:
+			return [ self.allItems[position] for position, key in enumerate(self.keys) if key.find(needle) != -1 ]
+		postings = [ ]
+		for start in range(len(needle) - 2):
+			thisPosting = self.trigrams.get(needle[start:start + 3])
+			if thisPosting is None: return [ ]
+			postings.append(thisPosting)
+		postings.sort(key = len)
+		candidates = set(postings[0]).intersection(*postings[1:])
+		return [ self.allItems[position] for position in sorted(candidates) if self.keys[position].find(needle) != -1 ]
+
+def getMatchIndex(allItems, matchField):
+	""" returns the MatchIndex for a list and field; a ServiceList keeps it, so that it is built only the first time the list is searched """
+	if not isinstance(allItems, ServiceList): return MatchIndex(allItems, matchField)
+	thisIndex = allItems.matchIndexes.get(matchField)
+	if thisIndex is not None and len(thisIndex.keys) == len(allItems): return thisIndex
+	thisIndex = MatchIndex(allItems, matchField)
+	allItems.matchIndexes[matchField] = thisIndex
+	return thisIndex
+
+#-- Words that don't help tell stops apart, left out of StopIndex searches
+stopIndexIgnoredWords = frozenset([ "AND", "AT", "&", "THE", "OF" ])
+
+def stopNameWords(name):
+	""" returns the words of a stop name or search, normalized as extractMatches does (uppercase, multiple spaces suppressed) and split at anything that isn't a letter or digit """
+	key = suppressMultipleSpaces(name.upper())
+	return [ thisWord for thisWord in "".join(thisCharacter if thisCharacter.isalnum() else " " for thisCharacter in key).split() if thisWord not in stopIndexIgnoredWords ]
+
+class StopEntry:
+	""" one stop in a StopIndex: its code, its name, its normalized name, and the (route number, direction number, direction text) of each route and direction that serves it """
+	__slots__ = ("code", "name", "key", "servedBy")
+	
+	def __init__(self, code, name):
+		self.code = code
+		self.name = name
+		self.key = suppressMultipleSpaces(name.upper())
+		self.servedBy = [ ]
+	
+	def toDict(self):
+		return { 'code': self.code, 'name': self.name, 'servedBy': [ list(thisService) for thisService in self.servedBy ] }
+
+class StopIndex:
+	"""
+	In-memory index of every stop in the network, built once from the whole catalogue (see
+	crawlCatalogue), so that a stop can be found, and the routes and directions that serve it
+	listed, without knowing its route first and without any service calls.  Stops are keyed by
+	stop code and by the words of their names, normalized as extractMatches does.
+	
+	search ranks stops by how many of the searched words their names contain, each word
+	weighted by how rare it is across the network (so "Franklin" counts for more than "Ave"),
+	with a word matching the start of a name word (e.g. "Univ") counting a little less than a
+	whole word, and a misspelt word that matches nothing being replaced by the closest name
+	words.  A search for an exact stop code puts that stop first.
+	
+	Parameters
+	------------
+	catalogue : dict
+		Result lists in Metro Transit format keyed by local path, as from crawlCatalogue; only
+		the Directions and Stops results are used.
+	"""
+	def __init__(self, catalogue):
+		directionTexts = { }		# (route number, direction number) -> direction text
+		for localPath, items in catalogue.items():
+			parts = localPath.strip("/").split("/")
+			if endpointClass(localPath) == "directions":
+				for thisDirection in items: directionTexts[(parts[2], thisDirection["Value"])] = thisDirection["Text"]
+		self.stops = { }		# stop code -> StopEntry
+		for localPath in sorted(catalogue, key = lambda thisPath: [ int(thisPart) if thisPart.isdigit() else 0 for thisPart in thisPath.split("/") ]):
+			if endpointClass(localPath) != "stops": continue
+			routeNumber, directionNumber = localPath.strip("/").split("/")[2:4]
+			for thisStop in catalogue[localPath]:
+				entry = self.stops.get(thisStop["Value"])
+				if entry is None: entry = self.stops[thisStop["Value"]] = StopEntry(thisStop["Value"], thisStop["Text"])
+				service = (routeNumber, directionNumber, directionTexts.get((routeNumber, directionNumber), ""))
+				if service not in entry.servedBy: entry.servedBy.append(service)
+		self.postings = { }		# name word -> stop codes whose names contain it
+		for thisEntry in self.stops.values():
+			for thisWord in set(stopNameWords(thisEntry.name)): self.postings.setdefault(thisWord, [ ]).append(thisEntry.code)
+		self.words = sorted(self.postings)		# for finding the words that start with a prefix by binary search
+		self.weights = { thisWord: math.log(1.0 + len(self.stops) / len(codes)) for thisWord, codes in self.postings.items() }
+	
+	def __len__(self):
+		return len(self.stops)
+	
+	def stop(self, stopCode):
+		""" returns the StopEntry for a stop code, or None """
+		return self.stops.get(stopCode.upper())
+	
+	def routesServing(self, stopCode):
+		""" returns the (route number, direction number, direction text) of each route and direction serving a stop, or [ ] for an unknown stop """
+		entry = self.stop(stopCode)
+		return list(entry.servedBy) if entry is not None else [ ]
+	
+	def matchingWords(self, searchWord):
+		""" returns (name word, how well it matches) for the name words that a searched word matches: 1 for the same word, 0.8 for a word it starts, 0.6 for a close spelling """
+		first = bisect.bisect_left(self.words, searchWord)
+		matches = [ ]
+		for position in range(first, len(self.words)):
+			if not self.words[position].startswith(searchWord) or len(matches) >= 64: break
+			matches.append((self.words[position], 1.0 if self.words[position] == searchWord else 0.8))
+		if not matches and len(searchWord) >= 4:
+			matches = [ (thisWord, 0.6) for thisWord in difflib.get_close_matches(searchWord, self.words, n = 3, cutoff = 0.75) ]
+		return matches
+	
+	def search(self, text, limit = 10):
+		""" returns up to limit StopEntry objects for the stops best matching text (a stop code, or some words of a stop's name), best first """
+		scores = collections.Counter()
+		exact = self.stops.get(text.strip().upper())
+		if exact is not None: scores[exact.code] += 1000.0
+		for thisWord in set(stopNameWords(text)):
+			best = { }		# stop code -> this searched word's best score for it
+			for nameWord, quality in self.matchingWords(thisWord):
+				score = quality * self.weights[nameWord]
+				for thisCode in self.postings[nameWord]:
+					if score > best.get(thisCode, 0.0): best[thisCode] = score
+			scores.update(best)
+		needle = suppressMultipleSpaces(text.upper())
+		for thisCode in scores:
+			if self.stops[thisCode].key.find(needle) != -1: scores[thisCode] += 1.0		# the words in the same order
+		ranked = sorted(scores, key = lambda thisCode: (-scores[thisCode], len(self.stops[thisCode].name), thisCode))
+		return [ self.stops[thisCode] for thisCode in ranked[0:limit] ]
+	
+	def stats(self):
+		return { 'stops': len(self.stops), 'words': len(self.words), 'services': sum(len(thisEntry.servedBy) for thisEntry in self.stops.values()) }
+
+#-- The StopIndex of the whole network, built on first use by getStopIndex
+stopIndex = None
+stopIndexLock = threading.Lock()
+
+def getStopIndex(rebuild = False, snapshotPath = None):
+	"""
+	Returns the StopIndex of the whole network, building it the first time (or again if
+	rebuild is True, or the catalogue snapshot in use has been rebuilt since).  It is built
+	from the catalogue snapshot if one is in use, with no service calls; otherwise the
+	catalogue is crawled once through the service caches (see crawlCatalogue), which raises
+	IOError if it fails.  If snapshotPath is given, a crawl is also written to that snapshot
+	file and used from then on, as with --build-catalogue, so later runs don't crawl again.
+	"""
+	global stopIndex
+	with stopIndexLock:
+		snapshot = catalogueSnapshot
+		if snapshot is not None: snapshot.refreshIfChanged()
+		source = None if snapshot is None else (snapshot.path, snapshot.built)
+		if stopIndex is None or rebuild or stopIndex.source != source:
+			if snapshot is not None:
+				catalogue = { localPath: snapshot.get(localPath) for localPath in list(snapshot.entries) if endpointClass(localPath) in ("directions", "stops") }
+			else:
+				catalogue = crawlCatalogue(useCache = True)
+				if snapshotPath is not None:
+					try:
+						writeCatalogueSnapshot(snapshotPath, catalogue)
+						snapshot = useCatalogueSnapshot(snapshotPath)
+						source = (snapshot.path, snapshot.built)
+					except (OSError, ValueError):
+						pass		# the snapshot is only an optimization, so index the crawl anyway
+			stopIndex = StopIndex(catalogue)
+			stopIndex.source = source
+		return stopIndex
 
 def getRouteMatches(busRouteSubstring):
 	""" given a substring, return matching routes as a list in Metro Transit format """
@@ -157,6 +2127,74 @@ def getTimepointDepartures(busRouteNumber, busDirectionNumber, busStopCode):
 	""" given a bus route number, bus direction number, and bus stop code, return timepoint departures as a list in Metro Transit format """
 	return getMetroTransitService("/NexTrip/" + busRouteNumber + "/" + busDirectionNumber + "/" + busStopCode)
 
+#-- Stale-while-revalidate settings for departures: whether nextBusResult serves the last-known
+#-- departures instead of waiting on the service, how long a list is served as fresh without
+#-- asking for a new one (seconds), and the oldest list it will serve at all (seconds)
+staleWhileRevalidate = True
+departureFreshness = 15.0
+maxDepartureStaleness = 120.0
+
+#-- Last-known departures for each stop, as (time fetched, departures), keyed by URL; entries expire after maxDepartureStaleness
+departureCache = TtlLruCache(maxEntries = 1024)
+
+#-- Departure refreshes still running after their caller was answered from departureCache, keyed by URL;
+#-- departureRefreshTasks holds the asyncio tasks doing the same for the coroutine versions
+departureRefreshes = { }
+departureRefreshesLock = threading.Lock()
+departureRefreshTasks = { }
+
+def departuresUrl(busRouteNumber, busDirectionNumber, busStopCode):
+	return metroTransitServiceUrl + "/NexTrip/" + busRouteNumber + "/" + busDirectionNumber + "/" + busStopCode
+
+def fetchAndKeepDepartures(busRouteNumber, busDirectionNumber, busStopCode):
+	""" fetches departures like getTimepointDepartures, keeping them in departureCache as the last-known list for the stop """
+	departures = getTimepointDepartures(busRouteNumber, busDirectionNumber, busStopCode)
+	departureCache.put(departuresUrl(busRouteNumber, busDirectionNumber, busStopCode), (time.time(), departures), maxDepartureStaleness)
+	return departures
+
+def refreshDepartures(busRouteNumber, busDirectionNumber, busStopCode):
+	""" returns a future for a fetch of a stop's departures, starting one in the background unless one is already running """
+	myURL = departuresUrl(busRouteNumber, busDirectionNumber, busStopCode)
+	with departureRefreshesLock:
+		refresh = departureRefreshes.get(myURL)
+		if refresh is not None: return refresh
+		refresh = getPrefetchExecutor().submit(fetchAndKeepDepartures, busRouteNumber, busDirectionNumber, busStopCode)
+		departureRefreshes[myURL] = refresh
+	def forget(finished):
+		with departureRefreshesLock:
+			if departureRefreshes.get(myURL) is finished: del departureRefreshes[myURL]
+	refresh.add_done_callback(forget)		# outside the lock, since it runs at once if the fetch has already finished
+	return refresh
+
+def getDeparturesStaleWhileRevalidate(busRouteNumber, busDirectionNumber, busStopCode):
+	"""
+	Gets a stop's departures like getTimepointDepartures, but doesn't make the caller wait on
+	the service when a recent list is at hand.  Departure records have absolute DepartureTime
+	stamps, so a list fetched a little while ago still gives the right minutes when they are
+	worked out against the current time (which also drops the buses that have left since).
+	The last list fetched for the stop is returned as it is while it is younger than
+	departureFreshness seconds.  After that it is still returned straight away, marked stale,
+	while a fetch runs in the background to replace it, as long as it is no older than
+	maxDepartureStaleness seconds; a list older than that, or no list at all, means fetching
+	and waiting.  With staleWhileRevalidate False, this just fetches.
+	
+	Returns
+	--------
+	tuple
+		(departures, stale, age): the departure list, whether it is past departureFreshness,
+		and its age in seconds (0 if just fetched).  Raises IOError like getTimepointDepartures
+		when it has to fetch and the fetch fails.
+	"""
+	entry = departureCache.get(departuresUrl(busRouteNumber, busDirectionNumber, busStopCode)) if staleWhileRevalidate else None
+	if entry is not None:
+		fetchedAt, departures = entry
+		age = max(0.0, time.time() - fetchedAt)
+		if age < departureFreshness: return departures, False, age
+		if age <= maxDepartureStaleness:
+			refreshDepartures(busRouteNumber, busDirectionNumber, busStopCode)		# a failed refresh just leaves the last-known list in place
+			return departures, True, age
+	return fetchAndKeepDepartures(busRouteNumber, busDirectionNumber, busStopCode), False, 0.0
+
 def minutesTillBus(busTimepoint, nowTime = None):
 	""" given a bus timepoint record from getTimepointDepartures, return the number of minutes until that bus, as a float.  nowTime is the current time since unix epoch, but leave it out to just use the system time. """
 	t = busTimepoint["DepartureTime"]
@@ -164,20 +2202,90 @@ def minutesTillBus(busTimepoint, nowTime = None):
 	secondsFromNow = float(t[6:-2].split('-')[0])/1000.0 - nowTime
 	return secondsFromNow / 60.0
 
-def formatTimepoint(busTimepoint, nowTime = None):
-	""" given a single bus timepoint record from getTimepointDepartures, return the formatted output string; supply the current time if you want using nowTime, or leave it out to use the system time (nowTime is seconds since Unix epoch). """
-	minutesFromNow = round(minutesTillBus(busTimepoint, nowTime))
+def parseDepartureTime(departureTime):
+	""" given a Metro Transit DepartureTime like /Date(1533081600000-0500)/, return (milliseconds since Unix epoch, timezone offset in minutes, e.g. -300) """
+	inside = departureTime[6:-2]
+	signPosition = max(inside.rfind("-"), inside.rfind("+"))
+	if signPosition <= 0: return int(inside), 0
+	offset = inside[signPosition + 1:]
+	offsetMinutes = int(offset[0:2]) * 60 + int(offset[2:4] or "0")
+	return int(inside[0:signPosition]), (-offsetMinutes if inside[signPosition] == "-" else offsetMinutes)
+
+def formatMinutes(minutesFromNow):
+	""" given a number of minutes until a bus, return it formatted for output, e.g. "1 Minute" or "5 Minutes" """
+	minutesFromNow = round(minutesFromNow)
 	if (minutesFromNow==1):
 		return "1 Minute"
 	else:
 		return "{:.0f} Minutes".format(minutesFromNow)
 
-def getNextBusRecord(busTimepointList):
-	""" given a list of bus timepoints from getTimepointDepartures, returns a list with one record (the next bus that hasn't arrived yet) or zero records (no bus is coming) """
-	for thisTimepoint in busTimepointList:
-		if minutesTillBus(thisTimepoint) > 0:
-			return [ thisTimepoint ]
-	return [ ]
+def formatTimepoint(busTimepoint, nowTime = None):
+	""" given a single bus timepoint record from getTimepointDepartures, return the formatted output string; supply the current time if you want using nowTime, or leave it out to use the system time (nowTime is seconds since Unix epoch). """
+	return decodeDepartures([ busTimepoint ]).formatDeparture(0, nowTime)		# parsed the same way as formatNextBus's departures
+
+class DepartureTimes:
+	"""
+	The departure times of a list of departures from getTimepointDepartures, parsed once into
+	an array of milliseconds since the Unix epoch (in list order) plus the timezone offset
+	Metro Transit gave them.  Finding the next bus, or the next few, is then a binary search
+	against one "now", instead of reparsing every record's DepartureTime each time.
+	
+	Parameters
+	------------
+	departures : list
+		The departures, which are normally in time order.  If they are not, searches fall back
+		to checking them in list order, which gives the same answers as getNextBusRecord always has.
+	"""
+	def __init__(self, departures):
+		self.departures = departures
+		self.times = array.array("q")
+		self.offsetMinutes = 0
+		for thisDeparture in departures:
+			epochMilliseconds, self.offsetMinutes = parseDepartureTime(thisDeparture["DepartureTime"])
+			self.times.append(epochMilliseconds)
+		self.inOrder = all(self.times[i] <= self.times[i + 1] for i in range(len(self.times) - 1))
+	
+	def __len__(self):
+		return len(self.times)
+	
+	def nextIndex(self, nowTime = None):
+		""" returns the position of the first departure still to come at nowTime (seconds since Unix epoch, default now), or None if there is none """
+		upcoming = self.upcomingIndexes(nowTime, 1)
+		return upcoming[0] if upcoming else None
+	
+	def upcomingIndexes(self, nowTime = None, count = None):
+		""" returns the positions of the departures still to come at nowTime (default now), in list order, at most count of them if count is given """
+		if nowTime is None: nowTime = time.time()
+		if self.inOrder:
+			first = bisect.bisect_right(self.times, nowTime * 1000.0)
+			last = len(self.times) if count is None else min(len(self.times), first + count)
+			return list(range(first, last))
+		upcoming = [ i for i in range(len(self.times)) if self.times[i] / 1000.0 - nowTime > 0 ]
+		return upcoming if count is None else upcoming[0:count]
+	
+	def minutesTill(self, index, nowTime = None):
+		""" returns the minutes from nowTime (default now) until the departure at a position, as a float, like minutesTillBus """
+		if nowTime is None: nowTime = time.time()
+		return (self.times[index] / 1000.0 - nowTime) / 60.0
+	
+	def formatDeparture(self, index, nowTime = None):
+		""" returns the departure at a position formatted like formatTimepoint, without reparsing it """
+		return formatMinutes(self.minutesTill(index, nowTime))
+
+def decodeDepartures(departures):
+	""" returns the DepartureTimes for a list of departures; a ServiceList keeps them, so that it is parsed only the first time it is seen """
+	if not isinstance(departures, ServiceList): return DepartureTimes(departures)
+	decoded = departures.departureTimes
+	if decoded is not None and len(decoded) == len(departures): return decoded
+	decoded = DepartureTimes(departures)
+	departures.departureTimes = decoded
+	return decoded
+
+def getNextBusRecord(busTimepointList, nowTime = None):
+	""" given a list of bus timepoints from getTimepointDepartures, returns a list with one record (the next bus that hasn't arrived yet) or zero records (no bus is coming); nowTime is as for minutesTillBus """
+	nextIndex = decodeDepartures(busTimepointList).nextIndex(nowTime)
+	if nextIndex is None: return [ ]
+	return [ busTimepointList[nextIndex] ]
 
 def commaList(inputList, fieldToUse):
 	""" Given an input list and a fieldname of which field to use, return a string that contains all those field items, separated by a comma and a space. """
@@ -187,6 +2295,215 @@ def commaList(inputList, fieldToUse):
 		outstr += thisItem[fieldToUse]
 	return outstr
 
+#-- Kinds of error a lookup can have (see NextBusResult.errorKind), which are also the start of nextBus's error messages
+errorNoMatch = "NO MATCH"
+errorMultipleMatches = "MULTIPLE MATCHES"
+errorNetwork = "NETWORK ERROR"
+errorUnknown = "UNKNOWN ERROR"
+
+class NextBusError(Exception):
+	"""
+	A lookup that can't be answered, e.g. no unique match.  str() of it is the exact message
+	nextBus returns, e.g. NO MATCH ON STOP.  errorKind is errorNoMatch or errorMultipleMatches,
+	itemKind is what didn't match uniquely (ROUTE, DIRECTION or STOP), and matches is the list
+	of matching records when there was more than one.
+	"""
+	def __init__(self, message, errorKind = None, itemKind = None, matches = None):
+		super().__init__(message)
+		self.errorKind = errorKind
+		self.itemKind = itemKind
+		self.matches = matches if matches is not None else [ ]
+	
+	def copy(self):
+		""" returns a new NextBusError with the same details, to raise again without reusing this one's traceback """
+		return NextBusError(str(self), self.errorKind, self.itemKind, self.matches)
+
+def uniqueMatch(matchingItems, matchField, itemKind):
+	"""
+	Returns the single item in a list of matches, or raises a NextBusError if there are none
+	("NO MATCH ON <itemKind>") or more than one ("MULTIPLE MATCHES ON <itemKind>: <list of
+	the matchField of each item>").
+	"""
+	if (len(matchingItems) == 0): raise NextBusError("NO MATCH ON " + itemKind, errorNoMatch, itemKind)
+	if (len(matchingItems) > 1): raise NextBusError("MULTIPLE MATCHES ON " + itemKind + ": " + commaList(matchingItems, matchField), errorMultipleMatches, itemKind, matchingItems)
+	return matchingItems[0]
+
+#-- How long, in seconds, the outcome of resolving a (route, stop, direction) query is remembered
+resolutionTtl = 3600
+
+#-- Remembered outcomes of resolveStop, keyed by service URL and normalized query: either the
+#-- (route number, direction number, stop code) tuple or the NextBusError that was raised
+resolutionCache = TtlLruCache(maxEntries = 4096)
+
+def resolutionKey(busRouteSubstring, busStopSubstring, directionSubstring):
+	""" returns the resolutionCache key for a query; queries that differ only in case or repeated spaces match the same things, so they share a key """
+	return (metroTransitServiceUrl, suppressMultipleSpaces(busRouteSubstring.upper()), suppressMultipleSpaces(busStopSubstring.upper()), suppressMultipleSpaces(directionSubstring.upper()))
+
+#-- How long (seconds) the NextBusError of a query with no unique match is remembered.  It is
+#-- shorter than resolutionTtl, so a stop that is added or renamed is found again soon.
+negativeResolutionTtl = 300
+
+#-- Remembered NextBusErrors of queries, kept apart from resolutionCache so that a flood of bad
+#-- queries can't push good resolutions out
+negativeResolutionCache = TtlLruCache(maxEntries = 1024)
+
+#-- Queries that had no unique match, and how often each was asked, to find where junk traffic comes from
+negativeQueries = TopCounter()
+
+def rememberResolution(cacheKey, outcome):
+	""" remembers the outcome of resolving a query: its codes in resolutionCache, or its NextBusError in negativeResolutionCache """
+	if isinstance(outcome, NextBusError):
+		negativeQueries.add(" / ".join(cacheKey[1:]))
+		negativeResolutionCache.put(cacheKey, outcome, negativeResolutionTtl)
+	else:
+		resolutionCache.put(cacheKey, outcome, resolutionTtl)
+
+def getCachedResolution(cacheKey):
+	""" returns the remembered codes for a query, raises its remembered NextBusError, or returns None if it isn't remembered """
+	outcome = resolutionCache.get(cacheKey)
+	if outcome is not None: return outcome
+	outcome = negativeResolutionCache.get(cacheKey)
+	if outcome is not None:
+		negativeQueries.add(" / ".join(cacheKey[1:]))
+		raise outcome.copy()
+	return None
+
+def resolveStop(busRouteSubstring, busStopSubstring, directionSubstring, useCache = True, speculative = None):
+	"""
+	Finds the Metro Transit codes for a bus route substring, a bus stop substring, and a
+	direction substring, as used by nextBus.  The outcome, including a failure to find a
+	unique match, is remembered for resolutionTtl seconds unless useCache is False, so a
+	repeated query needs no service calls at all.
+	
+	If speculative is True (or it is None and speculativeResolution is True), the route's
+	directions and stops are fetched at the same time instead of one after another; see
+	lookupStopCodesSpeculatively.  The results and errors are the same either way.
+	
+	Returns
+	--------
+	tuple
+		(route number, direction number, stop code), for use with getTimepointDepartures.
+		Raises a NextBusError with the message for nextBus if a route, direction or stop does
+		not have exactly one match, or an IOError if the service can't be reached.
+	"""
+	cacheKey = resolutionKey(busRouteSubstring, busStopSubstring, directionSubstring)
+	if useCache:
+		stopCodes = getCachedResolution(cacheKey)
+		if stopCodes is not None: return stopCodes
+	if speculative is None: speculative = speculativeResolution
+	try:
+		if speculative:
+			stopCodes = lookupStopCodesSpeculatively(busRouteSubstring, busStopSubstring, directionSubstring)
+		else:
+			stopCodes = lookupStopCodes(busRouteSubstring, busStopSubstring, directionSubstring)
+	except NextBusError as lookupError:
+		if useCache: rememberResolution(cacheKey, lookupError)
+		raise
+	if useCache: rememberResolution(cacheKey, stopCodes)
+	return stopCodes
+
+def lookupStopCodes(busRouteSubstring, busStopSubstring, directionSubstring):
+	""" does the lookups for resolveStop one after another: routes, then the route's directions, then the direction's stops """
+	# routes
+	thisBusNumber = uniqueMatch(getRouteMatches(busRouteSubstring), "Description", "ROUTE")["Route"]
+	# directions
+	thisDirectionNumber = uniqueMatch(getDirectionMatches(thisBusNumber, directionSubstring), "Text", "DIRECTION")["Value"]
+	# stops
+	thisStopCode = uniqueMatch(getStopMatches(thisBusNumber, thisDirectionNumber, busStopSubstring), "Text", "STOP")["Value"]
+	return (thisBusNumber, thisDirectionNumber, thisStopCode)
+
+#-- When True, resolveStop uses lookupStopCodesSpeculatively unless told otherwise
+speculativeResolution = False
+
+#-- The direction numbers Metro Transit uses, and the text it gives each one
+directionTexts = { '1': 'SOUTHBOUND', '2': 'EASTBOUND', '3': 'WESTBOUND', '4': 'NORTHBOUND' }
+directionTextList = [ { 'Text': directionText, 'Value': directionNumber } for directionNumber, directionText in directionTexts.items() ]
+
+#-- Thread pool for speculative fetches, created on first use
+prefetchExecutor = None
+prefetchExecutorLock = threading.Lock()
+
+def getPrefetchExecutor():
+	""" returns the thread pool used for speculative fetches, creating it on first use """
+	global prefetchExecutor
+	with prefetchExecutorLock:
+		if prefetchExecutor is None:
+			prefetchExecutor = concurrent.futures.ThreadPoolExecutor(max_workers = 8, thread_name_prefix = "nextbus-prefetch")
+		return prefetchExecutor
+
+def guessRouteNumber(busRouteSubstring):
+	""" returns the route number that a "#" route substring asks for (e.g. "21" for "#21"), or None if it isn't one """
+	if busRouteSubstring[0:1] != "#" or busRouteSubstring.upper() == "#ANY": return None
+	prefix = suppressMultipleSpaces(busRouteSubstring[1:].upper() + " ")
+	if len(prefix) > 1 and prefix.find(" ") == len(prefix) - 1: return prefix[:-1]
+	return None
+
+def guessDirectionNumbers(directionSubstring):
+	""" returns the direction numbers whose usual text (e.g. NORTHBOUND) matches a direction substring """
+	return [ thisDirection["Value"] for thisDirection in extractMatches(directionTextList, "Text", directionSubstring) ]
+
+def lookupStopCodesSpeculatively(busRouteSubstring, busStopSubstring, directionSubstring):
+	"""
+	Does the lookups for resolveStop with less waiting than lookupStopCodes.  As soon as the
+	route number is known, the route's directions and the stop lists for every direction the
+	direction substring could mean are fetched at the same time; stop lists that turn out not
+	to be needed are cancelled or ignored.  For a "#" route number, that starts even before
+	the route list arrives, so the whole lookup takes about one round trip instead of three.
+	Raises the same errors as lookupStopCodes, in the same order.  The fetches run in the
+	caller's priority lane, and only the error responses of those whose results are used are
+	recorded (see rememberErrorResponse).
+	"""
+	executor = getPrefetchExecutor()
+	directionGuesses = guessDirectionNumbers(directionSubstring)
+	def submitSpeculatively(localPath):
+		context = contextvars.copy_context()		# one each, as a context can't be entered by two threads at once
+		context.run(recordErrorResponses.set, False)
+		return executor.submit(context.run, getMetroTransitService, localPath)
+	def usedResult(future):
+		try:
+			return future.result()
+		except ServiceError as serviceError:
+			rememberErrorResponse(serviceError, True)		# now that a query did ask for it
+			raise
+	def startFetches(busNumber):
+		directionsFuture = submitSpeculatively("/NexTrip/Directions/" + busNumber)
+		stopsFutures = { directionNumber: submitSpeculatively("/NexTrip/Stops/" + busNumber + "/" + directionNumber) for directionNumber in directionGuesses }
+		return (busNumber, directionsFuture, stopsFutures)
+	guessedBusNumber = guessRouteNumber(busRouteSubstring)
+	fetches = startFetches(guessedBusNumber) if guessedBusNumber is not None else None
+	try:
+		# routes
+		thisBusNumber = uniqueMatch(getRouteMatches(busRouteSubstring), "Description", "ROUTE")["Route"]
+		if fetches is None or fetches[0] != thisBusNumber:
+			if fetches is not None:
+				for thisFuture in [ fetches[1] ] + list(fetches[2].values()): thisFuture.cancel()
+			fetches = startFetches(thisBusNumber)
+		# directions
+		thisDirectionNumber = uniqueMatch(extractMatches(usedResult(fetches[1]), "Text", directionSubstring), "Text", "DIRECTION")["Value"]
+		# stops
+		stopsFuture = fetches[2].get(thisDirectionNumber)
+		if stopsFuture is not None:
+			allStops = usedResult(stopsFuture)
+		else:
+			allStops = getMetroTransitService("/NexTrip/Stops/" + thisBusNumber + "/" + thisDirectionNumber)
+		thisStopCode = uniqueMatch(extractMatches(allStops, "Text", busStopSubstring), "Text", "STOP")["Value"]
+	finally:
+		if fetches is not None:
+			for thisFuture in [ fetches[1] ] + list(fetches[2].values()): thisFuture.cancel()		# the losers, if they haven't started yet
+	return (thisBusNumber, thisDirectionNumber, thisStopCode)
+
+def formatNextBus(departures, returnDepartureText = False, nowTime = None):
+	""" given a list of departures from getTimepointDepartures, return nextBus's output for it: the time till the next bus, or "" if no bus is coming; nowTime is as for minutesTillBus """
+	noBusReturnValue = ""	# return value for when no busses are coming
+	if nowTime is None: nowTime = time.time()		# one "now" for finding and formatting the next bus
+	departureTimes = decodeDepartures(departures)
+	nextIndex = departureTimes.nextIndex(nowTime)
+	if nextIndex is None: return noBusReturnValue
+	if returnDepartureText:
+		return departures[nextIndex]["DepartureText"]
+	else:
+		return departureTimes.formatDeparture(nextIndex, nowTime)
+
 def nextBus(busRouteSubstring, busStopSubstring, directionSubstring, returnDepartureText = False):
 	"""
 	Returns the response for the whole program, giving the formatted time for the next bus
@@ -218,47 +2535,1072 @@ def nextBus(busRouteSubstring, busStopSubstring, directionSubstring, returnDepar
 		NO MATCH ON DIRECTION
 		NETWORK ERROR
 		UNKOWN ERROR
+		This is the text of the NextBusResult that nextBusResult returns for the same query.
+	"""
+	try:
+		return nextBusResult(busRouteSubstring, busStopSubstring, directionSubstring, 1).text(returnDepartureText)
+	except:
+		return "UNKNOWN ERROR"
+
+class Departure:
+	"""
+	One upcoming departure in a NextBusResult.
+	
+	Attributes
+	------------
+	route : str
+		Route number, e.g. "21".
+	description : str
+		Route description Metro Transit gives the departure, e.g. "Uptown / Lake St", for labels.
+	departureTime : float
+		Time of the departure, in seconds since the Unix epoch.
+	minutes : float
+		Minutes from the result's time until the departure.
+	departureText : str
+		Metro Transit's own text for the departure: "14 Min" or "Due" for an estimate from
+		the bus's location, or a clock time like "10:08" for the schedule.
+	actual : boolean
+		True if the time is an estimate from the bus's location, False if it is only the schedule.
+	record : dict
+		The departure record from Metro Transit.
+	"""
+	__slots__ = ("route", "description", "departureTime", "minutes", "departureText", "actual", "record")
+	
+	def __init__(self, record, epochMilliseconds, minutes):
+		self.route = record.get("Route", "")
+		self.description = record.get("Description", "")
+		self.departureTime = epochMilliseconds / 1000.0
+		self.minutes = minutes
+		self.departureText = record.get("DepartureText", "")
+		actual = record.get("Actual")
+		if actual is None: actual = not (":" in self.departureText)		# scheduled times are shown as clock times
+		self.actual = bool(actual)
+		self.record = record
+	
+	def formatted(self):
+		""" returns the time till this departure as nextBus formats it, e.g. "5 Minutes" """
+		return formatMinutes(self.minutes)
+	
+	def toDict(self):
+		""" returns the departure as a dictionary that can be converted to JSON """
+		return { 'route': self.route, 'description': self.description, 'departureTime': self.departureTime, 'minutes': self.minutes,
+			'departureText': self.departureText, 'actual': self.actual }
+
+class NextBusResult:
+	"""
+	The whole answer to a nextBus query, from nextBusResult, so that callers that need more
+	than nextBus's one line (the next few buses, whether times are estimates or schedules,
+	the codes that the query resolved to, or the list of matches) can get it from one lookup.
+	text() gives nextBus's output.
+	
+	Attributes
+	------------
+	routeNumber, directionNumber, stopCode : str
+		The codes the query resolved to, or None if it didn't get that far.
+	departures : list
+		The next departures still to come, as Departure objects, soonest first; empty if no
+		bus is coming or there was an error.
+	nowTime : float
+		The time, in seconds since the Unix epoch, that the minutes are counted from.
+	stale : boolean
+		True if the departures come from a last-known list for the stop that is past
+		departureFreshness, served while a new one is fetched (see getDeparturesStaleWhileRevalidate).
+	age : float
+		Seconds since the departure list was fetched.
+	errorKind : str
+		None, or errorNoMatch, errorMultipleMatches, errorNetwork or errorUnknown.
+	errorText : str
+		The error message nextBus gives, or None.
+	itemKind : str
+		For a match error, what didn't match uniquely: ROUTE, DIRECTION or STOP.
+	matches : list
+		For errorMultipleMatches, the matching records from Metro Transit.
+	"""
+	__slots__ = ("routeNumber", "directionNumber", "stopCode", "departures", "nowTime", "stale", "age", "errorKind", "errorText", "itemKind", "matches")
+	
+	def __init__(self):
+		self.routeNumber = None
+		self.directionNumber = None
+		self.stopCode = None
+		self.departures = [ ]
+		self.nowTime = None
+		self.stale = False
+		self.age = 0.0
+		self.errorKind = None
+		self.errorText = None
+		self.itemKind = None
+		self.matches = [ ]
+	
+	@property
+	def ok(self):
+		""" True if the lookup had no error, whether or not any bus is coming """
+		return self.errorKind is None
+	
+	def setDepartures(self, departures, count, nowTime = None):
+		""" fills in the next count departures (all of them if count is None) still to come at nowTime (default now) from a list from getTimepointDepartures """
+		if nowTime is None: nowTime = time.time()
+		self.nowTime = nowTime
+		departureTimes = decodeDepartures(departures)
+		self.departures = [ Departure(departures[i], departureTimes.times[i], departureTimes.minutesTill(i, nowTime)) for i in departureTimes.upcomingIndexes(nowTime, count) ]
+	
+	def setError(self, errorKind, errorText, itemKind = None, matches = None):
+		""" records an error """
+		self.errorKind = errorKind
+		self.errorText = errorText
+		self.itemKind = itemKind
+		self.matches = matches if matches is not None else [ ]
+	
+	def text(self, returnDepartureText = False):
+		""" returns nextBus's output: the error message, "" if no bus is coming, or the time till the next bus (Metro Transit's text for it if returnDepartureText is true) """
+		if self.errorText is not None: return self.errorText
+		if len(self.departures) == 0: return ""
+		if returnDepartureText: return self.departures[0].departureText
+		return self.departures[0].formatted()
+	
+	def __str__(self):
+		return self.text()
+	
+	def toDict(self):
+		""" returns the result as a dictionary that can be converted to JSON """
+		return { 'text': self.text(), 'routeNumber': self.routeNumber, 'directionNumber': self.directionNumber, 'stopCode': self.stopCode,
+			'departures': [ thisDeparture.toDict() for thisDeparture in self.departures ], 'nowTime': self.nowTime, 'stale': self.stale, 'age': self.age,
+			'errorKind': self.errorKind, 'itemKind': self.itemKind, 'matches': [ dict(thisMatch) for thisMatch in self.matches ] }
+
+def nextBusResult(busRouteSubstring, busStopSubstring, directionSubstring, count = 3, nowTime = None):
+	"""
+	Looks up a query like nextBus, but returns the whole answer as a NextBusResult: the codes
+	the query resolved to, the next few departures with their times, and any error.  The
+	departures may come from the last list fetched for the stop, which the result marks as
+	stale once it is past departureFreshness (see getDeparturesStaleWhileRevalidate).
+	
+	Parameters
+	------------
+	busRouteSubstring, busStopSubstring, directionSubstring : str
+		As for nextBus.
+	count : int
+		(Optional) Maximum number of departures to include; None includes all of them.
+	nowTime : float
+		(Optional) Time, in seconds since the Unix epoch, to count minutes from; defaults to now.
+	
+	Returns
+	--------
+	NextBusResult
+		The answer; errors are recorded in it, never raised.
 	"""
+	result = NextBusResult()
+	queryStarted = metrics.start()
 	try:
-		# Get the information from Metro Transit.  Return appropriate errors if
+		# Get the information from Metro Transit.  resolveStop raises the appropriate errors if
 		# no matches are found or multiple matches are found.
-		# routes
-		noBusReturnValue = ""	# return value for when no busses are coming
-		matchingRoutes = getRouteMatches(busRouteSubstring)
-		if (len(matchingRoutes) == 0): return "NO MATCH ON ROUTE"
-		if (len(matchingRoutes) > 1): return "MULTIPLE MATCHES ON ROUTE: " + commaList(matchingRoutes, "Description")
-		thisBusNumber = matchingRoutes[0]["Route"]
-		# directions
-		matchingDirections = getDirectionMatches(thisBusNumber, directionSubstring)
-		if (len(matchingDirections) == 0): return "NO MATCH ON DIRECTION"
-		if (len(matchingDirections) > 1): return "MULTIPLE MATCHES ON DIRECTION: " + commaList(matchingDirections, "Text")
-		thisDirectionNumber = matchingDirections[0]["Value"]
-		# stops
-		matchingStops = getStopMatches(thisBusNumber, thisDirectionNumber, busStopSubstring)
-		if (len(matchingStops) == 0): return "NO MATCH ON STOP"
-		if (len(matchingStops) > 1): return "MULTIPLE MATCHES ON STOP: " + commaList(matchingStops, "Text")
-		thisStopCode = matchingStops[0]["Value"]
-		# Now, look up the bus schedule for the given location, and return the appropriate time,
-		# or, return "" if there are no buses coming.
-		departures = getTimepointDepartures(thisBusNumber, thisDirectionNumber, thisStopCode)
-		nextDepartureRecordList = getNextBusRecord(departures)
-		if (len(nextDepartureRecordList) == 0): return noBusReturnValue
-		if returnDepartureText:
-			return nextDepartureRecordList[0]["DepartureText"]
-		else:
-			return formatTimepoint(nextDepartureRecordList[0])
+		started = metrics.start()
+		result.routeNumber, result.directionNumber, result.stopCode = resolveStop(busRouteSubstring, busStopSubstring, directionSubstring)
+		metrics.finish("resolve", started)
+		# Now, look up the bus schedule for the given location.
+		started = metrics.start()
+		departures, result.stale, result.age = getDeparturesStaleWhileRevalidate(result.routeNumber, result.directionNumber, result.stopCode)
+		metrics.finish("departures", started)
+		result.setDepartures(departures, count, nowTime)
+	except NextBusError as lookupError:
+		result.setError(lookupError.errorKind, str(lookupError), lookupError.itemKind, lookupError.matches)
+	except IOError:
+		result.setError(errorNetwork, "NETWORK ERROR")
+	except:
+		result.setError(errorUnknown, "UNKNOWN ERROR")
+	metrics.count("results", result.errorKind or "OK")
+	metrics.finish("query", queryStarted)
+	return result
+
+def adaptivePollInterval(secondsTillEvent, minInterval, maxInterval, pollFraction):
+	""" returns the seconds to wait before polling again when the next thing to watch for is secondsTillEvent away: pollFraction of that time, kept between minInterval and maxInterval """
+	return max(minInterval, min(maxInterval, secondsTillEvent * pollFraction))
+
+class NextBusWatch:
+	"""
+	Keeps watching one stop, polling Metro Transit for its departures only as often as the next
+	bus needs: every minInterval seconds while a bus is a couple of minutes away or due, and
+	less often the further away it is, up to maxInterval when it is far away or there are no
+	more buses today.  The stop is resolved once and its codes kept.  Between polls the minutes
+	are counted down from the departures already fetched, so no service calls are needed just
+	to keep the time shown current.
+	
+	Parameters
+	------------
+	busRouteSubstring, busStopSubstring, directionSubstring : str
+		As for nextBus.
+	count : int
+		(Optional) Maximum number of departures in each result, as for nextBusResult.
+	minInterval, maxInterval : float
+		(Optional) Shortest and longest time between polls, in seconds.
+	pollFraction : float
+		(Optional) Fraction of the time till the next bus to wait before polling again.
+	errorInterval : float
+		(Optional) Seconds to wait before trying again after a network or unknown error.
+	clock, sleep : function
+		(Optional) Replacements for time.time and time.sleep, for testing.
+	
+	Example
+	--------
+		for thisResult in NextBusWatch("#21", "Snelling", "east").changes():
+			print(thisResult.text())
+	"""
+	def __init__(self, busRouteSubstring, busStopSubstring, directionSubstring, count = 3, minInterval = 15.0, maxInterval = 600.0,
+			pollFraction = 0.25, errorInterval = 60.0, clock = time.time, sleep = time.sleep):
+		self.query = (busRouteSubstring, busStopSubstring, directionSubstring)
+		self.count = count
+		self.minInterval = minInterval
+		self.maxInterval = maxInterval
+		self.pollFraction = pollFraction
+		self.errorInterval = errorInterval
+		self.clock = clock
+		self.sleep = sleep
+		self.stopCodes = None
+		self.departures = None
+		self.lastResult = None
+		self.nextPollTime = 0.0
+		self.polls = 0
+	
+	def pollInterval(self, result):
+		""" returns the seconds to wait after a poll that gave result before polling again """
+		if not result.ok: return self.errorInterval
+		if len(result.departures) == 0: return self.maxInterval
+		return adaptivePollInterval(result.departures[0].minutes * 60.0, self.minInterval, self.maxInterval, self.pollFraction)
+	
+	def poll(self, nowTime = None):
+		""" fetches the departures now (resolving the stop first if need be) and returns the NextBusResult """
+		if nowTime is None: nowTime = self.clock()
+		self.polls += 1
+		result = NextBusResult()
+		try:
+			if self.stopCodes is None: self.stopCodes = resolveStop(*self.query)
+			result.routeNumber, result.directionNumber, result.stopCode = self.stopCodes
+			self.departures = getTimepointDepartures(*self.stopCodes)
+			result.setDepartures(self.departures, self.count, nowTime)
+		except NextBusError as lookupError:
+			result.setError(lookupError.errorKind, str(lookupError), lookupError.itemKind, lookupError.matches)
+		except IOError:
+			result.setError(errorNetwork, "NETWORK ERROR")
+		except Exception:
+			result.setError(errorUnknown, "UNKNOWN ERROR")
+		self.nextPollTime = nowTime + self.pollInterval(result)
+		self.lastResult = result
+		return result
+	
+	def current(self, nowTime = None):
+		""" returns the NextBusResult for nowTime (default now), polling only if a poll is due and otherwise counting down from the last departures """
+		if nowTime is None: nowTime = self.clock()
+		if self.lastResult is None or nowTime >= self.nextPollTime: return self.poll(nowTime)
+		if not self.lastResult.ok: return self.lastResult		# wait errorInterval before trying again
+		result = NextBusResult()
+		result.routeNumber, result.directionNumber, result.stopCode = self.stopCodes
+		result.setDepartures(self.departures, self.count, nowTime)
+		if len(result.departures) == 0 and len(self.lastResult.departures) > 0: return self.poll(nowTime)		# the bus we were waiting for has left
+		self.lastResult = result
+		return result
+	
+	def changes(self, returnDepartureText = False, tickInterval = 15.0):
+		"""
+		Generator giving a NextBusResult each time the text nextBus would show for the stop
+		(with returnDepartureText as for nextBus) changes, checking every tickInterval seconds
+		and polling on the schedule above.  It ends after a NO MATCH or MULTIPLE MATCHES error,
+		since those won't change by waiting.
+		"""
+		lastText = None
+		while True:
+			result = self.current()
+			thisText = result.text(returnDepartureText)
+			if thisText != lastText:
+				lastText = thisText
+				yield result
+			if result.errorKind in (errorNoMatch, errorMultipleMatches): return
+			nowTime = self.clock()
+			self.sleep(max(0.0, min(tickInterval, self.nextPollTime - nowTime)))
+
+class Subscription:
+	"""
+	One "tell me when a bus is thresholdMinutes away" request in a SubscriptionScheduler.
+	stopCodes are the (route number, direction number, stop code) the query resolved to, and
+	callback (or None) is called with a BusAlert each time it fires.
+	"""
+	__slots__ = ("subscriptionId", "query", "stopCodes", "thresholdMinutes", "callback")
+	
+	def __init__(self, subscriptionId, query, stopCodes, thresholdMinutes, callback):
+		self.subscriptionId = subscriptionId
+		self.query = query
+		self.stopCodes = stopCodes
+		self.thresholdMinutes = thresholdMinutes
+		self.callback = callback
+
+class BusAlert:
+	""" a Subscription firing: departure (a Departure) is now minutes away, which is within the subscription's threshold """
+	__slots__ = ("subscription", "departure", "minutes")
+	
+	def __init__(self, subscription, departure, minutes):
+		self.subscription = subscription
+		self.departure = departure
+		self.minutes = minutes
+
+def departureKey(departure):
+	""" returns something that identifies the same bus in successive departure lists for a stop, even though its DepartureTime changes as the estimate changes """
+	if departure.get("BlockNumber") is None: return departure["DepartureTime"]
+	return (departure.get("Route"), departure.get("BlockNumber"), departure.get("Terminal"))
+
+class StopSubscriptions:
+	"""
+	The subscriptions of a SubscriptionScheduler for one stop, and what it knows about the
+	stop's departures.  thresholds holds (thresholdMinutes, subscriptionId) in order, so the
+	subscriptions due for a bus are a slice found by binary search; departures maps the
+	departureKey of each bus to [departure record, time in milliseconds since the Unix
+	epoch, firedAbove, version], where every subscription with a threshold of at least
+	firedAbove minutes has already been alerted about that bus.
+	"""
+	__slots__ = ("stopCodes", "thresholds", "departures", "pollVersion")
+	
+	def __init__(self, stopCodes):
+		self.stopCodes = stopCodes
+		self.thresholds = [ ]
+		self.departures = { }
+		self.pollVersion = 0
+
+class SubscriptionScheduler:
+	"""
+	Sends alerts when buses are a given number of minutes away, for any number of
+	subscriptions.  Subscriptions are grouped by stop, so each stop's departures are fetched
+	once per poll however many subscriptions it has, and stops are polled on the same kind of
+	schedule as NextBusWatch.  Every threshold crossing that will come from the departures
+	fetched so far is kept in one heap of timers, so runPending only does work for the
+	crossings and polls that are due: finding the subscriptions a crossing alerts is a binary
+	search in the stop's thresholds, not a loop over all subscriptions.
+	
+	Each subscription is alerted once per bus, as soon as the scheduler sees that bus within
+	its threshold (so a subscription added when a bus is already close is alerted about it
+	at once).
+	
+	Parameters
+	------------
+	callback : function
+		(Optional) Called with each BusAlert of subscriptions that don't have their own callback.
+	maxWorkers : int
+		(Optional) Maximum number of stops fetched at once when several polls are due together.
+	minInterval, maxInterval, pollFraction, errorInterval : float
+		(Optional) Polling schedule for each stop, as for NextBusWatch, based on the time till
+		the stop's next threshold crossing.
+	clock : function
+		(Optional) Replacement for time.time, for testing.
+	
+	Example
+	--------
+		scheduler = SubscriptionScheduler(print)
+		scheduler.subscribe("#21", "Snelling", "east", 5)
+		scheduler.run()
+	"""
+	def __init__(self, callback = None, maxWorkers = 8, minInterval = 15.0, maxInterval = 600.0, pollFraction = 0.25, errorInterval = 60.0, clock = time.time):
+		self.callback = callback
+		self.maxWorkers = maxWorkers
+		self.minInterval = minInterval
+		self.maxInterval = maxInterval
+		self.pollFraction = pollFraction
+		self.errorInterval = errorInterval
+		self.clock = clock
+		self.lock = threading.RLock()
+		self.wakeup = threading.Event()
+		self.subscriptions = { }
+		self.stops = { }
+		self.timers = [ ]		# heap of (due time, sequence, stopCodes, departureKey or None for a poll, version)
+		self.timerSequence = 0
+		self.liveTimers = set()		# (stopCodes, departureKey or None) of the timers in the heap that are still current
+		self.pendingAlerts = [ ]		# alerts found by subscribe, sent by the next runPending
+		self.nextSubscriptionId = 1
+		self.polls = 0
+		self.alerts = 0
+	
+	def subscribe(self, busRouteSubstring, busStopSubstring, directionSubstring, thresholdMinutes, callback = None):
+		"""
+		Adds a subscription and returns its id, for unsubscribe.  The stop is resolved straight
+		away, so a query that doesn't match raises a NextBusError (or IOError) here.
+		"""
+		stopCodes = resolveStop(busRouteSubstring, busStopSubstring, directionSubstring)
+		with self.lock:
+			subscription = Subscription(self.nextSubscriptionId, (busRouteSubstring, busStopSubstring, directionSubstring), stopCodes, thresholdMinutes, callback)
+			self.nextSubscriptionId += 1
+			self.subscriptions[subscription.subscriptionId] = subscription
+			stop = self.stops.get(stopCodes)
+			if stop is None:
+				stop = self.stops[stopCodes] = StopSubscriptions(stopCodes)
+				self.pushTimer(self.clock(), stopCodes, None, stop.pollVersion)		# poll a new stop straight away
+			bisect.insort(stop.thresholds, (thresholdMinutes, subscription.subscriptionId))
+			nowTime = self.clock()
+			for thisKey, thisState in stop.departures.items():
+				if thisState[2] <= thresholdMinutes and thisState[1] / 1000.0 > nowTime:		# already within the new threshold
+					minutes = (thisState[1] / 1000.0 - nowTime) / 60.0
+					self.pendingAlerts.append(BusAlert(subscription, Departure(thisState[0], thisState[1], minutes), minutes))
+				self.scheduleCrossing(stop, thisKey)		# a bigger threshold may cross sooner
+		self.wakeup.set()
+		return subscription.subscriptionId
+	
+	def unsubscribe(self, subscriptionId):
+		""" removes a subscription; its timers are simply skipped when they come due """
+		with self.lock:
+			subscription = self.subscriptions.pop(subscriptionId, None)
+			if subscription is None: return False
+			stop = self.stops[subscription.stopCodes]
+			position = bisect.bisect_left(stop.thresholds, (subscription.thresholdMinutes, subscriptionId))
+			del stop.thresholds[position]
+			if len(stop.thresholds) == 0:
+				del self.stops[subscription.stopCodes]
+				self.liveTimers.discard((stop.stopCodes, None))		# the stop's timers are all dead now
+				for thisKey in stop.departures: self.liveTimers.discard((stop.stopCodes, thisKey))
+		return True
+	
+	def pushTimer(self, dueTime, stopCodes, key, version):
+		"""
+		Adds a timer to the heap, replacing any earlier timer for the same poll or bus (whose
+		version the caller has moved on).  Replaced timers stay in the heap until they come due,
+		unless they outnumber the current ones, when they are cleared out all at once; the
+		current ones are counted as they come and go, so that check costs nothing.
+		"""
+		self.timerSequence += 1
+		heapq.heappush(self.timers, (dueTime, self.timerSequence, stopCodes, key, version))
+		self.liveTimers.add((stopCodes, key))
+		if len(self.timers) > 2 * len(self.liveTimers):
+			self.timers = [ thisTimer for thisTimer in self.timers if self.timerIsCurrent(thisTimer) ]
+			heapq.heapify(self.timers)
+			self.liveTimers = set((thisTimer[2], thisTimer[3]) for thisTimer in self.timers)
+	
+	def popTimer(self):
+		""" removes the first timer from the heap and returns it, or None if it has been replaced or cancelled """
+		thisTimer = heapq.heappop(self.timers)
+		if not self.timerIsCurrent(thisTimer): return None
+		self.liveTimers.discard((thisTimer[2], thisTimer[3]))
+		return thisTimer
+	
+	def timerIsCurrent(self, timer):
+		""" returns True if a timer from the heap hasn't been replaced or cancelled """
+		dueTime, sequence, stopCodes, key, version = timer
+		stop = self.stops.get(stopCodes)
+		if stop is None: return False
+		if key is None: return version == stop.pollVersion
+		return key in stop.departures and version == stop.departures[key][3]
+	
+	def scheduleCrossing(self, stop, key):
+		""" puts a timer on the heap for the next threshold that a bus at a stop will cross, if any """
+		state = stop.departures[key]
+		position = bisect.bisect_left(stop.thresholds, (state[2], 0)) - 1		# largest threshold below firedAbove
+		if position < 0: return
+		state[3] += 1
+		self.pushTimer(state[1] / 1000.0 - stop.thresholds[position][0] * 60.0, stop.stopCodes, key, state[3])
+	
+	def nextCrossingTime(self, stop):
+		""" returns when the next threshold crossing (or failing that, the next departure) is due at a stop, or None if no bus is coming """
+		times = [ ]
+		for thisRecord, thisTime, thisFiredAbove, thisVersion in stop.departures.values():
+			position = bisect.bisect_left(stop.thresholds, (thisFiredAbove, 0)) - 1
+			times.append(thisTime / 1000.0 - (stop.thresholds[position][0] * 60.0 if position >= 0 else 0.0))
+		return min(times) if times else None
+	
+	def applyDepartures(self, stop, departures, nowTime):
+		""" takes a new departure list for a stop, keeping what has already fired for the buses still in it, and schedules the crossings and the next poll """
+		departureTimes = decodeDepartures(departures)
+		oldDepartures = stop.departures
+		stop.departures = { }
+		for i in departureTimes.upcomingIndexes(nowTime):
+			thisKey = departureKey(departures[i])
+			firedAbove = oldDepartures[thisKey][2] if thisKey in oldDepartures else float("inf")
+			version = oldDepartures[thisKey][3] if thisKey in oldDepartures else 0
+			stop.departures[thisKey] = [ departures[i], departureTimes.times[i], firedAbove, version ]
+			self.scheduleCrossing(stop, thisKey)
+		for thisKey in oldDepartures:
+			if thisKey not in stop.departures: self.liveTimers.discard((stop.stopCodes, thisKey))		# buses that have gone
+		nextEvent = self.nextCrossingTime(stop)
+		interval = self.maxInterval if nextEvent is None else adaptivePollInterval(nextEvent - nowTime, self.minInterval, self.maxInterval, self.pollFraction)
+		stop.pollVersion += 1
+		self.pushTimer(nowTime + interval, stop.stopCodes, None, stop.pollVersion)
+	
+	def fireCrossing(self, stop, key, nowTime):
+		""" alerts the subscriptions whose threshold a bus has now crossed, and schedules the next crossing for it """
+		state = stop.departures[key]
+		minutes = (state[1] / 1000.0 - nowTime) / 60.0
+		crossedAbove = minutes - 1e-6		# so a timer set for exactly a threshold's crossing always fires it
+		first = bisect.bisect_left(stop.thresholds, (crossedAbove, 0))
+		last = bisect.bisect_left(stop.thresholds, (state[2], 0))
+		state[2] = min(state[2], crossedAbove)
+		alerts = [ ]
+		if first < last:
+			departure = Departure(state[0], state[1], minutes)
+			for thisThreshold, thisSubscriptionId in stop.thresholds[first:last]:
+				alerts.append(BusAlert(self.subscriptions[thisSubscriptionId], departure, minutes))
+		if minutes > 0: self.scheduleCrossing(stop, key)
+		return alerts
+	
+	def runPending(self, nowTime = None):
+		"""
+		Does the polls and threshold crossings that are due at nowTime (default now), calls the
+		callbacks, and returns the list of BusAlerts sent.  Stops that are due to be polled
+		together are fetched concurrently.
+		"""
+		if nowTime is None: nowTime = self.clock()
+		with self.lock:
+			alerts, self.pendingAlerts = [ thisAlert for thisAlert in self.pendingAlerts if thisAlert.subscription.subscriptionId in self.subscriptions ], [ ]
+			duePolls = [ ]
+			while self.timers and self.timers[0][0] <= nowTime:
+				thisTimer = self.popTimer()
+				if thisTimer is None: continue
+				stopCodes, key = thisTimer[2], thisTimer[3]
+				if key is None:
+					duePolls.append(self.stops[stopCodes])
+				else:
+					alerts.extend(self.fireCrossing(self.stops[stopCodes], key, nowTime))
+			self.polls += len(duePolls)
+		if duePolls:
+			# fetched without holding the lock, so subscribe, unsubscribe and stats aren't held up by the service
+			with concurrent.futures.ThreadPoolExecutor(max_workers = min(self.maxWorkers, len(duePolls))) as executor:
+				fetches = [ (thisStop, executor.submit(getTimepointDepartures, *thisStop.stopCodes)) for thisStop in duePolls ]
+			with self.lock:
+				for thisStop, thisFetch in fetches:
+					if self.stops.get(thisStop.stopCodes) is not thisStop: continue		# unsubscribed while it was being fetched
+					try:
+						self.applyDepartures(thisStop, thisFetch.result(), nowTime)
+					except Exception:
+						thisStop.pollVersion += 1		# keep what we had, and try again later
+						self.pushTimer(nowTime + self.errorInterval, thisStop.stopCodes, None, thisStop.pollVersion)
+				while self.timers and self.timers[0][0] <= nowTime:		# crossings that the new departures made due
+					thisTimer = self.popTimer()
+					if thisTimer is None: continue
+					if thisTimer[3] is None:
+						self.pushTimer(nowTime + self.minInterval, thisTimer[2], None, thisTimer[4])		# no second poll in one run
+					else:
+						alerts.extend(self.fireCrossing(self.stops[thisTimer[2]], thisTimer[3], nowTime))
+		self.alerts += len(alerts)
+		for thisAlert in alerts:
+			callback = thisAlert.subscription.callback or self.callback
+			if callback is not None: callback(thisAlert)
+		return alerts
+	
+	def nextDueTime(self):
+		""" returns when runPending next has something to do, or None if nothing is scheduled """
+		with self.lock:
+			return self.timers[0][0] if self.timers else None
+	
+	def run(self, stopEvent = None):
+		""" calls runPending whenever something is due, sleeping in between, until stopEvent (a threading.Event) is set """
+		if stopEvent is None: stopEvent = threading.Event()
+		while not stopEvent.is_set():
+			self.runPending()
+			dueTime = self.nextDueTime()
+			self.wakeup.clear()
+			timeout = self.maxInterval if dueTime is None else max(0.0, dueTime - self.clock())
+			self.wakeup.wait(min(timeout, 1.0))		# wake at least once a second to check stopEvent
+	
+	def stats(self):
+		""" returns a dictionary of counts, for monitoring """
+		with self.lock:
+			return { 'subscriptions': len(self.subscriptions), 'stops': len(self.stops), 'timers': len(self.timers), 'liveTimers': len(self.liveTimers),
+				'polls': self.polls, 'alerts': self.alerts }
+
+def parseBoardEntry(text):
+	""" parses a departure board entry written as ROUTE/DIRECTION/STOP, e.g. 21/2/SNUN, into a tuple of Metro Transit codes, raising ValueError if it isn't one """
+	entry = tuple(thisPart.strip() for thisPart in text.split("/"))
+	if len(entry) != 3 or "" in entry: raise ValueError("board entry must be ROUTE/DIRECTION/STOP: " + text)
+	return entry
+
+def departureBoard(entries, count = 10, nowTime = None, maxWorkers = 8):
+	"""
+	Finds the next buses on any of several routes at one place, e.g. every route that stops at a
+	corner.  All the departure lists are fetched at once, so this takes about as long as one
+	fetch however many entries there are, and then they are merged in order of departure time.
+	
+	Parameters
+	------------
+	entries : iterable
+		(route number, direction number, stop code) triples, as from resolveStop or parseBoardEntry.
+	count : int
+		(Optional) Maximum number of departures to return; None returns all of them.
+	nowTime : float
+		(Optional) Time, in seconds since the Unix epoch, to count minutes from; defaults to now.
+	maxWorkers : int
+		(Optional) Maximum number of fetches in flight at once.
+	
+	Returns
+	--------
+	tuple
+		(departures, failedEntries): the next departures across all the entries, soonest first,
+		as Departure objects, whose route and record (with RouteDirection) label them; and the
+		entries whose departures couldn't be fetched.
+	"""
+	entries = list(collections.OrderedDict.fromkeys(tuple(thisEntry) for thisEntry in entries))		# each stop fetched once
+	if nowTime is None: nowTime = time.time()
+	departureLists, failedEntries = [ ], [ ]
+	if entries:
+		with concurrent.futures.ThreadPoolExecutor(max_workers = min(maxWorkers, len(entries))) as executor:
+			fetches = [ (thisEntry, executor.submit(getTimepointDepartures, *thisEntry)) for thisEntry in entries ]
+		for thisEntry, thisFetch in fetches:
+			try:
+				departureLists.append(thisFetch.result())
+			except Exception:
+				failedEntries.append(thisEntry)
+	def upcoming(departures):
+		departureTimes = decodeDepartures(departures)
+		indexes = departureTimes.upcomingIndexes(nowTime)
+		if not departureTimes.inOrder: indexes.sort(key = lambda i: departureTimes.times[i])
+		for i in indexes: yield departureTimes.times[i], departures, i
+	merged = heapq.merge(*[ upcoming(thisList) for thisList in departureLists ], key = lambda item: item[0])
+	departures = [ ]
+	for epochMilliseconds, thisList, i in merged:
+		if count is not None and len(departures) >= count: break
+		departures.append(Departure(thisList[i], epochMilliseconds, (epochMilliseconds / 1000.0 - nowTime) / 60.0))
+	return departures, failedEntries
+
+def formatBoardLine(departure):
+	""" formats a departure from departureBoard as one tab-separated line: time till it leaves, route, direction, description """
+	return "\t".join([ departure.formatted(), departure.route, departure.record.get("RouteDirection", ""), suppressMultipleSpaces(departure.description) ])
+
+def parseBatchLine(line):
+	"""
+	Reads one (route, stop, direction) query from a line of batch input.  The line can be CSV
+	(e.g. "#21,Snelling,east", with quotes around names that contain commas), a JSON object
+	with "route", "stop" and "direction" keys, or a JSON list of three strings.  Returns the
+	triple as a tuple, or None for a blank line; raises a ValueError if the line can't be read.
+	"""
+	line = line.strip()
+	if line == "": return None
+	if line[0] in "{[":
+		item = json.loads(line)
+		if isinstance(item, dict):
+			if not all(key in item for key in ("route", "stop", "direction")): raise ValueError("missing route, stop or direction")
+			item = [ item["route"], item["stop"], item["direction"] ]
+	else:
+		try:
+			item = next(csv.reader([ line ], skipinitialspace = True))
+		except csv.Error as csvError:
+			raise ValueError(str(csvError))
+	if len(item) != 3 or not all(isinstance(field, str) for field in item): raise ValueError("expected route, stop and direction")
+	return tuple(item)
+
+def nextBusBatch(queries, maxWorkers = 8, returnDepartureText = False):
+	"""
+	Answers many nextBus queries in one pass, yielding one result per query in input order
+	as soon as it is ready.  Route, direction and stop lookups shared by several queries are
+	fetched once (they come from the service cache after the first query that needs them),
+	a stop asked for more than once has its departures fetched once, and departures are
+	fetched concurrently, in the background priority lane so that interactive lookups sharing
+	the process's rate limit go first (see RateLimiter).
+	
+	Parameters
+	------------
+	queries : iterable
+		(route substring, stop substring, direction substring) triples, as for nextBus.  An
+		item of None (e.g. an unreadable line of input) gets the result "PARAMETER ERROR".
+	maxWorkers : int
+		(Optional) Maximum number of departure fetches in flight at once.
+	returnDepartureText : boolean
+		(Optional) As for nextBus.
+	
+	Returns
+	--------
+	generator
+		The nextBus result string for each query.
+	"""
+	pending = collections.deque()		# futures or finished result strings, in input order
+	departureFutures = { }		# one departures fetch per stop for the whole batch
+	with concurrent.futures.ThreadPoolExecutor(max_workers = maxWorkers) as executor:
+		for thisQuery in queries:
+			if thisQuery is None:
+				pending.append("PARAMETER ERROR")
+			else:
+				try:
+					stopCodes = resolveStop(*thisQuery)
+					if stopCodes not in departureFutures:
+						departureFutures[stopCodes] = executor.submit(withPriority, priorityBackground, getTimepointDepartures, *stopCodes)
+					pending.append(departureFutures[stopCodes])
+				except NextBusError as lookupError:
+					pending.append(str(lookupError))
+				except IOError:
+					pending.append("NETWORK ERROR")
+				except:
+					pending.append("UNKNOWN ERROR")
+			# yield whatever is finished at the front, and wait if too many fetches are queued up
+			while pending and (isinstance(pending[0], str) or pending[0].done() or len(pending) > maxWorkers * 4):
+				yield batchResult(pending.popleft(), returnDepartureText)
+		while pending:
+			yield batchResult(pending.popleft(), returnDepartureText)
+
+def batchResult(pendingItem, returnDepartureText):
+	""" turns an item queued by nextBusBatch, either a result string or a departures future, into a result string """
+	if isinstance(pendingItem, str): return pendingItem
+	try:
+		return formatNextBus(pendingItem.result(), returnDepartureText)
 	except IOError:
 		return "NETWORK ERROR"
 	except:
 		return "UNKNOWN ERROR"
 
+#
+#	Coroutine versions of the lookups, for use from asyncio programs.  They share the matching
+#	and formatting code above, and return the same results and errors.
+#
+async def getRouteMatchesAsync(busRouteSubstring):
+	""" coroutine version of getRouteMatches """
+	return extractMatches(await getMetroTransitServiceAsync("/NexTrip/Routes"), "Description", busRouteSubstring)
+
+async def getDirectionMatchesAsync(busRouteNumber, busDirectionSubstring):
+	""" coroutine version of getDirectionMatches """
+	return extractMatches(await getMetroTransitServiceAsync("/NexTrip/Directions/" + busRouteNumber), "Text", busDirectionSubstring)
+
+async def getStopMatchesAsync(busRouteNumber, busDirectionNumber, busStopSubstring):
+	""" coroutine version of getStopMatches """
+	return extractMatches(await getMetroTransitServiceAsync("/NexTrip/Stops/" + busRouteNumber + "/" + busDirectionNumber), "Text", busStopSubstring)
+
+async def getTimepointDeparturesAsync(busRouteNumber, busDirectionNumber, busStopCode):
+	""" coroutine version of getTimepointDepartures """
+	return await getMetroTransitServiceAsync("/NexTrip/" + busRouteNumber + "/" + busDirectionNumber + "/" + busStopCode)
+
+async def fetchAndKeepDeparturesAsync(busRouteNumber, busDirectionNumber, busStopCode):
+	""" coroutine version of fetchAndKeepDepartures """
+	departures = await getTimepointDeparturesAsync(busRouteNumber, busDirectionNumber, busStopCode)
+	departureCache.put(departuresUrl(busRouteNumber, busDirectionNumber, busStopCode), (time.time(), departures), maxDepartureStaleness)
+	return departures
+
+def refreshDeparturesAsync(busRouteNumber, busDirectionNumber, busStopCode):
+	""" version of refreshDepartures for the running event loop, returning the task fetching the stop's departures """
+	myURL = departuresUrl(busRouteNumber, busDirectionNumber, busStopCode)
+	loop = asyncio.get_running_loop()
+	refresh = departureRefreshTasks.get(myURL)
+	if refresh is not None and not refresh.done() and refresh.get_loop() is loop: return refresh
+	refresh = loop.create_task(fetchAndKeepDeparturesAsync(busRouteNumber, busDirectionNumber, busStopCode))
+	departureRefreshTasks[myURL] = refresh
+	def forget(finished):
+		if departureRefreshTasks.get(myURL) is finished: del departureRefreshTasks[myURL]
+		if not finished.cancelled(): finished.exception()		# a failed background fetch is not an error
+	refresh.add_done_callback(forget)
+	return refresh
+
+async def getDeparturesStaleWhileRevalidateAsync(busRouteNumber, busDirectionNumber, busStopCode):
+	""" coroutine version of getDeparturesStaleWhileRevalidate; the background fetch is a task on the running loop """
+	entry = departureCache.get(departuresUrl(busRouteNumber, busDirectionNumber, busStopCode)) if staleWhileRevalidate else None
+	if entry is not None:
+		fetchedAt, departures = entry
+		age = max(0.0, time.time() - fetchedAt)
+		if age < departureFreshness: return departures, False, age
+		if age <= maxDepartureStaleness:
+			refreshDeparturesAsync(busRouteNumber, busDirectionNumber, busStopCode)
+			return departures, True, age
+	return await fetchAndKeepDeparturesAsync(busRouteNumber, busDirectionNumber, busStopCode), False, 0.0
+
+async def resolveStopAsync(busRouteSubstring, busStopSubstring, directionSubstring, useCache = True):
+	""" coroutine version of resolveStop, sharing its remembered outcomes """
+	cacheKey = resolutionKey(busRouteSubstring, busStopSubstring, directionSubstring)
+	if useCache:
+		stopCodes = getCachedResolution(cacheKey)
+		if stopCodes is not None: return stopCodes
+	try:
+		thisBusNumber = uniqueMatch(await getRouteMatchesAsync(busRouteSubstring), "Description", "ROUTE")["Route"]
+		thisDirectionNumber = uniqueMatch(await getDirectionMatchesAsync(thisBusNumber, directionSubstring), "Text", "DIRECTION")["Value"]
+		thisStopCode = uniqueMatch(await getStopMatchesAsync(thisBusNumber, thisDirectionNumber, busStopSubstring), "Text", "STOP")["Value"]
+	except NextBusError as lookupError:
+		if useCache: rememberResolution(cacheKey, lookupError)
+		raise
+	stopCodes = (thisBusNumber, thisDirectionNumber, thisStopCode)
+	if useCache: rememberResolution(cacheKey, stopCodes)
+	return stopCodes
+
+async def nextBusAsync(busRouteSubstring, busStopSubstring, directionSubstring, returnDepartureText = False):
+	""" coroutine version of nextBus, returning exactly the same strings """
+	return (await nextBusResultAsync(busRouteSubstring, busStopSubstring, directionSubstring, 1)).text(returnDepartureText)
+
+async def nextBusResultAsync(busRouteSubstring, busStopSubstring, directionSubstring, count = 3, nowTime = None):
+	""" coroutine version of nextBusResult """
+	result = NextBusResult()
+	queryStarted = metrics.start()
+	try:
+		started = metrics.start()
+		result.routeNumber, result.directionNumber, result.stopCode = await resolveStopAsync(busRouteSubstring, busStopSubstring, directionSubstring)
+		metrics.finish("resolve", started)
+		started = metrics.start()
+		departures, result.stale, result.age = await getDeparturesStaleWhileRevalidateAsync(result.routeNumber, result.directionNumber, result.stopCode)
+		metrics.finish("departures", started)
+		result.setDepartures(departures, count, nowTime)
+	except NextBusError as lookupError:
+		result.setError(lookupError.errorKind, str(lookupError), lookupError.itemKind, lookupError.matches)
+	except IOError:
+		result.setError(errorNetwork, "NETWORK ERROR")
+	except Exception:
+		result.setError(errorUnknown, "UNKNOWN ERROR")
+	metrics.count("results", result.errorKind or "OK")
+	metrics.finish("query", queryStarted)
+	return result
+
+class NextBusRequestHandler(http.server.BaseHTTPRequestHandler):
+	"""
+	Answers HTTP requests for NextBusServer:
+		GET /nextbus?route=...&stop=...&direction=...	the nextBus result as plain text
+		(add format=json, or send "Accept: application/json", for a JSON object instead,
+		which also has the NextBusResult for the query under "details")
+		GET /stats		request counts, latencies and cache statistics as JSON, including
+				the most asked bad queries and the clients that send the most of them
+		GET /metrics		per-stage latency histograms and counters (see Metrics) in the
+				Prometheus text format
+	Every response has an X-Response-Time header with the time taken to answer it.
+	"""
+	protocol_version = "HTTP/1.1"		# keep-alive, so scripts can send many queries over one connection
+	
+	def do_GET(self):
+		started = time.perf_counter()
+		urlParts = urllib.parse.urlsplit(self.path)
+		query = urllib.parse.parse_qs(urlParts.query, keep_blank_values = True)
+		wantsJson = query.get("format", [ "" ])[0].lower() == "json" or "application/json" in self.headers.get("Accept", "")
+		if urlParts.path == "/stats":
+			status, body = 200, self.server.stats()
+			wantsJson = True
+		elif urlParts.path == "/metrics":
+			status, body = 200, { 'result': metrics.prometheus().rstrip("\n") }
+			wantsJson = False
+		elif urlParts.path in ("/", "/nextbus"):
+			route, stop, direction = [ query.get(name, [ None ])[0] for name in ("route", "stop", "direction") ]
+			body = { 'route': route, 'stop': stop, 'direction': direction }
+			if route is None or stop is None or direction is None:
+				status, body['result'] = 400, "PARAMETER ERROR"
+			else:
+				result = nextBusResult(route, stop, direction)
+				status, body['result'], body['details'] = 200, result.text(), result.toDict()
+				if result.errorKind in (errorNoMatch, errorMultipleMatches): self.server.badQueryClients.add(self.client_address[0])
+		else:
+			status, body = 404, { 'result': "NOT FOUND" }
+		latency = time.perf_counter() - started
+		self.server.recordRequest(latency)
+		if status >= 400: self.server.badQueryClients.add(self.client_address[0])
+		if wantsJson:
+			body['latencyMs'] = round(latency * 1000.0, 3)
+			data = json.dumps(body).encode("utf-8")
+			contentType = "application/json; charset=utf-8"
+		else:
+			data = (body['result'] + "\n").encode("utf-8")
+			contentType = "text/plain; charset=utf-8"
+		self.send_response(status)
+		self.send_header("Content-Type", contentType)
+		self.send_header("Content-Length", str(len(data)))
+		self.send_header("X-Response-Time", "{:.3f}ms".format(latency * 1000.0))
+		self.end_headers()
+		self.wfile.write(data)
+		if self.server.logRequests:
+			self.log_message('"%s" %d %.3fms', self.requestline, status, latency * 1000.0)
+	
+	def log_request(self, code = "-", size = "-"):
+		pass		# do_GET logs each request itself, with its latency
+
+class NextBusServer(http.server.ThreadingHTTPServer):
+	"""
+	Long-running HTTP server that answers nextBus queries (see NextBusRequestHandler), so that
+	scripts can ask a warm process instead of starting Python for every query.  Connections
+	to Metro Transit, the service caches, match indexes and remembered resolutions all stay
+	warm between requests, and each client connection is handled on its own thread.
+	
+	Parameters
+	------------
+	serverAddress : tuple
+		(host, port) to listen on; port 0 picks a free port.
+	logRequests : boolean
+		(Optional) If true, each request and its latency is logged to standard error.
+	collectMetrics : boolean
+		(Optional) If true, turns on the module's Metrics, for /metrics and /stats.
+	"""
+	daemon_threads = True
+	
+	def __init__(self, serverAddress, logRequests = False, collectMetrics = True):
+		super().__init__(serverAddress, NextBusRequestHandler)
+		self.logRequests = logRequests
+		if collectMetrics: metrics.enable()
+		self.statsLock = threading.Lock()
+		self.started = time.time()
+		self.requestCount = 0
+		self.totalLatency = 0.0
+		self.maxLatency = 0.0
+		self.badQueryClients = TopCounter()		# client addresses sending bad or unmatched queries
+	
+	def recordRequest(self, latency):
+		""" counts a request and its latency in seconds """
+		with self.statsLock:
+			self.requestCount += 1
+			self.totalLatency += latency
+			self.maxLatency = max(self.maxLatency, latency)
+	
+	def stats(self):
+		""" returns the server's request and latency statistics, and the cache statistics, as a dictionary """
+		with self.statsLock:
+			averageLatency = self.totalLatency / self.requestCount if self.requestCount else 0.0
+			return { 'processId': os.getpid(), 'uptimeSeconds': round(time.time() - self.started, 3), 'requests': self.requestCount,
+				'averageLatencyMs': round(averageLatency * 1000.0, 3), 'maxLatencyMs': round(self.maxLatency * 1000.0, 3),
+				'serviceCache': serviceCache.stats(), 'resolutionCache': resolutionCache.stats(), 'serviceFlights': serviceFlights.stats(),
+				'upstream': upstream.stats(), 'negativeCache': negativeCacheStats(), 'topBadQueryClients': self.badQueryClients.top(), 'metrics': metrics.stats() }
+
+def crawlCatalogue(maxWorkers = 8, useCache = False):
+	"""
+	Fetches the whole Metro Transit catalogue: the route list, every route's directions, and
+	every direction's stops, several at a time, bypassing the caches unless useCache is True.
+	Returns a dictionary of results keyed by local path, for writeCatalogueSnapshot; raises an
+	IOError if any fetch fails.
+	"""
+	def fetch(localPath):
+		return withPriority(priorityBackground, getMetroTransitService, localPath, None, useCache)
+	results = { "/NexTrip/Routes": fetch("/NexTrip/Routes") }
+	with concurrent.futures.ThreadPoolExecutor(max_workers = maxWorkers) as executor:
+		directionPaths = [ "/NexTrip/Directions/" + thisRoute["Route"] for thisRoute in results["/NexTrip/Routes"] ]
+		results.update(zip(directionPaths, executor.map(fetch, directionPaths)))
+		stopPaths = [ "/NexTrip/Stops/" + thisPath.split("/")[-1] + "/" + thisDirection["Value"] for thisPath in directionPaths for thisDirection in results[thisPath] ]
+		results.update(zip(stopPaths, executor.map(fetch, stopPaths)))
+	return results
+
+def refreshCatalogueSnapshot(snapshotPath, maxWorkers = 8):
+	""" crawls the catalogue and atomically replaces the snapshot file; returns False, keeping the old snapshot, if the crawl fails """
+	try:
+		writeCatalogueSnapshot(snapshotPath, crawlCatalogue(maxWorkers))
+		return True
+	except IOError:
+		return False
+
+def resetAfterFork():
+	""" drops state that must not be shared with a parent process: pooled connections and the prefetch and hedge thread pools """
+	global prefetchExecutor, hedgeExecutor
+	transport.close()
+	if isinstance(asyncTransport, AsyncTransport): setAsyncTransport(AsyncTransport(asyncTransport.timeout, asyncTransport.poolSize, asyncTransport.maxRedirects))
+	prefetchExecutor = None
+	hedgeExecutor = None
+	upstream.reset()
+
+def servePreforked(serverAddress, processCount, snapshotPath, refreshInterval = 6 * 3600, logRequests = True, retryInterval = 60.0):
+	"""
+	Serves nextBus over HTTP like NextBusServer, but from processCount worker processes that
+	share one listening socket, so throughput scales with CPU cores.  The workers answer
+	routes, directions and stops from one memory-mapped catalogue snapshot instead of each
+	keeping its own copy.  One more process rebuilds the snapshot every refreshInterval seconds
+	and swaps it in atomically; the workers pick the new one up by themselves, or load it as
+	soon as it exists if there was none when they started.  Worker or
+	refresher processes that die are restarted.  Runs until interrupted or sent SIGTERM or
+	SIGHUP, and then stops the other processes too.  Needs os.fork, so it is not available
+	on Windows.
+	
+	Parameters
+	------------
+	serverAddress : tuple
+		(host, port) to listen on.
+	processCount : int
+		Number of worker processes.
+	snapshotPath : str
+		The catalogue snapshot file; it is built before the workers start if it doesn't exist
+		or can't be read.
+	refreshInterval : float
+		(Optional) Seconds between snapshot rebuilds.
+	retryInterval : float
+		(Optional) Seconds to wait before trying again after a rebuild fails, or when there is
+		no usable snapshot.
+	logRequests : boolean
+		(Optional) As for NextBusServer.
+	"""
+	if not hasattr(os, "fork"): raise OSError("pre-fork serving needs os.fork")
+	try:
+		CatalogueSnapshot(snapshotPath)
+	except (OSError, ValueError):
+		refreshCatalogueSnapshot(snapshotPath)		# missing, or from an older version
+	server = NextBusServer(serverAddress, logRequests)
+	children = { }		# process id -> ("worker" or "refresher", time started)
+	def runWorker():
+		awaitCatalogueSnapshot(snapshotPath)		# if there is no usable snapshot yet, use the service caches until the refresher builds one
+		server.serve_forever()
+	def runRefresher():
+		server.socket.close()
+		try:
+			CatalogueSnapshot(snapshotPath)
+			delay = refreshInterval
+		except (OSError, ValueError):
+			delay = 0.0		# the build at startup failed, so try again straight away
+		while True:
+			time.sleep(delay)
+			delay = refreshInterval if refreshCatalogueSnapshot(snapshotPath) else min(retryInterval, refreshInterval)
+	def startChild(role):
+		childId = os.fork()
+		if childId == 0:
+			exitCode = 0
+			try:
+				for thisSignal in stopSignals: signal.signal(thisSignal, signal.SIG_DFL)
+				resetAfterFork()
+				runWorker() if role == "worker" else runRefresher()
+			except KeyboardInterrupt:
+				pass
+			except BaseException:
+				exitCode = 1
+			finally:
+				os._exit(exitCode)
+		children[childId] = (role, time.time())
+	def stopServing(signalNumber, frame):
+		raise KeyboardInterrupt		# so that a service manager stopping us shuts the children down the same way Ctrl-C does
+	stopSignals = (signal.SIGTERM, signal.SIGHUP)
+	oldHandlers = { thisSignal: signal.signal(thisSignal, stopServing) for thisSignal in stopSignals }
+	try:
+		for workerNumber in range(processCount): startChild("worker")
+		startChild("refresher")
+		while True:
+			childId, exitStatus = os.wait()
+			role, childStarted = children.pop(childId, (None, 0))
+			if role is None: continue
+			if time.time() - childStarted < 1.0: time.sleep(1.0)		# don't spin if a child keeps failing at startup
+			startChild(role)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		for thisSignal in stopSignals: signal.signal(thisSignal, oldHandlers[thisSignal])
+		for childId in children:
+			try:
+				os.kill(childId, signal.SIGTERM)
+			except OSError:
+				pass
+		for childId in children:
+			try:
+				os.waitpid(childId, 0)
+			except OSError:
+				pass
+		server.server_close()
+
+def parseCommandLine(arguments, flagOptions, valueOptions):
+	"""
+	Separates command-line options from the positional parameters.
+	
+	Parameters
+	------------
+	arguments : list
+		The command-line arguments, not including the program name.
+	flagOptions : list
+		Options that take no value, e.g. "--no-cache".
+	valueOptions : list
+		Options followed by a value, given as "--cache-dir DIR" or "--cache-dir=DIR".
+	
+	Returns
+	--------
+	tuple
+		(options, positional): a dictionary of the options found (True for flag options), and
+		a list of the remaining parameters.  Arguments that aren't known options, like "--help",
+		are left in the positional list.  Raises a ValueError if an option is missing its value.
+	"""
+	options = { }
+	positional = [ ]
+	argumentIterator = iter(arguments)
+	for thisArgument in argumentIterator:
+		optionName, equalsSign, optionValue = thisArgument.partition("=")
+		if thisArgument in flagOptions:
+			options[thisArgument] = True
+		elif optionName in valueOptions and equalsSign:
+			options[optionName] = optionValue
+		elif thisArgument in valueOptions:
+			optionValue = next(argumentIterator, None)
+			if optionValue is None: raise ValueError("missing value for " + thisArgument)
+			options[thisArgument] = optionValue
+		else:
+			positional.append(thisArgument)
+	return options, positional
+
 #
 #	Main program, for when the program is used independently on the command-line
 #
 if __name__ == "__main__":
-	import sys
 	helpText = """
-	Example Command-Line: nextbus.py "bus-route" "bus-stop-name" "direction"
+	Example Command-Line: nextbus.py [options] "bus-route" "bus-stop-name" "direction"
 	
 	bus-route:
 		should be a unique substring of the name of the bus route you want
@@ -273,8 +3615,132 @@ if __name__ == "__main__":
 		must be east, north, south, or west (case-insensitive)
 		If you put #any, it lists all the directions for that route in the 
 		resulting error message
+	
+	options:
+		--no-cache		don't use the on-disk cache of routes, directions and stops
+		--cache-dir DIR		keep the on-disk cache in DIR (default: ~/.cache/nextbus)
+		--batch FILE		answer every query in FILE, or standard input if FILE
+					is -, one per line, as CSV (route,stop,direction)
+					or JSON lines; prints one result line per query
+		--workers N		departure lookups done at once in batch or board
+					mode (default 8)
+		--serve PORT		run as a local HTTP server on PORT; query it with
+					GET /nextbus?route=...&stop=...&direction=...
+		--host HOST		address for --serve to listen on (default 127.0.0.1)
+		--processes N		with --serve, run N worker processes sharing one
+					memory-mapped catalogue snapshot (not on Windows)
+		--catalogue FILE	catalogue snapshot file (default: catalogue.snapshot
+					in the cache directory); names are looked up in it,
+					if it has been built, instead of asking Metro Transit
+		--build-catalogue	crawl all routes, directions and stops and write
+					the catalogue snapshot file (run it nightly)
+		--board			print a departure board instead: the arguments are
+					ROUTE/DIRECTION/STOP codes, e.g. 21/2/SNUN 4/1/LALY,
+					and it prints the next departures on any of them
+		--count N		number of departures --board prints, or stops
+					--find-stop prints (default 10)
+		--find-stop		find stops anywhere in the network instead: the
+					arguments are part of a stop's name or its code,
+					and it prints the routes and directions serving each
+		--watch			keep watching the stop, printing a new line each
+					time the result changes (press Ctrl-C to stop)
+		--profile		print how long each stage of the work took, and
+					the service calls and cache hits, to standard error
+		--record FILE		save Metro Transit's responses to the cassette FILE
+		--replay FILE		answer from the responses in the cassette FILE
+					instead of asking Metro Transit
 	"""
-	if (len(sys.argv)<2):
+	try:
+		options, arguments = parseCommandLine(sys.argv[1:], [ "--no-cache", "--watch", "--board", "--build-catalogue", "--find-stop", "--profile" ], [ "--cache-dir", "--batch", "--workers", "--count", "--serve", "--host", "--processes", "--catalogue", "--record", "--replay" ])
+		workers = int(options.get("--workers", 8))
+		if workers < 1: raise ValueError("--workers must be at least 1")
+		servePort = int(options["--serve"]) if "--serve" in options else None
+		processCount = int(options.get("--processes", 1))
+		if processCount < 1: raise ValueError("--processes must be at least 1")
+		boardCount = int(options.get("--count", 10))
+		boardEntries = [ parseBoardEntry(thisArgument) for thisArgument in arguments ] if "--board" in options else None
+		if "--replay" in options: setTransport(ReplayTransport(options["--replay"]))
+	except (ValueError, OSError):
+		print("PARAMETER ERROR: " + helpText)
+		exit(1)
+	if "--record" in options:
+		recorder = RecordingTransport(transport)
+		setTransport(recorder)
+		atexit.register(recorder.cassette.save, options["--record"])		# however the program ends
+	if "--profile" in options:
+		metrics.enable()
+		atexit.register(lambda: print(metrics.profile(), file = sys.stderr))		# however the program ends
+	if "--no-cache" not in options:
+		try:
+			enableDiskCache(options.get("--cache-dir"))
+		except (OSError, sqlite3.Error):
+			pass		# the cache is only an optimization, so carry on without it
+	snapshotPath = options.get("--catalogue", os.path.join(options.get("--cache-dir", defaultCacheDir()), "catalogue.snapshot"))
+	if "--build-catalogue" in options:
+		os.makedirs(os.path.dirname(os.path.abspath(snapshotPath)), exist_ok = True)
+		if not refreshCatalogueSnapshot(snapshotPath, workers):
+			print("NETWORK ERROR")
+			exit(1)
+		snapshotStats = CatalogueSnapshot(snapshotPath).stats()
+		print("Catalogue written to " + snapshotPath + ": " + str(snapshotStats['results']) + " results, " + str(snapshotStats['records']) + " records, "
+			+ str(snapshotStats['strings']) + " distinct strings, " + str(os.path.getsize(snapshotPath)) + " bytes")
+		exit(0)
+	if servePort is None or processCount == 1:
+		if "--catalogue" in options:
+			try:
+				useCatalogueSnapshot(snapshotPath)
+			except (OSError, ValueError):
+				print("PARAMETER ERROR: " + helpText)
+				exit(1)
+		else:
+			useFreshCatalogueSnapshot(snapshotPath)		# names are resolved from it, if it has been built, without any service calls
+	if servePort is not None:
+		serverAddress = (options.get("--host", "127.0.0.1"), servePort)
+		if processCount > 1:
+			print("NextBus serving at http://" + serverAddress[0] + ":" + str(serverAddress[1]) + "/nextbus with " + str(processCount) + " processes", flush = True)
+			os.makedirs(os.path.dirname(os.path.abspath(snapshotPath)), exist_ok = True)
+			servePreforked(serverAddress, processCount, snapshotPath)
+			exit(0)
+		server = NextBusServer(serverAddress, logRequests = True)
+		print("NextBus serving at http://" + server.server_address[0] + ":" + str(server.server_address[1]) + "/nextbus", flush = True)
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			server.server_close()
+		exit(0)
+	elif "--batch" in options:
+		try:
+			batchFile = sys.stdin if options["--batch"] == "-" else open(options["--batch"], encoding = "utf-8")
+		except OSError:
+			print("PARAMETER ERROR: " + helpText)
+			exit(1)
+		def batchQueries():
+			for thisLine in batchFile:
+				try:
+					thisQuery = parseBatchLine(thisLine)
+				except ValueError:
+					thisQuery = None		# reported as PARAMETER ERROR, keeping one output line per input line
+				if thisLine.strip() != "": yield thisQuery
+		for thisResult in nextBusBatch(batchQueries(), workers):
+			print(thisResult, flush = True)
+		exit(0)
+	elif boardEntries is not None:
+		departures, failedEntries = departureBoard(boardEntries, boardCount, maxWorkers = workers)
+		for thisDeparture in departures:
+			print(formatBoardLine(thisDeparture))
+		if failedEntries: print("NETWORK ERROR: " + ", ".join("/".join(thisEntry) for thisEntry in failedEntries))
+		exit(0)
+	elif "--find-stop" in options:
+		try:
+			os.makedirs(os.path.dirname(os.path.abspath(snapshotPath)), exist_ok = True)
+			foundStops = getStopIndex(snapshotPath = snapshotPath).search(" ".join(arguments), boardCount)		# a crawl is saved for next time
+		except IOError:
+			print("NETWORK ERROR")
+			exit(1)
+		for thisStop in foundStops:
+			print(thisStop.code + "\t" + thisStop.name.strip() + ": " + ", ".join(thisService[0] + "/" + thisService[1] + " " + thisService[2] for thisService in thisStop.servedBy))
+		exit(0)
+	elif (len(arguments)<1):
 		# Special Case: Some web-based python viewers don't have 
 		# command lines, so we just prompt for the parameters.
 		while True:
@@ -289,12 +3755,19 @@ if __name__ == "__main__":
 			print ("")
 			print (nextBus(route, stop, direction))
 			print ("")
-	elif sys.argv[1] == "/?" or sys.argv[1].upper()[0:3] == "--H" or sys.argv[1].upper()[0:2] == "/H":
+	elif arguments[0] == "/?" or arguments[0].upper()[0:3] == "--H" or arguments[0].upper()[0:2] == "/H":
 		print(helpText)
 		exit(0)
-	elif len(sys.argv) != 4:
+	elif len(arguments) != 3:
 		print("PARAMETER ERROR: " + helpText)
 		exit(1)
+	elif "--watch" in options:
+		try:
+			for thisResult in NextBusWatch(arguments[0], arguments[1], arguments[2]).changes():
+				print(thisResult.text(), flush = True)
+		except KeyboardInterrupt:
+			pass
+		exit(0)
 	else:
-		print(nextBus(sys.argv[1],sys.argv[2],sys.argv[3]))
+		print(nextBus(arguments[0],arguments[1],arguments[2]))
 		exit(0)
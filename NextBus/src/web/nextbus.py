@@ -13,6 +13,11 @@
 #
 #	Interface: Command-Line
 #
+#	This is the copy run in the browser by nextbus.htm under Brython, with web/requests.py standing
+#	in for requests.  It stays at the original single-lookup version of the program: ../nextbus.py
+#	has since added connection pooling, caching, servers and asyncio, which Brython can't run.
+#	Fixes to lookups or formatting there have to be copied here by hand if the web page needs them.
+#
 #	External dependencies:	requests
 #		Install this dependency by using: pip install requests
 #	Standard libraries:		time, sys
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+#
+#	nextbus_stub.py
+#	Local stub of the Metro Transit NexTrip service, used by the NextBus unit tests
+#	so they can exercise the whole program without the network.
+#
+#	The stub serves a small fixed network (a few routes, their directions and stops)
+#	in the same JSON format as http://svc.metrotransit.org, and departures that are
+#	generated relative to the current time, so minutesTillBus gives predictable answers.
+#	Or, given a cassette recorded from the real service (see nextbus.RecordingTransport
+#	and nextbus.py --record), it serves the recorded responses instead.  Either way it can
+#	add latency and errors (see delay, errorRate and addFault).
+#
+#	Example:
+#		stub = nextbus_stub.StubServer().start()
+#		nextbus.metroTransitServiceUrl = stub.url
+#		...
+#		stub.stop()
+#
+#	To serve a cassette from the command line: python nextbus_stub.py CASSETTE-FILE
+#
+#	Dependencies: standard library only, and nextbus.py for cassettes
+#
+
+import collections
+import http.server
+import json
+import random
+import sys
+import threading
+import time
+
+#-- Fixture data, in Metro Transit format.  Note the double spaces, which the real service also has.
+stubRoutes = [
+	{ 'Description': '4 - Lyndale Av - Bryant Av - Johnson St NE', 'ProviderID': '8', 'Route': '4' },
+	{ 'Description': '14 - Robbinsdale-West Broadway-Bloomington Av', 'ProviderID': '8', 'Route': '14' },
+	{ 'Description': '21 - Uptown - Lake St - Selby  Av', 'ProviderID': '8', 'Route': '21' },
+	{ 'Description': '121 - U of M - Campus Connector', 'ProviderID': '8', 'Route': '121' },
+	{ 'Description': '535 - Express - Richfield - 35W - Mpls', 'ProviderID': '8', 'Route': '535' } ]
+
+stubDirections = {
+	'4': [ { 'Text': 'SOUTHBOUND', 'Value': '1' }, { 'Text': 'NORTHBOUND', 'Value': '4' } ],
+	'14': [ { 'Text': 'SOUTHBOUND', 'Value': '1' }, { 'Text': 'NORTHBOUND', 'Value': '4' } ],
+	'21': [ { 'Text': 'EASTBOUND', 'Value': '2' }, { 'Text': 'WESTBOUND', 'Value': '3' } ],
+	'121': [ { 'Text': 'EASTBOUND', 'Value': '2' }, { 'Text': 'WESTBOUND', 'Value': '3' } ],
+	'535': [ { 'Text': 'SOUTHBOUND', 'Value': '1' }, { 'Text': 'NORTHBOUND', 'Value': '4' } ] }
+
+stubStops = {
+	('4', '1'): [ { 'Text': 'Franklin Ave and Lyndale Ave', 'Value': 'FRLY' }, { 'Text': 'Lyndale Ave  and Lake St', 'Value': 'LALY' },
+		{ 'Text': '39th Ave and Silver Lake Rd', 'Value': '39SL' }, { 'Text': 'Silver Lake Village ', 'Value': 'SLVI' } ],
+	('4', '4'): [ { 'Text': 'Lake St and Lyndale Ave', 'Value': 'LKLY' }, { 'Text': 'Lyndale Ave and Franklin Ave', 'Value': 'LYFR' } ],
+	('14', '1'): [ { 'Text': 'Bloomington Ave and Lake St', 'Value': 'BLLA' }, { 'Text': 'Broadway Ave and Penn Ave', 'Value': 'BRPE' } ],
+	('14', '4'): [ { 'Text': 'Lake St and Bloomington Ave', 'Value': 'LABL' } ],
+	('21', '2'): [ { 'Text': 'Uptown Transit Station', 'Value': 'UPTR' }, { 'Text': 'Snelling Ave and University Ave', 'Value': 'SNUN' },
+		{ 'Text': 'Lake St and Lyndale Ave', 'Value': 'LALY' } ],
+	('21', '3'): [ { 'Text': 'University Ave and Snelling Ave', 'Value': 'UNSN' }, { 'Text': 'Lake St and Lyndale Ave', 'Value': 'LALY' } ],
+	('121', '2'): [ { 'Text': 'Washington Ave and Church St', 'Value': 'WACH' } ],
+	('121', '3'): [ { 'Text': 'Church St and Washington Ave', 'Value': 'CHWA' } ],
+	('535', '1'): [ { 'Text': 'Marquette Ave and 4th St', 'Value': 'MA4S' } ],
+	('535', '4'): [ { 'Text': '2nd Ave and 7th St', 'Value': '7S2A' } ] }
+
+#-- Default departures: seconds from now for each (route, direction, stop); stops not listed have no more buses today
+stubDepartureOffsets = {
+	('4', '1', 'FRLY'): [ 300, 1200, 2400 ],
+	('4', '1', 'LALY'): [ -60, 420, 1500 ],
+	('21', '2', 'SNUN'): [ 90, 1000 ],
+	('21', '3', 'UNSN'): [ 600 ],
+	('14', '1', 'BLLA'): [ 30, 900 ],
+	('535', '1', 'MA4S'): [ 2700 ] }
+
+def departureTimeText(epochSeconds):
+	""" formats a time the way Metro Transit does in DepartureTime, e.g. /Date(1533081600000-0500)/ """
+	return "/Date({:.0f}-0500)/".format(epochSeconds * 1000.0)
+
+def departureRecord(route, directionText, secondsFromNow, nowTime = None, actual = True, blockNumber = 1000):
+	""" builds one departure record in Metro Transit format, leaving out the vehicle location fields """
+	if nowTime is None: nowTime = time.time()
+	minutes = int(round(secondsFromNow / 60.0))
+	if not actual:
+		departureText = time.strftime("%H:%M", time.localtime(nowTime + secondsFromNow)).lstrip("0")
+	elif minutes <= 0:
+		departureText = "Due"
+	else:
+		departureText = str(minutes) + " Min"
+	return { 'Actual': actual, 'BlockNumber': blockNumber, 'DepartureText': departureText, 'DepartureTime': departureTimeText(nowTime + secondsFromNow),
+		'Description': route, 'Gate': '', 'Route': route, 'RouteDirection': directionText, 'Terminal': '' }
+
+#-- Path prefix that redirect faults send requests to; the stub serves it as if it weren't there
+movedPrefix = "/Moved"
+
+class StubRequestHandler(http.server.BaseHTTPRequestHandler):
+	""" answers NexTrip paths from the fixture data of the server that owns it """
+	protocol_version = "HTTP/1.1"		# so that keep-alive connections can be tested
+
+	def setup(self):
+		super().setup()
+		with self.server.stub.lock:
+			self.server.stub.connectionCount += 1
+
+	def log_message(self, format, *args):
+		pass		# keep unit test output clean
+
+	def do_GET(self):
+		stub = self.server.stub
+		path = self.path.split("?")[0]
+		while path.startswith(movedPrefix): path = path[len(movedPrefix):]		# where redirects send requests
+		with stub.lock:
+			stub.requestCounts[self.path.split("?")[0]] += 1
+			fault = stub.faults.popleft() if stub.faults else None
+			if fault is None and stub.errorRate > 0 and stub.random.random() < stub.errorRate: fault = ("error", 0.0, 503)
+		if stub.delay > 0: time.sleep(stub.delay)
+		if fault is not None and fault[0] == "stall": time.sleep(fault[1])
+		if fault is not None and fault[0] == "drop":
+			self.close_connection = True		# hang up without answering
+			return
+		if fault is not None and fault[0] == "error":
+			status, body = fault[2], { 'Message': 'An error has occurred.' }
+		elif fault is not None and fault[0] == "redirect":
+			status, body = fault[2], { 'Message': 'Moved.' }
+		else:
+			status, body = stub.respond(path)
+		self.send_response(status)
+		if fault is not None and fault[0] == "redirect":
+			self.send_header("Location", movedPrefix + self.path)
+		if status in (204, 304):
+			self.end_headers()		# no body, and no Content-Length to say so
+			return
+		data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+		self.send_header("Content-Type", "application/json; charset=utf-8")
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+class StubServer:
+	"""
+	A NexTrip stub server on a free local port, running in a background thread.
+
+	Attributes
+	------------
+	url : str
+		The base URL to put in nextbus.metroTransitServiceUrl.
+	departureOffsets : dict
+		Seconds from now of each departure, keyed by (route, direction, stop); change it to change departures.
+	delay : float
+		Seconds to wait before answering each request.
+	errorRate : float
+		Fraction of requests, chosen at random (but the same ones each run), answered with a 503 error.
+	requestCounts : collections.Counter
+		Number of requests received for each path, including movedPrefix for redirected ones.
+	connectionCount : int
+		Number of TCP connections accepted.
+	faults : collections.deque
+		Faults to inject, one per request, in order (see addFault).
+	cassette : nextbus.Cassette
+		Recorded responses served instead of the fixture data, or None.
+	"""
+	def __init__(self, cassette = None):
+		self.lock = threading.Lock()
+		self.departureOffsets = dict(stubDepartureOffsets)
+		self.delay = 0.0
+		self.errorRate = 0.0
+		self.random = random.Random(0)
+		if isinstance(cassette, str):
+			import nextbus
+			cassette = nextbus.Cassette.load(cassette)
+		self.cassette = cassette
+		self.requestCounts = collections.Counter()
+		self.connectionCount = 0
+		self.faults = collections.deque()
+		self.httpServer = None
+		self.thread = None
+		self.url = None
+
+	def respond(self, path):
+		""" returns (HTTP status, JSON body) for a NexTrip path; a body from a cassette is already encoded """
+		if self.cassette is not None:
+			answer = self.cassette.play(path)
+			if answer is not None: return answer
+			return 404, { 'Message': 'No HTTP resource was found' }
+		parts = path.strip("/").split("/")
+		if len(parts) < 2 or parts[0] != "NexTrip": return 404, { 'Message': 'No HTTP resource was found' }
+		if parts[1:] == [ "Routes" ]: return 200, stubRoutes
+		if len(parts) == 3 and parts[1] == "Directions":
+			if parts[2] in stubDirections: return 200, stubDirections[parts[2]]
+			return 400, { 'Message': 'The request is invalid.' }
+		if len(parts) == 4 and parts[1] == "Stops":
+			if not parts[3].isdigit(): return 400, { 'Message': 'The request is invalid.' }
+			return 200, stubStops.get((parts[2], parts[3]), [ ])
+		if len(parts) == 4 and parts[3].upper() == parts[3]:
+			route, direction, stop = parts[1:]
+			if not direction.isdigit(): return 400, { 'Message': 'The request is invalid.' }
+			directionText = ""
+			for thisDirection in stubDirections.get(route, [ ]):
+				if thisDirection['Value'] == direction: directionText = thisDirection['Text']
+			nowTime = time.time()
+			return 200, [ departureRecord(route, directionText, offset, nowTime, blockNumber = 1000 + i)
+				for i, offset in enumerate(self.departureOffsets.get((route, direction, stop), [ ])) ]
+		return 404, { 'Message': 'No HTTP resource was found' }
+
+	def addFault(self, kind, count = 1, seconds = 0.0, status = 503):
+		"""
+		Makes the next count requests misbehave: kind "stall" answers normally but only after
+		waiting seconds, "error" answers with the HTTP status (with no body for 204 or 304),
+		"redirect" answers with the HTTP status and a Location of the same path under
+		movedPrefix, and "drop" closes the connection without answering.
+		"""
+		with self.lock:
+			for i in range(count): self.faults.append((kind, seconds, status))
+	
+	def start(self):
+		""" starts serving on 127.0.0.1 and returns the server itself """
+		self.httpServer = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubRequestHandler)
+		self.httpServer.daemon_threads = True
+		self.httpServer.stub = self
+		self.url = "http://127.0.0.1:" + str(self.httpServer.server_address[1])
+		self.thread = threading.Thread(target = self.httpServer.serve_forever, daemon = True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		""" shuts the server down """
+		if self.httpServer is not None:
+			self.httpServer.shutdown()
+			self.httpServer.server_close()
+			self.httpServer = None
+
+	def reset(self):
+		""" forgets request and connection counts and faults, and restores the default departures, delay and error rate """
+		with self.lock:
+			self.faults.clear()
+			self.requestCounts.clear()
+			self.connectionCount = 0
+			self.delay = 0.0
+			self.errorRate = 0.0
+			self.random = random.Random(0)
+			self.departureOffsets = dict(stubDepartureOffsets)
+
+if __name__ == "__main__":
+	stub = StubServer(sys.argv[1] if len(sys.argv) > 1 else None).start()
+	print("NexTrip stub serving at " + stub.url + " (press Ctrl-C to stop)")
+	try:
+		while True: time.sleep(3600)
+	except KeyboardInterrupt:
+		stub.stop()
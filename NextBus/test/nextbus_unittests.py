@@ -21,18 +21,59 @@
 #	Dependencies: unittest, json, time, math, requests
 #		You may have to install json by using "pip install json"
 #		You may have to install requests by uisng "pip install requests"
+#
+#	The TestNextBusOffline tests run against a local stub of the Metro Transit
+#	service (nextbus_stub.py, which must be in the same folder), so they
+#	work without the network.
+#	The stub can also serve a cassette of real responses recorded with
+#	nextbus.py --record, and nextbus.ReplayTransport plays cassettes back
+#	without any server at all.
+#
+#	The TestNextBus tests go to the live service, unless NEXTBUS_REPLAY names
+#	a cassette to answer from instead, such as the nextbus_cassette.json
+#	beside this file:
+#		NEXTBUS_REPLAY=nextbus_cassette.json python nextbus_unittests.py
+#	NEXTBUS_RECORD=FILE runs them live and saves what was fetched to FILE,
+#	including the Metro Transit web pages, for replaying later.
 #		
 
+import os
+import sys
 import time
+import signal
+import socket
+import asyncio
+import threading
+import tempfile
+import tracemalloc
+import subprocess
 import nextbus
+import nextbus_stub
 import unittest
 import json
 import requests
 
 class TestNextBus(unittest.TestCase):
 
+	@classmethod
+	def setUpClass(cls):
+		# see NEXTBUS_REPLAY and NEXTBUS_RECORD at the top of this file
+		cls.savedTransport = None
+		cls.recorder = None
+		if os.environ.get("NEXTBUS_REPLAY"):
+			cls.savedTransport = nextbus.setTransport(nextbus.ReplayTransport(os.environ["NEXTBUS_REPLAY"]))
+		elif os.environ.get("NEXTBUS_RECORD"):
+			cls.recorder = nextbus.RecordingTransport(nextbus.transport)
+			cls.savedTransport = nextbus.setTransport(cls.recorder)
+		nextbus.invalidateServiceCache()
+
+	@classmethod
+	def tearDownClass(cls):
+		if cls.recorder is not None: cls.recorder.cassette.save(os.environ["NEXTBUS_RECORD"])
+		if cls.savedTransport is not None: nextbus.setTransport(cls.savedTransport)
+
 	def same_json(self, a,b):
-		return json.dumps(a) == json.dumps(b)
+		return json.dumps(a, default = nextbus.serviceRecordJson) == json.dumps(b, default = nextbus.serviceRecordJson)
 		
 	def mock_time_value(self, testValue, nowTime = None):
 		# returns a fake JSON timestamp to help test the timestamp portion
@@ -57,10 +98,11 @@ class TestNextBus(unittest.TestCase):
 			self.assertEqual(a,b)
 
 	def displayMetroTransitUITime(self, route, direction, stop):
-		# some tests use the Metro Transit user-facing website to see if we get the same answer for next bus
-		result = requests.get("https://www.metrotransit.org/NexTripBadge.aspx", params = { 'route': route, 'direction': direction, 'stop': stop })
+		# some tests use the Metro Transit user-facing website to see if we get the same answer for next bus;
+		# it is fetched through nextbus's transport so that it is recorded and replayed with the service
+		result = nextbus.transport.get("https://www.metrotransit.org/NexTripBadge.aspx", params = { 'route': route, 'direction': direction, 'stop': stop }, timeout = (3.05, 10.0))
 		if not result.ok: raise IOError
-		html = result.text
+		html = result.content.decode("utf-8")
 		startTag = '<b class="countdown">'
 		findNextBusIndex = html.find(startTag)
 		if findNextBusIndex >= 0:
@@ -101,6 +143,26 @@ class TestNextBus(unittest.TestCase):
 		self.assertEqual(json.dumps(nextbus.extractMatches(testList, 'name', '#ANY')).replace(" ",""), json.dumps(testList).replace(" ",""))
 		self.assertEqual(json.dumps(nextbus.extractMatches(testList, 'name', 'Lake')).replace(" ",""), '[{"name":"14-BloomingtonLake","value":"4"},{"name":"21-LakeMarshall","value":"7"}]')
 		
+	def test_matchIndex(self):
+		def scanMatches(allItems, matchField, substring):
+			# the original linear scan, which the index must agree with
+			if substring[0:1] == "#":
+				prefix = nextbus.suppressMultipleSpaces(substring[1:].upper() + " ")
+				return [ thisItem for thisItem in allItems if nextbus.suppressMultipleSpaces(thisItem[matchField].upper()).find(prefix) == 0 ]
+			return [ thisItem for thisItem in allItems if nextbus.suppressMultipleSpaces(thisItem[matchField].upper()).find(nextbus.suppressMultipleSpaces(substring.upper())) != -1 ]
+		testList = [ { 'name': '4 - Lyndale Bryant' }, { 'name': '14 - Bloomington  Lake' }, { 'name': '21 - Lake   Marshall' }, { 'name': '6 - Hennepin to 34th' },
+			{ 'name': '21A - Lake St' }, { 'name': 'Silver Lake Village ' }, { 'name': ' 21 leading space' }, { 'name': '4' } ]
+		index = nextbus.MatchIndex(testList, 'name')
+		for substring in [ "Lake", "LAKE  MARSHALL", "lake marshall", "ke M", "4", "#4", "#14", "#21", "#21 -", "#21  - lake", "# 21", "#", "", " ", "e ", "Village ", "Village  ", "#21A", "xyz", "#xyz", "34TH" ]:
+			with self.subTest(substring=substring):
+				self.assertEqual(index.find(substring), scanMatches(testList, 'name', substring))
+				self.assertEqual(nextbus.extractMatches(testList, 'name', substring), scanMatches(testList, 'name', substring))
+		self.assertIs(index.find("#any"), testList)
+		serviceList = nextbus.ServiceList(testList)
+		self.assertIs(nextbus.getMatchIndex(serviceList, 'name'), nextbus.getMatchIndex(serviceList, 'name'))    # built once per service result
+		self.assertIsNot(nextbus.getMatchIndex(testList, 'name'), nextbus.getMatchIndex(testList, 'name'))    # and not kept for other lists
+		self.assertIsInstance(nextbus.decodeServiceJson('[{"name": "4"}]'), nextbus.ServiceList)
+
 	def test_getRouteMatches(self):
 		self.assertTrue(self.same_json(nextbus.getRouteMatches("Plymouth - Annapolis"), [{'Description': '741 - Plymouth - Annapolis - Campus Dr - Station 73', 'ProviderID': '10', 'Route': '741'}]))
 		for i in [4,6,10,21,54,14,535]: 
@@ -178,6 +240,30 @@ class TestNextBus(unittest.TestCase):
 		testArray3 = [{'DepartureTime': self.mock_time_value(-30), 'Field': 37}, {'DepartureTime': self.mock_time_value(-20), 'Field': 64}]
 		self.assertEqual(len(nextbus.getNextBusRecord(testArray3)), 0)
 
+	def test_departureTimes(self):
+		self.assertEqual(nextbus.parseDepartureTime("/Date(1533081600000-0500)/"), (1533081600000, -300))
+		self.assertEqual(nextbus.parseDepartureTime("/Date(1533081600000+0130)/"), (1533081600000, 90))
+		self.assertEqual(nextbus.parseDepartureTime("/Date(1533081600000)/"), (1533081600000, 0))
+		nowTime = round(time.time(), 3)
+		testArray = [ { 'DepartureTime': self.mock_time_value(offset, nowTime), 'Field': offset } for offset in [ -120, -30, 0, 45, 90, 600 ] ]
+		testArray = nextbus.ServiceList(testArray)
+		departureTimes = nextbus.decodeDepartures(testArray)
+		self.assertIs(nextbus.decodeDepartures(testArray), departureTimes)    # parsed once per service result
+		self.assertIs(testArray.departureTimes, departureTimes)
+		self.assertEqual(departureTimes.offsetMinutes, -300)
+		self.assertEqual(departureTimes.nextIndex(nowTime), 3)
+		self.assertEqual(departureTimes.upcomingIndexes(nowTime, 2), [ 3, 4 ])
+		self.assertEqual(departureTimes.upcomingIndexes(nowTime - 60), [ 1, 2, 3, 4, 5 ])
+		self.assertIsNone(departureTimes.nextIndex(nowTime + 601))
+		self.assertEqual(departureTimes.formatDeparture(4, nowTime), nextbus.formatTimepoint(testArray[4], nowTime))
+		self.assertAlmostEqual(departureTimes.minutesTill(5, nowTime), nextbus.minutesTillBus(testArray[5], nowTime), 9)
+		self.assertEqual(nextbus.getNextBusRecord(testArray, nowTime)[0]['Field'], 45)
+		unsortedArray = [ testArray[5], testArray[0], testArray[3] ]
+		self.assertEqual(nextbus.getNextBusRecord(unsortedArray, nowTime)[0]['Field'], 600)    # list order, as always
+		self.assertEqual(nextbus.decodeDepartures(unsortedArray).upcomingIndexes(nowTime), [ 0, 2 ])
+		self.assertEqual(nextbus.formatNextBus(testArray, False, nowTime), "1 Minute")
+		self.assertEqual(nextbus.formatNextBus(testArray[0:3], False, nowTime), "")
+
 	def test_commaList(self):
 		testList = [ { 'name': '4 - Lyndale Bryant', 'value': '3' }, {'name': '14 - Bloomington Lake', 'value': '4'}, {'name': '21 - Lake Marshall', 'value': '7'}, { 'name': '6 - Hennepin to 34th', 'value': '10' } ];
 		self.assertEqual(nextbus.commaList(testList, 'name'), "4 - Lyndale Bryant, 14 - Bloomington Lake, 21 - Lake Marshall, 6 - Hennepin to 34th")
@@ -226,6 +312,847 @@ class TestNextBus(unittest.TestCase):
 					# other values cause a test failure
 					self.fail("test type was not valid")
 
+class TestNextBusOffline(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.stub = nextbus_stub.StubServer().start()
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.stub.stop()
+
+	def setUp(self):
+		self.stub.reset()
+		self.savedServiceUrl = nextbus.metroTransitServiceUrl
+		self.savedTransport = nextbus.setTransport(nextbus.PooledTransport())
+		nextbus.metroTransitServiceUrl = self.stub.url
+		nextbus.invalidateServiceCache()
+		nextbus.upstream.reset()
+		nextbus.metrics.enable(False)
+		nextbus.metrics.reset()
+		nextbus.staleWhileRevalidate = False    # fetch departures every time, except in the tests that are about serving last-known ones
+		nextbus.upstream.hedging = False    # no duplicate requests when the stub is slow to schedule, except in the tests that are about hedging
+
+	def tearDown(self):
+		nextbus.staleWhileRevalidate = True
+		nextbus.upstream.hedging = True
+		nextbus.setTransport(self.savedTransport).close()
+		nextbus.setAsyncTransport(nextbus.AsyncTransport())
+		nextbus.metroTransitServiceUrl = self.savedServiceUrl
+
+	def runAsync(self, coroutine):
+		# runs a coroutine on a new event loop, closing the async transport's connections before the loop closes
+		async def runAndClose():
+			try:
+				return await coroutine
+			finally:
+				nextbus.asyncTransport.close()
+		return asyncio.run(runAndClose())
+
+	def test_pooledTransport(self):
+		self.assertEqual(nextbus.nextBus("#21", "Snelling", "east", True), "2 Min")
+		self.assertEqual(self.stub.connectionCount, 1)    # Routes, Directions, Stops and departures all share one connection
+		self.assertEqual(sum(self.stub.requestCounts.values()), 4)
+		with self.assertRaises(IOError):
+			nextbus.getMetroTransitService("/NexTrip/Unreal/Address")
+
+	def test_transportTimeout(self):
+		nextbus.setTransport(nextbus.PooledTransport(timeout = 0.2, retries = 0)).close()
+		self.stub.delay = 1.0
+		started = time.time()
+		with self.assertRaises(IOError):
+			nextbus.getMetroTransitService("/NexTrip/Routes")
+		self.assertLess(time.time() - started, 0.9)
+		self.assertEqual(nextbus.nextBus("#21", "Snelling", "east"), "NETWORK ERROR")
+
+	def test_upstreamHedging(self):
+		nextbus.upstream.hedging = True
+		nextbus.setTransport(nextbus.PooledTransport(retries = 0)).close()
+		for i in range(25):
+			nextbus.getMetroTransitService("/NexTrip/Routes", useCache = False)
+		self.assertEqual(nextbus.upstream.timeoutFor("routes"), nextbus.upstream.minTimeout)    # the stub is fast, so the shortest timeout
+		self.assertIsNone(nextbus.upstream.timeoutFor("departures"))    # no samples yet
+		self.stub.addFault("stall", seconds = 1.5)
+		started = time.time()
+		self.assertEqual(len(nextbus.getMetroTransitService("/NexTrip/Routes", useCache = False)), len(nextbus_stub.stubRoutes))
+		self.assertLess(time.time() - started, 0.9)    # the hedged copy answered, not the stalled first request
+		self.assertEqual((nextbus.upstream.hedges, nextbus.upstream.hedgeWins), (1, 1))
+		self.assertEqual(self.stub.requestCounts["/NexTrip/Routes"], 27)
+		stats = nextbus.upstream.stats()
+		self.assertEqual(stats["latency"]["routes"]["samples"], 26)
+		self.assertEqual(stats["breaker"]["state"], nextbus.circuitClosed)
+
+	def test_circuitBreaker(self):
+		nextbus.setTransport(nextbus.PooledTransport(retries = 0)).close()
+		clock = [ 0.0 ]
+		self.addCleanup(setattr, nextbus.upstream, "breaker", nextbus.upstream.breaker)
+		nextbus.upstream.breaker = nextbus.CircuitBreaker(failureThreshold = 3, resetTimeout = 30.0, clock = lambda: clock[0])
+		for i in range(5):
+			with self.assertRaises(IOError):
+				nextbus.getMetroTransitService("/NexTrip/Directions/999")    # an error answer, but the service is up
+		self.assertEqual(nextbus.upstream.breaker.state, nextbus.circuitClosed)
+		self.stub.addFault("error", count = 2, status = 503)
+		self.stub.addFault("drop")
+		for i in range(3):
+			with self.assertRaises(IOError):
+				nextbus.getMetroTransitService("/NexTrip/Routes")
+		self.assertEqual(nextbus.upstream.breaker.state, nextbus.circuitOpen)
+		started = time.time()
+		self.assertEqual(nextbus.nextBus("#21", "Snelling", "east"), "NETWORK ERROR")
+		self.assertLess(time.time() - started, 0.1)
+		self.assertEqual(self.stub.requestCounts["/NexTrip/Routes"], 3)    # refused without calling the service
+		clock[0] = 31.0
+		self.assertEqual(nextbus.nextBus("Bryant", "Franklin", "south"), "5 Minutes")    # the trial call succeeds and closes the circuit
+		self.assertEqual(nextbus.upstream.breaker.state, nextbus.circuitClosed)
+		self.assertEqual(nextbus.upstream.breaker.opens, 1)
+
+	def test_rateLimiter(self):
+		limiter = nextbus.RateLimiter(rate = 20.0, burst = 1)
+		self.assertLess(limiter.acquire(), 0.01)    # the bucket starts full
+		granted = [ ]
+		def take(name, priority):
+			limiter.acquire(priority)
+			granted.append(name)
+		threads = [ threading.Thread(target = take, args = ("background" + str(i), nextbus.priorityBackground)) for i in range(3) ]
+		for thisThread in threads:
+			thisThread.start()
+			time.sleep(0.005)
+		threads.append(threading.Thread(target = take, args = ("live", nextbus.priorityLive)))
+		threads[-1].start()
+		started = time.time()
+		for thisThread in threads: thisThread.join()
+		self.assertEqual(granted, [ "live", "background0", "background1", "background2" ])    # live jumps the queue
+		self.assertGreater(time.time() - started, 0.12)    # held to 20 a second, not refused
+		self.assertEqual(limiter.stats()["granted"], { nextbus.priorityLookup: 1, nextbus.priorityBackground: 3, nextbus.priorityLive: 1 })
+		async def takeAsync():
+			return await asyncio.gather(*[ limiter.acquireAsync(nextbus.priorityLive) for i in range(3) ])
+		started = time.time()
+		asyncio.run(takeAsync())
+		self.assertGreater(time.time() - started, 0.09)
+		self.addCleanup(setattr, nextbus.upstream, "rateLimiter", nextbus.upstream.rateLimiter)
+		nextbus.upstream.rateLimiter = nextbus.RateLimiter(rate = 20.0, burst = 2)
+		started = time.time()
+		self.assertEqual(list(nextbus.nextBusBatch([ ("Bryant", "Franklin", "south"), ("#21", "University", "west") ])), [ "5 Minutes", "10 Minutes" ])
+		self.assertGreater(time.time() - started, 0.15)    # five calls at 20 a second after a burst of two
+		stats = nextbus.upstream.stats()["rateLimiter"]
+		self.assertEqual(stats["granted"][nextbus.priorityBackground], 2)    # the batch's departure fetches
+		self.assertEqual(stats["granted"][nextbus.priorityLookup], 5)
+		nextbus.upstream.rateLimiter = nextbus.RateLimiter(rate = 10.0, burst = 1)
+		self.addCleanup(setattr, nextbus.upstream, "hedgeBudget", nextbus.upstream.hedgeBudget)
+		nextbus.upstream.hedging, nextbus.upstream.hedgeBudget = True, 1.0
+		for i in range(nextbus.upstream.minSamples): nextbus.upstream.tracker("departures").record(0.001)
+		self.stub.reset()
+		stops = [ "4/1/FRLY", "4/1/LALY", "21/2/SNUN", "21/3/UNSN", "14/1/BLLA", "535/1/MA4S" ]
+		threads = [ threading.Thread(target = nextbus.getMetroTransitService, args = ("/NexTrip/" + thisStop, None, False)) for thisStop in stops ]
+		for thisThread in threads: thisThread.start()
+		for thisThread in threads: thisThread.join()
+		self.assertEqual(nextbus.upstream.hedges, 0)    # waiting half a second for a token is not a slow service
+		self.assertEqual(sum(self.stub.requestCounts.values()), len(stops))
+
+	def test_recordReplay(self):
+		recorder = nextbus.RecordingTransport(nextbus.transport)
+		nextbus.setTransport(recorder)
+		self.assertEqual(nextbus.nextBus("Bryant", "Franklin", "south"), "5 Minutes")
+		self.assertEqual(nextbus.nextBus("#21", "University", "west"), "10 Minutes")
+		self.assertEqual(len(recorder.cassette), 7)
+		with tempfile.TemporaryDirectory() as cassetteDir:
+			cassettePath = os.path.join(cassetteDir, "nextbus.cassette")
+			recorder.cassette.save(cassettePath)
+			nextbus.setTransport(nextbus.ReplayTransport(cassettePath))
+			nextbus.invalidateServiceCache()
+			self.stub.reset()
+			for i in range(2):    # the last response for a path is repeated
+				self.assertEqual(nextbus.nextBus("Bryant", "Franklin", "south"), "5 Minutes")
+			self.assertEqual(nextbus.nextBus("#21", "University", "west"), "10 Minutes")
+			self.assertEqual(nextbus.nextBus("#121", "Church", "west"), "NETWORK ERROR")    # not recorded
+			self.assertEqual(dict(self.stub.requestCounts), { })
+			replayedLater = nextbus.ReplayTransport(nextbus.Cassette.load(cassettePath), shiftTimes = False, clock = lambda: time.time() + 600)
+			self.assertEqual(replayedLater.get(self.stub.url + "/NexTrip/4/1/FRLY").content, recorder.cassette.play("/NexTrip/4/1/FRLY", shiftTimes = False)[1])
+			self.assertEqual(nextbus.shiftDepartureTimes('[{"DepartureTime":"\\/Date(1000-0500)\\/"}]', 2.5), '[{"DepartureTime":"\\/Date(3500-0500)\\/"}]')
+			slowReplay = nextbus.ReplayTransport(cassettePath, latency = 0.2)
+			started = time.time()
+			self.assertTrue(slowReplay.get(self.stub.url + "/NexTrip/Routes").ok)
+			self.assertGreaterEqual(time.time() - started, 0.2)
+			with self.assertRaises(requests.Timeout):
+				slowReplay.get(self.stub.url + "/NexTrip/Routes", timeout = (1.0, 0.05))
+			cassetteStub = nextbus_stub.StubServer(cassettePath).start()
+			try:
+				nextbus.setTransport(nextbus.PooledTransport(retries = 0))
+				nextbus.metroTransitServiceUrl = cassetteStub.url
+				nextbus.invalidateServiceCache()
+				self.assertEqual(nextbus.nextBus("#21", "University", "west"), "10 Minutes")
+				self.assertEqual(nextbus.nextBus("#4", "Lyndale Ave and", "south"), "NETWORK ERROR")    # departures for LALY weren't recorded
+				cassetteStub.errorRate = 1.0
+				nextbus.invalidateServiceCache()
+				self.assertEqual(nextbus.nextBus("#21", "University", "west"), "NETWORK ERROR")
+			finally:
+				cassetteStub.stop()
+			nextbus.metroTransitServiceUrl = self.stub.url
+			nextbus.invalidateServiceCache()
+			asyncRecorder = nextbus.AsyncRecordingTransport()
+			nextbus.setAsyncTransport(asyncRecorder)
+			self.assertEqual(self.runAsync(nextbus.nextBusAsync("Bryant", "Franklin", "south")), "5 Minutes")
+			self.assertEqual(len(asyncRecorder.cassette), 4)
+			nextbus.setAsyncTransport(nextbus.AsyncReplayTransport(asyncRecorder.cassette, latency = 0.01))
+			nextbus.invalidateServiceCache()
+			self.stub.reset()
+			self.assertEqual(self.runAsync(nextbus.nextBusAsync("Bryant", "Franklin", "south")), "5 Minutes")
+			self.assertEqual(self.runAsync(nextbus.nextBusAsync("#121", "Church", "west")), "NETWORK ERROR")
+			self.assertEqual(dict(self.stub.requestCounts), { })
+			with open(cassettePath, "w") as badFile: badFile.write("[]")
+			with self.assertRaises(ValueError):
+				nextbus.Cassette.load(cassettePath)
+
+	def test_ttlLruCache(self):
+		now = [ 1000.0 ]
+		cache = nextbus.TtlLruCache(maxEntries = 2, clock = lambda: now[0])
+		cache.put("a", [ ], 10)
+		cache.put("b", 2, 100)
+		self.assertEqual(cache.get("a", nextbus.cacheMiss), [ ])
+		cache.put("c", 3)    # evicts b, the least recently used
+		self.assertIs(cache.get("b", nextbus.cacheMiss), nextbus.cacheMiss)
+		now[0] += 11
+		self.assertIsNone(cache.get("a"))    # expired
+		self.assertEqual(cache.get("c"), 3)
+		cache.put("d", 4, 0)    # zero ttl is not stored
+		self.assertIsNone(cache.get("d"))
+		self.assertEqual(cache.stats(), { 'size': 1, 'maxEntries': 2, 'hits': 2, 'misses': 3, 'evictions': 1 })
+		self.assertEqual(cache.invalidate("c"), 1)
+
+	def test_serviceCache(self):
+		self.assertEqual(nextbus.endpointClass("/NexTrip/Routes"), "routes")
+		self.assertEqual(nextbus.endpointClass("/NexTrip/Stops/21/2"), "stops")
+		self.assertEqual(nextbus.endpointClass("/NexTrip/21/2/SNUN"), "departures")
+		for i in range(3):
+			self.assertEqual(nextbus.nextBus("#21", "Snelling", "east", True), "2 Min")
+		self.assertEqual(self.stub.requestCounts["/NexTrip/Routes"], 1)
+		self.assertEqual(self.stub.requestCounts["/NexTrip/Stops/21/2"], 1)
+		self.assertEqual(self.stub.requestCounts["/NexTrip/21/2/SNUN"], 3)    # departures are always live
+		self.assertEqual(nextbus.invalidateServiceCache("/NexTrip/Stops/21"), 1)
+		nextbus.nextBus("#21", "Snelling", "east")
+		self.assertEqual(self.stub.requestCounts["/NexTrip/Stops/21/2"], 2)
+		self.assertEqual(self.stub.requestCounts["/NexTrip/Directions/21"], 1)
+		with self.assertRaises(IOError):    # errors are not cached and are still raised as IOError
+			nextbus.getMetroTransitService("/NexTrip/Directions/Squid")
+
+	def test_diskCache(self):
+		with tempfile.TemporaryDirectory() as cacheDir:
+			try:
+				nextbus.enableDiskCache(cacheDir)
+				self.assertEqual(nextbus.nextBus("#21", "Snelling", "east", True), "2 Min")
+				nextbus.serviceCache.invalidate()    # as if this were a new process
+				nextbus.resolutionCache.invalidate()
+				otherProcessCache = nextbus.SqliteCache(cacheDir)
+				self.assertEqual(otherProcessCache.get(self.stub.url + "/NexTrip/Directions/21"), [{'Text': 'EASTBOUND', 'Value': '2'}, {'Text': 'WESTBOUND', 'Value': '3'}])
+				self.assertEqual(nextbus.nextBus("#21", "Snelling", "east", True), "2 Min")
+				self.assertEqual(self.stub.requestCounts["/NexTrip/Routes"], 1)
+				self.assertEqual(self.stub.requestCounts["/NexTrip/21/2/SNUN"], 2)
+				nextbus.invalidateServiceCache("/NexTrip/Routes")
+				self.assertIsNone(otherProcessCache.get(self.stub.url + "/NexTrip/Routes"))
+				expiredCache = nextbus.SqliteCache(cacheDir, clock = lambda: time.time() + 7 * 3600)
+				self.assertIsNone(expiredCache.get(self.stub.url + "/NexTrip/Directions/21"))
+			finally:
+				nextbus.disableDiskCache()
+
+	def test_compactRecords(self):
+		stops = nextbus.getMetroTransitService("/NexTrip/Stops/21/2")
+		self.assertIsInstance(stops[0], nextbus.ServiceRecord)
+		self.assertEqual(stops, nextbus_stub.stubStops[("21", "2")])    # reads like the dictionaries
+		self.assertIs(stops[2]["Text"], nextbus.getMetroTransitService("/NexTrip/Stops/21/3")[1]["Text"])    # one interned string
+		self.assertEqual((stops[1]["Value"], stops[1].get("Nope", "-"), "Text" in stops[1], stops[1].keys()), ("SNUN", "-", True, [ "Text", "Value" ]))
+		with self.assertRaises(KeyError):
+			stops[1]["Nope"]
+		self.assertEqual(nextbus.commaList(nextbus.extractMatches(stops, "Text", "ave"), "Text"), "Snelling Ave and University Ave, Lake St and Lyndale Ave")
+		departures = nextbus.getTimepointDepartures("4", "1", "FRLY")
+		self.assertIs(type(departures[0]), type(departures[1]))    # one type for each set of fields
+		self.assertEqual(json.loads(json.dumps(departures, default = nextbus.serviceRecordJson)), departures)
+		self.assertEqual(nextbus.nextBus("Bryant", "Franklin", "south"), "5 Minutes")
+		result = nextbus.NextBusResult()
+		result.setError(nextbus.errorMultipleMatches, "MULTIPLE MATCHES ON STOP", "STOP", stops)
+		self.assertEqual(json.loads(json.dumps(result.toDict()))['matches'], stops)
+		self.assertEqual(nextbus.compactServiceObject({ 'items': 1 }), { 'items': 1 })    # a field that can't be a slot
+		streets = [ "Street " + str(i) for i in range(60) ]
+		bigCatalogue = json.dumps({ "/NexTrip/Stops/" + str(route) + "/" + str(direction): [ { 'Text': streets[(route + i) % 60] + " and " + streets[(route * 7 + i) % 60], 'Value': "S" + str(i) }
+			for i in range(40) ] for route in range(50) for direction in (1, 4) })
+		sizes = [ ]
+		try:
+			for compactRecords in (False, True):
+				nextbus.compactRecords = compactRecords
+				tracemalloc.start()
+				decoded = nextbus.decodeServiceJson(bigCatalogue)
+				sizes.append(tracemalloc.get_traced_memory()[0])
+				tracemalloc.stop()
+				self.assertEqual(type(decoded["/NexTrip/Stops/3/4"][5]) is dict, not compactRecords)
+			nextbus.compactRecords = False
+			nextbus.invalidateServiceCache()
+			self.assertIs(type(nextbus.getMetroTransitService("/NexTrip/Stops/21/2")[0]), dict)
+		finally:
+			nextbus.compactRecords = True
+		self.assertLess(sizes[1], sizes[0] / 2)
+
+	def test_resolveStop(self):
+		self.assertEqual(nextbus.resolveStop("#21", "Snelling", "east"), ("21", "2", "SNUN"))
+		self.assertEqual(nextbus.resolveStop("Bryant", "Lake St", "south"), ("4", "1", "LALY"))
+		with self.assertRaises(nextbus.NextBusError) as raised:
+			nextbus.resolveStop("Bryant", "Lake", "south")
+		self.assertEqual(str(raised.exception), "MULTIPLE MATCHES ON STOP: Lyndale Ave  and Lake St, 39th Ave and Silver Lake Rd, Silver Lake Village ")
+		self.assertEqual(nextbus.nextBus("#21", "Snelling", "north"), "NO MATCH ON DIRECTION")
+		self.assertEqual(nextbus.nextBus("#21", "Snelling", "t"), "MULTIPLE MATCHES ON DIRECTION: EASTBOUND, WESTBOUND")
+		self.assertEqual(nextbus.nextBus("Squigmire", "Snelling", "east"), "NO MATCH ON ROUTE")
+		self.assertEqual(nextbus.nextBus("#121", "Church", "west"), "")    # no more buses today
+
+	def test_nextBusResult(self):
+		nowTime = time.time()
+		result = nextbus.nextBusResult("Bryant", "Franklin", "south", 2, nowTime)
+		self.assertTrue(result.ok)
+		self.assertEqual((result.routeNumber, result.directionNumber, result.stopCode), ("4", "1", "FRLY"))
+		self.assertEqual([ thisDeparture.formatted() for thisDeparture in result.departures ], [ "5 Minutes", "20 Minutes" ])
+		self.assertEqual([ thisDeparture.departureText for thisDeparture in result.departures ], [ "5 Min", "20 Min" ])
+		self.assertTrue(result.departures[0].actual)
+		self.assertEqual(result.text(), "5 Minutes")
+		self.assertEqual(result.text(True), "5 Min")
+		self.assertEqual(self.stub.requestCounts["/NexTrip/4/1/FRLY"], 1)
+		self.assertEqual(len(nextbus.nextBusResult("Bryant", "Franklin", "south", None).departures), 3)
+		json.dumps(result.toDict())
+		result = nextbus.nextBusResult("Bryant", "Lake", "south")
+		self.assertFalse(result.ok)
+		self.assertEqual((result.errorKind, result.itemKind), (nextbus.errorMultipleMatches, "STOP"))
+		self.assertEqual([ thisStop["Value"] for thisStop in result.matches ], [ "LALY", "39SL", "SLVI" ])
+		self.assertEqual(str(result), nextbus.nextBus("Bryant", "Lake", "south"))
+		self.assertEqual(nextbus.nextBusResult("Squigmire", "Snelling", "east").errorKind, nextbus.errorNoMatch)
+		self.assertEqual(nextbus.nextBusResult("#121", "Church", "west").departures, [ ])
+
+	def test_staleWhileRevalidate(self):
+		nextbus.staleWhileRevalidate = True
+		nextbus.setTransport(nextbus.PooledTransport(retries = 0)).close()
+		result = nextbus.nextBusResult("Bryant", "Franklin", "south")
+		self.assertEqual((result.text(), result.stale, result.age), ("5 Minutes", False, 0.0))
+		self.assertFalse(nextbus.nextBusResult("Bryant", "Franklin", "south").stale)
+		self.assertEqual(self.stub.requestCounts["/NexTrip/4/1/FRLY"], 1)    # still fresh, so not fetched again
+		self.addCleanup(setattr, nextbus, "departureFreshness", nextbus.departureFreshness)
+		nextbus.departureFreshness = 0.0
+		self.stub.delay = 1.0
+		started = time.time()
+		result = nextbus.nextBusResult("Bryant", "Franklin", "south", nowTime = time.time() + 60)
+		self.assertLess(time.time() - started, 0.5)    # answered from the last-known list at once, not after the slow service
+		self.assertTrue(result.stale)
+		self.assertEqual(result.text(), "4 Minutes")    # recomputed for now
+		self.assertTrue(result.toDict()["stale"])
+		self.assertEqual(len(nextbus.nextBusResult("Bryant", "Franklin", "south", None, time.time() + 400).departures), 2)    # the first bus has left
+		time.sleep(1.2)
+		self.stub.delay = 0.0
+		self.stub.addFault("error")
+		result = nextbus.nextBusResult("Bryant", "Franklin", "south")
+		self.assertEqual((result.text(), result.stale), ("5 Minutes", True))    # the refresh behind it fails, leaving the last-known list in place
+		self.addCleanup(setattr, nextbus, "maxDepartureStaleness", nextbus.maxDepartureStaleness)
+		nextbus.maxDepartureStaleness = 0.2
+		nextbus.nextBusResult("Bryant", "Franklin", "south")
+		time.sleep(0.3)
+		self.stub.addFault("error")
+		self.assertEqual(nextbus.nextBus("Bryant", "Franklin", "south"), "NETWORK ERROR")    # too old to serve
+		self.assertFalse(self.runAsync(nextbus.nextBusResultAsync("Bryant", "Franklin", "south")).stale)
+		nextbus.maxDepartureStaleness = 120.0
+		self.stub.delay = 0.3
+		async def readWhileRefreshing():
+			answers = await asyncio.gather(*[ nextbus.getDeparturesStaleWhileRevalidateAsync("4", "1", "FRLY") for i in range(5) ])
+			refreshes = list(nextbus.departureRefreshTasks.values())
+			await asyncio.gather(*refreshes)
+			return answers, len(refreshes)
+		fetches = self.stub.requestCounts["/NexTrip/4/1/FRLY"]
+		answers, refreshCount = self.runAsync(readWhileRefreshing())
+		self.assertTrue(all(thisAnswer[1] for thisAnswer in answers))    # all answered from the last-known list
+		self.assertEqual(refreshCount, 1)    # by one refresh between them
+		self.assertEqual(self.stub.requestCounts["/NexTrip/4/1/FRLY"] - fetches, 1)
+		self.assertEqual(nextbus.departureRefreshTasks, { })
+
+	def test_nextBusWatch(self):
+		clock = [ time.time() ]
+		def sleep(seconds): clock[0] += seconds
+		watch = nextbus.NextBusWatch("Bryant", "Franklin", "south", clock = lambda: clock[0], sleep = sleep)
+		self.assertEqual(watch.current().text(), "5 Minutes")
+		self.assertAlmostEqual(watch.nextPollTime - clock[0], 75.0, delta = 1.0)    # a quarter of the time till the bus
+		clock[0] += 60
+		self.assertEqual(watch.current().text(), "4 Minutes")    # counted down without polling
+		self.assertEqual((watch.polls, self.stub.requestCounts["/NexTrip/4/1/FRLY"]), (1, 1))
+		clock[0] += 20
+		watch.current()
+		self.assertEqual(watch.polls, 2)
+		self.assertEqual(self.stub.requestCounts["/NexTrip/Routes"], 1)    # resolved only once
+		self.assertEqual(watch.pollInterval(nextbus.nextBusResult("#14", "Bloomington", "south")), watch.minInterval)
+		self.assertEqual(watch.pollInterval(nextbus.nextBusResult("#121", "Church", "west")), watch.maxInterval)
+		changes = watch.changes()
+		texts = [ next(changes).text() for i in range(3) ]
+		self.assertEqual(len(set(texts)), 3)
+		self.assertLessEqual(watch.polls, 5)
+		self.stub.addFault("error", count = 20, status = 503)
+		failingWatch = nextbus.NextBusWatch("#21", "Snelling", "east", clock = lambda: clock[0], sleep = sleep)
+		self.assertEqual(failingWatch.current().text(), "NETWORK ERROR")
+		clock[0] += 15
+		self.assertEqual(failingWatch.current().text(), "NETWORK ERROR")
+		self.assertEqual(failingWatch.polls, 1)    # no second try before errorInterval is up
+		self.stub.faults.clear()
+		clock[0] += failingWatch.errorInterval
+		self.assertTrue(failingWatch.current().ok)
+		self.assertEqual(failingWatch.polls, 2)
+		results = list(nextbus.NextBusWatch("Squigmire", "Snelling", "east", sleep = sleep).changes())
+		self.assertEqual([ thisResult.text() for thisResult in results ], [ "NO MATCH ON ROUTE" ])
+
+	def test_subscriptionScheduler(self):
+		clock = [ time.time() ]
+		alerts = [ ]
+		scheduler = nextbus.SubscriptionScheduler(alerts.append, clock = lambda: clock[0])
+		startTime = clock[0]
+		ids = { threshold: scheduler.subscribe("Bryant", "Franklin", "south", threshold) for threshold in (3, 4, 10, 22) }    # buses in 5, 20 and 40 minutes
+		snellingId = scheduler.subscribe("#21", "Snelling", "east", 2)    # buses in 1.5 and 16.7 minutes
+		with self.assertRaises(nextbus.NextBusError):
+			scheduler.subscribe("Squigmire", "Snelling", "east", 5)
+		def fired(alertList): return sorted((thisAlert.subscription.thresholdMinutes, round(thisAlert.minutes)) for thisAlert in alertList)
+		self.assertEqual(fired(scheduler.runPending()), [ (2, 2), (10, 5), (22, 5), (22, 20) ])
+		self.assertEqual(self.stub.requestCounts["/NexTrip/4/1/FRLY"], 1)    # one fetch for four subscriptions
+		self.assertEqual(fired(scheduler.runPending()), [ ])    # nothing due, so nothing fetched
+		self.assertEqual(scheduler.polls, 2)
+		self.assertAlmostEqual(scheduler.nextDueTime() - startTime, 15.0, delta = 1.0)    # the next crossing is a minute away, so poll soon
+		clock[0] = startTime + 61
+		self.assertEqual(fired(scheduler.runPending()), [ (4, 4) ])
+		self.assertEqual(self.stub.requestCounts["/NexTrip/4/1/FRLY"], 2)
+		scheduler.unsubscribe(ids[3])
+		scheduler.unsubscribe(snellingId)
+		clock[0] = startTime + 121
+		self.assertEqual(fired(scheduler.runPending()), [ ])
+		scheduler.subscribe("Bryant", "Franklin", "south", 30)
+		self.assertEqual(fired(scheduler.runPending()), [ (30, 3), (30, 18) ])    # both buses are already within 30 minutes, so alerted straight away
+		self.assertEqual(scheduler.stats()["subscriptions"], 4)
+		self.assertEqual(scheduler.stats()["stops"], 1)
+		self.assertEqual(scheduler.alerts, len(alerts))
+		self.assertEqual(scheduler.stats()["liveTimers"], len([ thisTimer for thisTimer in scheduler.timers if scheduler.timerIsCurrent(thisTimer) ]))
+
+	def test_departureBoard(self):
+		self.assertEqual(nextbus.parseBoardEntry("21/2/SNUN"), ("21", "2", "SNUN"))
+		with self.assertRaises(ValueError):
+			nextbus.parseBoardEntry("21/SNUN")
+		self.stub.delay = 0.3
+		startTime = time.time()
+		entries = [ ("4", "1", "FRLY"), ("4", "1", "LALY"), ("21", "2", "SNUN"), ("4", "1", "FRLY"), ("99", "x", "NONE") ]
+		departures, failedEntries = nextbus.departureBoard(entries, 5, startTime)
+		self.assertLess(time.time() - startTime, 0.9)    # fetched at once, not one after another
+		self.assertEqual(failedEntries, [ ("99", "x", "NONE") ])
+		self.assertEqual(self.stub.requestCounts["/NexTrip/4/1/FRLY"], 1)
+		self.assertEqual([ (thisDeparture.route, thisDeparture.formatted()) for thisDeparture in departures ],
+			[ ("21", "2 Minutes"), ("4", "5 Minutes"), ("4", "7 Minutes"), ("21", "17 Minutes"), ("4", "20 Minutes") ])
+		self.assertEqual(nextbus.formatBoardLine(departures[0]), "2 Minutes\t21\tEASTBOUND\t21")
+		self.assertEqual(len(nextbus.departureBoard(entries[0:3], None, startTime)[0]), 7)
+
+	def test_resolutionCache(self):
+		self.assertEqual(nextbus.nextBus("#21", "Snelling", "east", True), "2 Min")
+		self.assertEqual(nextbus.nextBus("Bryant", "Lake", "south")[0:26], "MULTIPLE MATCHES ON STOP: ")
+		self.stub.reset()
+		self.assertEqual(nextbus.nextBus("#21", "SNELLING", "East", True), "2 Min")
+		self.assertEqual(nextbus.nextBus("#21", "snelling", "EAST", True), "2 Min")
+		self.assertEqual(dict(self.stub.requestCounts), { "/NexTrip/21/2/SNUN": 2 })    # exactly one departures fetch per repeat
+		self.assertEqual(nextbus.nextBus("bryant", "LAKE", "South"), "MULTIPLE MATCHES ON STOP: Lyndale Ave  and Lake St, 39th Ave and Silver Lake Rd, Silver Lake Village ")
+		self.assertEqual(nextbus.resolveStop("#21", "Snelling", "east"), ("21", "2", "SNUN"))
+		self.assertEqual(sum(self.stub.requestCounts.values()), 2)
+		nextbus.invalidateServiceCache("/NexTrip/Stops/21/2")
+		self.assertEqual(nextbus.resolveStop("#21", "Snelling", "east"), ("21", "2", "SNUN"))
+		self.assertEqual(self.stub.requestCounts["/NexTrip/Stops/21/2"], 1)
+		self.assertEqual(self.runAsync(nextbus.resolveStopAsync("#21", "Snelling", "east")), ("21", "2", "SNUN"))
+		self.assertEqual(sum(self.stub.requestCounts.values()), 3)
+
+	def test_negativeCache(self):
+		nextbus.negativeQueries.clear()
+		nextbus.errorResponsePaths.clear()
+		message = nextbus.nextBus("Bryant", "Lake", "south")
+		self.stub.reset()
+		for i in range(5):
+			self.assertEqual(nextbus.nextBus("BRYANT", "lake", "South"), message)    # byte-identical, from the cache
+			self.assertEqual(nextbus.nextBus("Squigmire", "Snelling", "east"), "NO MATCH ON ROUTE")
+		self.assertEqual(sum(self.stub.requestCounts.values()), 0)
+		self.assertEqual(nextbus.negativeQueries.top(1), [ [ "BRYANT / LAKE / SOUTH", 6 ] ])
+		self.assertEqual(nextbus.resolutionCache.stats()["size"], 0)    # bad queries don't take the place of good ones
+		self.assertEqual(nextbus.negativeResolutionCache.stats()["size"], 2)
+		for i in range(3):
+			with self.assertRaises(nextbus.ServiceError) as raised:
+				nextbus.getMetroTransitService("/NexTrip/Directions/999")
+			self.assertEqual(raised.exception.statusCode, 400)
+		self.assertEqual(self.stub.requestCounts["/NexTrip/Directions/999"], 1)
+		with self.assertRaises(IOError):
+			self.runAsync(nextbus.getMetroTransitServiceAsync("/NexTrip/Directions/999"))
+		self.assertEqual(self.stub.requestCounts["/NexTrip/Directions/999"], 1)
+		stats = nextbus.negativeCacheStats()
+		self.assertEqual(stats["topErrorPaths"], [ [ "/NexTrip/Directions/999", 4 ] ])
+		self.stub.addFault("error", status = 503)
+		nextbus.setTransport(nextbus.PooledTransport(retries = 0)).close()
+		with self.assertRaises(IOError):
+			nextbus.getMetroTransitService("/NexTrip/21/2/SNUN")
+		self.assertEqual(len(nextbus.getMetroTransitService("/NexTrip/21/2/SNUN")), 2)    # a 5xx isn't remembered
+		nextbus.invalidateServiceCache()
+		nextbus.getMetroTransitService("/NexTrip/Directions/21")
+		with self.assertRaises(IOError):
+			nextbus.getMetroTransitService("/NexTrip/Directions/999")
+		self.assertEqual(self.stub.requestCounts["/NexTrip/Directions/999"], 2)
+
+	def test_speculativeResolution(self):
+		self.assertEqual(nextbus.guessRouteNumber("#21"), "21")
+		self.assertEqual(nextbus.guessRouteNumber("#21 - Uptown"), None)
+		self.assertEqual(nextbus.guessRouteNumber("21"), None)
+		self.assertEqual(nextbus.guessDirectionNumbers("north"), [ "4" ])
+		self.assertEqual(nextbus.guessDirectionNumbers("ST"), [ "2", "3" ])
+		queries = [ ("#21", "Snelling", "east"), ("21 - Uptown", "Snelling", "east"), ("Bryant", "Lake", "south"), ("#4", "Franklin", "north"), ("#21", "Snelling", "t"),
+			("#21", "Snelling", "#any"), ("#121", "Church", "west"), ("#14", "Bloomington", "SOUTHBOUND"), ("#999", "Lake", "south"), ("Squigmire", "Lake", "south") ]
+		serialResults = [ nextbus.nextBus(*thisQuery, True) for thisQuery in queries ]
+		for thisQuery, serialResult in zip(queries, serialResults):
+			with self.subTest(thisQuery=thisQuery):
+				nextbus.invalidateServiceCache()
+				try:
+					self.assertEqual(nextbus.formatNextBus(nextbus.getTimepointDepartures(*nextbus.resolveStop(*thisQuery, speculative = True)), True), serialResult)
+				except nextbus.NextBusError as lookupError:
+					self.assertEqual(str(lookupError), serialResult)
+		nextbus.invalidateServiceCache()
+		nextbus.errorResponsePaths.clear()
+		self.addCleanup(setattr, nextbus.upstream, "rateLimiter", nextbus.upstream.rateLimiter)
+		nextbus.upstream.rateLimiter = nextbus.RateLimiter(rate = 1000.0, burst = 100)
+		with self.assertRaises(nextbus.NextBusError):
+			nextbus.withPriority(nextbus.priorityBackground, nextbus.resolveStop, "#999", "Lake", "south", True, True)
+		time.sleep(0.2)    # let the wrong guess's fetches finish, if they weren't cancelled
+		self.assertEqual(nextbus.errorResponsePaths.top(), [ ])    # nobody asked for Directions/999
+		self.assertIsNone(nextbus.errorResponseCache.get(nextbus.metroTransitServiceUrl + "/NexTrip/Directions/999"))
+		self.assertEqual(set(nextbus.upstream.rateLimiter.stats()["granted"]), { nextbus.priorityBackground })    # the guesses ran in the caller's lane
+		self.stub.delay = 0.3
+		for thisQuery, roundTrips in [ (("#21", "Snelling", "east"), 2), (("21 - Uptown", "Snelling", "east"), 3) ]:
+			with self.subTest(thisQuery=thisQuery):
+				nextbus.invalidateServiceCache()
+				started = time.time()
+				nextbus.getTimepointDepartures(*nextbus.resolveStop(*thisQuery, speculative = True))
+				self.assertLess(time.time() - started, 0.3 * roundTrips + 0.25)
+		nextbus.metroTransitServiceUrl = self.stub.url + "/Unreal"
+		with self.assertRaises(IOError):
+			nextbus.resolveStop("#21", "Snelling", "east", speculative = True)
+
+	def test_parseBatchLine(self):
+		self.assertEqual(nextbus.parseBatchLine('#21,Snelling,east\n'), ("#21", "Snelling", "east"))
+		self.assertEqual(nextbus.parseBatchLine('"Lake St, Lyndale", "Lake St", south'), ("Lake St, Lyndale", "Lake St", "south"))
+		self.assertEqual(nextbus.parseBatchLine('{"route": "#4", "stop": "Franklin", "direction": "south"}'), ("#4", "Franklin", "south"))
+		self.assertEqual(nextbus.parseBatchLine('["#4", "Franklin", "south"]'), ("#4", "Franklin", "south"))
+		self.assertIsNone(nextbus.parseBatchLine('   \n'))
+		for badLine in [ '#21,Snelling', '{"route": "#4"}', '["#4", 5, "south"]', '{"route": ' ]:
+			with self.subTest(badLine=badLine):
+				with self.assertRaises(ValueError):
+					nextbus.parseBatchLine(badLine)
+
+	def test_nextBusBatch(self):
+		queries = [ ("#21", "Snelling", "east"), ("#4", "Franklin", "south"), None, ("#21", "SNELLING", "East"), ("Bryant", "Lake", "south"), ("#21", "Snelling", "east") ] * 5
+		expected = [ nextbus.nextBus(*thisQuery, True) if thisQuery is not None else "PARAMETER ERROR" for thisQuery in queries ]
+		for thisRefresh in list(nextbus.departureRefreshes.values()): thisRefresh.result()    # let any background refresh finish before counting
+		self.stub.reset()
+		self.assertEqual(list(nextbus.nextBusBatch(queries, maxWorkers = 3, returnDepartureText = True)), expected)
+		self.assertEqual(self.stub.requestCounts["/NexTrip/Routes"], 0)    # already cached by the nextBus calls above
+		self.assertEqual(self.stub.requestCounts["/NexTrip/21/2/SNUN"], 1)
+		self.assertEqual(self.stub.requestCounts["/NexTrip/4/1/FRLY"], 1)
+
+	def test_nextBusAsync(self):
+		queries = [ ("#21", "Snelling", "east"), ("#4", "Franklin", "south"), ("#21", "SNELLING", "north"), ("Bryant", "Lake", "south"), ("Squigmire", "Lake", "south"), ("#121", "Church", "west") ]
+		expected = [ nextbus.nextBus(*thisQuery, True) for thisQuery in queries ]
+		nextbus.invalidateServiceCache()
+		async def runQueries():
+			self.assertEqual(await nextbus.resolveStopAsync("#4", "Franklin", "south"), ("4", "1", "FRLY"))
+			self.assertEqual(len(await nextbus.getRouteMatchesAsync("Lake")), 1)
+			return await asyncio.gather(*[ nextbus.nextBusAsync(*thisQuery, True) for thisQuery in queries * 20 ])
+		self.stub.reset()
+		self.assertEqual(self.runAsync(runQueries()), expected * 20)
+		self.assertLessEqual(self.stub.connectionCount, nextbus.asyncTransport.poolSize)    # connections are pooled and reused
+		self.assertIn(self.stub.requestCounts["/NexTrip/4/1/FRLY"], range(1, 21))    # concurrent identical fetches may be coalesced
+		with self.assertRaises(IOError):
+			self.runAsync(nextbus.getMetroTransitServiceAsync("/NexTrip/Unreal/Address"))
+
+	def test_asyncTransportRedirects(self):
+		routes = nextbus.getMetroTransitService("/NexTrip/Routes", None, False)
+		self.stub.reset()
+		self.stub.addFault("redirect", status = 301)
+		self.stub.addFault("redirect", status = 307)
+		self.assertEqual(self.runAsync(nextbus.getMetroTransitServiceAsync("/NexTrip/Routes", None, False)), routes)    # followed, as by requests
+		self.assertEqual([ self.stub.requestCounts[thisPath] for thisPath in [ "/NexTrip/Routes", "/Moved/NexTrip/Routes", "/Moved/Moved/NexTrip/Routes" ] ], [ 1, 1, 1 ])
+		nextbus.setAsyncTransport(nextbus.AsyncTransport(maxRedirects = 2))
+		self.stub.addFault("redirect", count = 3, status = 302)
+		with self.assertRaises(IOError):
+			self.runAsync(nextbus.getMetroTransitServiceAsync("/NexTrip/Routes", None, False))
+		nextbus.setAsyncTransport(nextbus.AsyncTransport(timeout = 2.0))
+		self.stub.reset()
+		for thisStatus in [ 204, 304 ]:
+			with self.subTest(thisStatus=thisStatus):
+				self.stub.addFault("error", status = thisStatus)
+				async def fetchTwice():
+					with self.assertRaises(IOError):    # no JSON in an empty body
+						await nextbus.getMetroTransitServiceAsync("/NexTrip/Routes", None, False)
+					return await nextbus.getMetroTransitServiceAsync("/NexTrip/Routes", None, False)
+				started = time.time()
+				self.assertEqual(self.runAsync(fetchTwice()), routes)
+				self.assertLess(time.time() - started, 1.0)    # not waiting for a body that never comes
+				self.assertEqual(self.stub.connectionCount, 1)    # and the connection is still good for the next call
+				self.stub.reset()
+
+	def test_nextBusAsyncTimeout(self):
+		nextbus.setAsyncTransport(nextbus.AsyncTransport(timeout = 0.2))
+		self.stub.delay = 1.0
+		started = time.time()
+		self.assertEqual(self.runAsync(nextbus.nextBusAsync("#21", "Snelling", "east")), "NETWORK ERROR")
+		self.assertLess(time.time() - started, 0.9)
+
+	def test_nextBusServer(self):
+		server = nextbus.NextBusServer(("127.0.0.1", 0))
+		serverThread = threading.Thread(target = server.serve_forever, daemon = True)
+		serverThread.start()
+		serverUrl = "http://127.0.0.1:" + str(server.server_address[1])
+		try:
+			with requests.Session() as session:
+				for thisQuery in [ ("#21", "Snelling", "east"), ("Bryant", "Lake", "south"), ("#any", "x", "north"), ("#121", "Church", "west") ]:
+					with self.subTest(thisQuery=thisQuery):
+						params = { 'route': thisQuery[0], 'stop': thisQuery[1], 'direction': thisQuery[2] }
+						textResponse = session.get(serverUrl + "/nextbus", params = params)
+						self.assertEqual(textResponse.status_code, 200)
+						self.assertEqual(textResponse.text, nextbus.nextBus(*thisQuery) + "\n")
+						self.assertTrue(textResponse.headers["X-Response-Time"].endswith("ms"))
+						params['format'] = 'json'
+						jsonResponse = session.get(serverUrl + "/nextbus", params = params).json()
+						self.assertEqual(jsonResponse['result'], nextbus.nextBus(*thisQuery))
+						self.assertGreaterEqual(jsonResponse['latencyMs'], 0)
+				self.assertEqual(session.get(serverUrl + "/nextbus", params = { 'route': '#21' }).status_code, 400)
+				self.assertEqual(session.get(serverUrl + "/nothing").status_code, 404)
+				stats = session.get(serverUrl + "/stats").json()
+				self.assertEqual(stats['requests'], 10)
+				self.assertGreater(stats['serviceCache']['hits'], 0)
+		finally:
+			server.shutdown()
+			server.server_close()
+
+	def test_metrics(self):
+		self.assertEqual(nextbus.nextBus("Bryant", "Franklin", "south"), "5 Minutes")
+		self.assertEqual(nextbus.metrics.stats()['stages'], { })    # nothing collected while off
+		nextbus.invalidateServiceCache()
+		nextbus.metrics.enable()
+		self.assertEqual(nextbus.nextBus("Bryant", "Franklin", "south"), "5 Minutes")
+		self.assertEqual(nextbus.nextBus("Bryant", "Lake", "south")[0:25], "MULTIPLE MATCHES ON STOP:")
+		stats = nextbus.metrics.stats()
+		self.assertEqual({ thisStage: stage['calls'] for thisStage, stage in stats['stages'].items() },
+			{ 'query': 2, 'resolve': 1, 'departures': 1, 'service routes': 2, 'service directions': 2, 'service stops': 2, 'service departures': 1, 'http': 4, 'decode': 4, 'match': 6 })
+		self.assertLessEqual(stats['stages']['resolve']['seconds'], stats['stages']['query']['seconds'])
+		self.assertEqual(stats['counters']['httpRequests'], { 'routes': 1, 'directions': 1, 'stops': 1, 'departures': 1 })
+		self.assertEqual(stats['counters']['httpStatus'], { 200: 4 })
+		self.assertGreater(stats['counters']['httpBytes']['routes'], 0)
+		self.assertEqual(stats['counters']['cacheLookups'], { 'miss': 3, 'memory': 3 })    # the second query's routes, directions and stops were cached
+		self.assertEqual(stats['counters']['results'], { 'OK': 1, nextbus.errorMultipleMatches: 1 })
+		self.stub.addFault("error", status = 404)
+		nextbus.invalidateServiceCache()
+		self.assertEqual(nextbus.nextBus("Bryant", "Franklin", "south"), "NETWORK ERROR")
+		self.assertEqual(nextbus.metrics.stats()['counters']['serviceErrors'], { 'ServiceError': 1 })
+		exposition = nextbus.metrics.prometheus()
+		self.assertIn('nextbus_stage_seconds_bucket{stage="query",le="+Inf"} 3\n', exposition)
+		self.assertIn('nextbus_stage_seconds_count{stage="service stops"} 2\n', exposition)
+		self.assertIn('nextbus_results_total{kind="NETWORK ERROR"} 1\n', exposition)
+		self.assertIn("# TYPE nextbus_http_requests_total counter\n", exposition)
+		profile = nextbus.metrics.profile().split("\n")
+		self.assertEqual(profile[1].split()[0:2], [ "query", "3" ])    # the slowest stage in total first
+		server = nextbus.NextBusServer(("127.0.0.1", 0))
+		threading.Thread(target = server.serve_forever, daemon = True).start()
+		try:
+			response = requests.get("http://127.0.0.1:" + str(server.server_address[1]) + "/metrics")
+			self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+			self.assertIn('nextbus_results_total{kind="OK"} 1\n', response.text)
+		finally:
+			server.shutdown()
+			server.server_close()
+
+	def test_catalogueSnapshot(self):
+		catalogue = nextbus.crawlCatalogue()
+		self.assertEqual(len(catalogue), 1 + len(nextbus_stub.stubRoutes) + len(nextbus_stub.stubStops))
+		self.assertEqual(catalogue["/NexTrip/Stops/21/3"], nextbus_stub.stubStops[("21", "3")])
+		with tempfile.TemporaryDirectory() as snapshotDir:
+			snapshotPath = os.path.join(snapshotDir, "catalogue.snapshot")
+			nextbus.writeCatalogueSnapshot(snapshotPath, catalogue)
+			try:
+				snapshot = nextbus.useCatalogueSnapshot(snapshotPath)
+				self.stub.reset()
+				self.assertEqual(nextbus.nextBus("#21", "Snelling", "east", True), "2 Min")
+				self.assertEqual(nextbus.nextBus("Bryant", "Lake", "south"), "MULTIPLE MATCHES ON STOP: Lyndale Ave  and Lake St, 39th Ave and Silver Lake Rd, Silver Lake Village ")
+				self.assertEqual(dict(self.stub.requestCounts), { "/NexTrip/21/2/SNUN": 1 })    # everything else came from the snapshot
+				self.assertEqual(nextbus.serviceCache.stats()['size'], 0)    # and wasn't copied into this process's cache
+				routes = snapshot.get("/NexTrip/Routes")
+				self.assertEqual(nextbus.getMatchIndex(routes, "Description").keys[2], "21 - UPTOWN - LAKE ST - SELBY AV")
+				catalogue["/NexTrip/Routes"] = catalogue["/NexTrip/Routes"][0:2]
+				nextbus.writeCatalogueSnapshot(snapshotPath, catalogue)    # as the refresher process does
+				snapshot.nextCheck = 0
+				self.assertEqual(len(nextbus.getMetroTransitService("/NexTrip/Routes")), 2)
+				self.assertIsNone(snapshot.get("/NexTrip/Stops/99/1"))
+			finally:
+				nextbus.useCatalogueSnapshot(None)
+			with open(snapshotPath, "wb") as badFile: badFile.write(b"not a snapshot")
+			with self.assertRaises(ValueError):
+				nextbus.CatalogueSnapshot(snapshotPath)
+
+	def test_compactCatalogue(self):
+		with tempfile.TemporaryDirectory() as snapshotDir:
+			snapshotPath = os.path.join(snapshotDir, "catalogue.snapshot")
+			self.assertIsNone(nextbus.useFreshCatalogueSnapshot(snapshotPath))    # not built yet
+			catalogue = nextbus.crawlCatalogue()
+			streets = [ "Street " + str(i) for i in range(60) ]
+			bigCatalogue = { "/NexTrip/Stops/" + str(route) + "/" + str(direction): [ { 'Text': streets[(route + i) % 60] + " and " + streets[(route * 7 + i) % 60], 'Value': "S" + str(i) }
+				for i in range(40) ] for route in range(50) for direction in (1, 4) }
+			nextbus.writeCatalogueSnapshot(snapshotPath, bigCatalogue)
+			self.assertLess(os.path.getsize(snapshotPath), len(json.dumps(bigCatalogue)) / 2)    # names repeat, and each is stored once
+			self.assertEqual(nextbus.CatalogueSnapshot(snapshotPath).get("/NexTrip/Stops/7/4"), bigCatalogue["/NexTrip/Stops/7/4"])
+			self.assertTrue(nextbus.refreshCatalogueSnapshot(snapshotPath, maxWorkers = 4))
+			try:
+				snapshot = nextbus.useFreshCatalogueSnapshot(snapshotPath)
+				self.assertEqual(snapshot.get("/NexTrip/Stops/4/1"), catalogue["/NexTrip/Stops/4/1"])
+				self.assertIs(snapshot.get("/NexTrip/Stops/21/2")[2]["Text"], snapshot.get("/NexTrip/Stops/21/3")[1]["Text"])    # one string object for both
+				self.assertEqual(snapshot.stats()["records"], sum(len(thisResult) for thisResult in catalogue.values()))
+				self.stub.reset()
+				self.assertEqual(nextbus.nextBus("Bryant", "Franklin", "south"), "5 Minutes")
+				self.assertEqual(dict(self.stub.requestCounts), { "/NexTrip/4/1/FRLY": 1 })    # only the live departures
+			finally:
+				nextbus.useCatalogueSnapshot(None)
+			self.assertIsNone(nextbus.useFreshCatalogueSnapshot(snapshotPath, maxAge = -1))    # too old
+			self.assertIsNone(nextbus.catalogueSnapshot)
+			laterPath = os.path.join(snapshotDir, "later.snapshot")
+			self.addCleanup(setattr, nextbus, "catalogueRetryInterval", nextbus.catalogueRetryInterval)
+			nextbus.catalogueRetryInterval = 0.0
+			try:
+				self.assertIsNone(nextbus.awaitCatalogueSnapshot(laterPath))    # not built yet
+				self.assertEqual(nextbus.nextBus("Bryant", "Franklin", "south"), "5 Minutes")
+				self.assertTrue(nextbus.refreshCatalogueSnapshot(laterPath))
+				nextbus.invalidateServiceCache()
+				self.stub.reset()
+				self.assertEqual(nextbus.nextBus("Bryant", "Franklin", "south"), "5 Minutes")
+				self.assertEqual(dict(self.stub.requestCounts), { "/NexTrip/4/1/FRLY": 1 })    # picked up on the next lookup once built
+				self.assertEqual(nextbus.catalogueSnapshot.path, laterPath)
+			finally:
+				nextbus.useCatalogueSnapshot(None)
+			nextbus.writeCatalogueSnapshot(snapshotPath, { "/NexTrip/Stops/1/1": [ { 'Text': 'Odd  Stop', 'Value': 7, 'Extra': None } ] })
+			oddStops = nextbus.CatalogueSnapshot(snapshotPath).get("/NexTrip/Stops/1/1")
+			self.assertEqual(oddStops, [ { 'Text': 'Odd  Stop', 'Value': 7, 'Extra': None } ])    # values that aren't strings survive
+			self.assertEqual(nextbus.getMatchIndex(oddStops, "Text").keys, [ "ODD STOP" ])
+			with open(snapshotPath, "r+b") as oldFile:
+				oldFile.seek(len(nextbus.catalogueMagic))
+				oldFile.write(bytes([ 1 ]))    # as written by an older version
+			with self.assertRaises(ValueError):
+				nextbus.CatalogueSnapshot(snapshotPath)
+
+	def test_stopIndex(self):
+		index = nextbus.getStopIndex(rebuild = True)
+		self.assertIs(nextbus.getStopIndex(), index)
+		self.assertEqual((len(index), index.stats()['services']), (16, 18))    # LALY is served three times
+		self.stub.reset()
+		self.assertEqual(index.routesServing("laly"), [ ("4", "1", "SOUTHBOUND"), ("21", "2", "EASTBOUND"), ("21", "3", "WESTBOUND") ])
+		self.assertEqual(index.routesServing("NONE"), [ ])
+		self.assertEqual(index.stop("LALY").name, "Lyndale Ave  and Lake St")    # the first name seen
+		self.assertEqual(set(thisStop.code for thisStop in index.search("Lake & Lyndale", 2)), { "LALY", "LKLY" })
+		self.assertEqual([ thisStop.code for thisStop in index.search("franklin lyndale")[0:2] ], [ "FRLY", "LYFR" ])
+		self.assertEqual(index.search("FRLY")[0].code, "FRLY")    # a stop code
+		self.assertEqual(set(thisStop.code for thisStop in index.search("Frankln Lyndal", 2)), { "FRLY", "LYFR" })    # misspelt
+		self.assertEqual(set(thisStop.code for thisStop in index.search("univ snell", 2)), { "UNSN", "SNUN" })    # word beginnings
+		self.assertEqual(index.search("Snelling and University")[0].code, "SNUN")    # the words in the same order
+		self.assertEqual(index.search("nowhere at all"), [ ])
+		self.assertEqual(index.stop("LKLY").toDict(), { 'code': "LKLY", 'name': "Lake St and Lyndale Ave", 'servedBy': [ [ "4", "4", "NORTHBOUND" ] ] })
+		self.assertEqual(dict(self.stub.requestCounts), { })    # all in memory
+		nextbus.getStopIndex(rebuild = True)
+		self.assertEqual(dict(self.stub.requestCounts), { })    # crawled again through the service cache
+		with tempfile.TemporaryDirectory() as snapshotDir:
+			savedPath = os.path.join(snapshotDir, "saved.snapshot")
+			try:
+				self.assertEqual(nextbus.getStopIndex(rebuild = True, snapshotPath = savedPath).routesServing("LALY"), index.routesServing("LALY"))
+				self.assertEqual(nextbus.catalogueSnapshot.path, savedPath)    # the crawl was saved, and is used from now on
+				self.assertEqual(nextbus.CatalogueSnapshot(savedPath).stats()["results"], len(nextbus.crawlCatalogue()))
+			finally:
+				nextbus.useCatalogueSnapshot(None)
+			snapshotPath = os.path.join(snapshotDir, "catalogue.snapshot")
+			self.assertTrue(nextbus.refreshCatalogueSnapshot(snapshotPath))
+			try:
+				nextbus.useCatalogueSnapshot(snapshotPath)
+				self.stub.reset()
+				snapshotIndex = nextbus.getStopIndex()
+				self.assertIsNot(snapshotIndex, index)
+				self.assertEqual(snapshotIndex.routesServing("LALY"), index.routesServing("LALY"))
+				self.assertEqual(dict(self.stub.requestCounts), { })    # built from the snapshot
+			finally:
+				nextbus.useCatalogueSnapshot(None)
+
+	@unittest.skipUnless(hasattr(os, "fork"), "pre-fork serving needs os.fork")
+	def test_servePreforked(self):
+		with socket.socket() as portFinder:
+			portFinder.bind(("127.0.0.1", 0))
+			port = portFinder.getsockname()[1]
+		with tempfile.TemporaryDirectory() as snapshotDir:
+			script = "import sys, nextbus; nextbus.metroTransitServiceUrl = sys.argv[1]; nextbus.servePreforked(('127.0.0.1', int(sys.argv[2])), 2, sys.argv[3], logRequests = False)"
+			environment = dict(os.environ, PYTHONPATH = os.path.dirname(os.path.abspath(nextbus.__file__)))
+			server = subprocess.Popen([ sys.executable, "-c", script, self.stub.url, str(port), os.path.join(snapshotDir, "catalogue.snapshot") ], env = environment, start_new_session = True)
+			try:
+				serverUrl = "http://127.0.0.1:" + str(port)
+				for attempt in range(100):
+					try:
+						requests.get(serverUrl + "/stats", timeout = 1)
+						break
+					except requests.ConnectionError:
+						time.sleep(0.1)
+				self.stub.reset()
+				self.stub.departureOffsets[("21", "2", "SNUN")] = [ 300 ]
+				processIds = set()
+				for i in range(20):
+					self.assertEqual(requests.get(serverUrl + "/nextbus", params = { 'route': "#21", 'stop': "Snelling", 'direction': "east", 'format': "json" }).json()['result'], "5 Minutes")
+					processIds.add(requests.get(serverUrl + "/stats").json()['processId'])
+				self.assertEqual(list(self.stub.requestCounts), [ "/NexTrip/21/2/SNUN" ])    # workers answer the catalogue from the shared snapshot
+				self.assertLessEqual(self.stub.requestCounts["/NexTrip/21/2/SNUN"], 2)    # and fetch departures once each while they are fresh
+				self.assertNotIn(server.pid, processIds)
+				server.send_signal(signal.SIGTERM)    # to the parent alone, as a service manager would
+				self.assertEqual(server.wait(10), 0)
+				for processId in processIds:
+					with self.assertRaises(ProcessLookupError):
+						os.kill(processId, 0)    # the workers went with it
+			finally:
+				try:
+					os.killpg(server.pid, signal.SIGKILL)
+				except ProcessLookupError:
+					pass
+				server.wait(10)
+
+	def test_singleFlight(self):
+		self.stub.delay = 0.3
+		flightStats = nextbus.serviceFlights.stats()
+		results = [ None ] * 10
+		def fetchDepartures(i):
+			results[i] = nextbus.getTimepointDepartures("21", "2", "SNUN")
+		threads = [ threading.Thread(target = fetchDepartures, args = (i,)) for i in range(10) ]
+		for thisThread in threads: thisThread.start()
+		for thisThread in threads: thisThread.join()
+		self.assertEqual(self.stub.requestCounts["/NexTrip/21/2/SNUN"], 1)
+		self.assertTrue(all(thisResult is results[0] for thisResult in results))
+		self.assertEqual(nextbus.serviceFlights.stats()['collapsed'] - flightStats['collapsed'], 9)
+		self.assertEqual(nextbus.serviceFlights.stats()['inFlight'], 0)
+		async def fetchFromTasksAndThreads():
+			threadFetch = asyncio.get_running_loop().run_in_executor(None, nextbus.getTimepointDepartures, "4", "1", "FRLY")
+			return await asyncio.gather(*([ nextbus.getTimepointDeparturesAsync("4", "1", "FRLY") for i in range(10) ] + [ threadFetch ]))
+		mixedResults = self.runAsync(fetchFromTasksAndThreads())
+		self.assertEqual(self.stub.requestCounts["/NexTrip/4/1/FRLY"], 1)
+		self.assertEqual(len(set(json.dumps(thisResult, default = nextbus.serviceRecordJson) for thisResult in mixedResults)), 1)
+		errors = [ ]
+		def fetchBadPath():
+			try:
+				nextbus.getMetroTransitService("/NexTrip/Unreal/Address")
+			except IOError as error:
+				errors.append(error)
+		threads = [ threading.Thread(target = fetchBadPath) for i in range(5) ]
+		for thisThread in threads: thisThread.start()
+		for thisThread in threads: thisThread.join()
+		self.assertEqual(len(errors), 5)
+		self.assertEqual(self.stub.requestCounts["/NexTrip/Unreal/Address"], 1)
+
+	def test_parseCommandLine(self):
+		flags, values = [ "--no-cache" ], [ "--cache-dir" ]
+		self.assertEqual(nextbus.parseCommandLine([ "#21", "--no-cache", "Snelling", "east" ], flags, values), ({ '--no-cache': True }, [ "#21", "Snelling", "east" ]))
+		self.assertEqual(nextbus.parseCommandLine([ "--cache-dir", "/tmp/x", "a" ], flags, values), ({ '--cache-dir': "/tmp/x" }, [ "a" ]))
+		self.assertEqual(nextbus.parseCommandLine([ "--cache-dir=/tmp/y", "--help" ], flags, values), ({ '--cache-dir': "/tmp/y" }, [ "--help" ]))
+		with self.assertRaises(ValueError):
+			nextbus.parseCommandLine([ "a", "--cache-dir" ], flags, values)
+
 if __name__ == "__main__":
 	print ("------------------------------------------------------------")
 	print ("NextBus Unit Tests:")